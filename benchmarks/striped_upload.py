@@ -0,0 +1,97 @@
+"""
+Benchmark for striped uploads
+
+Makes the same upload once on a single stream and once striped over
+several connections, and reports how long each took and the speedup
+of striping.
+
+By default both run against a local Server with a StripedSink, and
+each upload is timed until the server has received all of it. Given
+a host, the uploads go to the bot on that host instead (which must run
+with --stripes so it has a sink), and are timed until the server has
+acknowledged every byte.
+
+The speedup is only what several connections gain over one on the
+same path. The connection manager places host pairs, not connections,
+so every stripe of an upload goes over the same arm of the diamond; the
+sport and dport in the notifications aren't used to split them.
+
+Usage: python3 benchmarks/striped_upload.py [megabytes] [stripes] [host [port]]
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from upload_bot.server import Server
+from upload_bot.client import Client
+from upload_bot.payload import PayloadPool, DEFAULT_MAX_SIZE
+from upload_bot.workload import UploadPlan, MB
+from upload_bot.striping import split_plan
+
+
+class Completions:
+    """
+    Stands in for a FlowRecorder; signals when the server has seen a flow
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+    def record(self, side, src, dest, start, duration, size):
+        if side.startswith("server"):
+            self.done.set()
+
+
+def upload(clients, completions):
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    if completions:
+        completions.done.wait(60)
+        completions.done.clear()
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        client.stop()
+    return elapsed
+
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    stripes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    host = sys.argv[3] if len(sys.argv) > 3 else None
+    port = int(sys.argv[4]) if len(sys.argv) > 4 else 9000
+
+    server = None
+    completions = None
+    if host is None:
+        host = "127.0.0.1"
+        completions = Completions()
+        server = Server(host, port, recorder=completions, stripe_port=port + 1)
+        server.start()
+
+    payloads = PayloadPool(seed=0)
+    writes = [DEFAULT_MAX_SIZE] * (megabytes * MB // DEFAULT_MAX_SIZE)
+    plan = UploadPlan(host, writes, [0] * len(writes))
+    total = plan.total_bytes()
+
+    single = upload([Client(plan, port, payloads=payloads, settle=0)], completions)
+    striped = upload([
+        Client(stripe, port + 1, payloads=payloads, settle=0, stripe_header=header)
+        for stripe, header in split_plan(plan, stripes)
+    ], completions)
+
+    if server:
+        server.stop()
+
+    print("{:<16} {:8.3f} s {:10.1f} MB/s".format("single stream", single, total / single / MB))
+    print("{:<16} {:8.3f} s {:10.1f} MB/s".format("{} stripes".format(stripes), striped, total / striped / MB))
+    print("speedup          {:8.2f}x".format(single / striped))
+    print("(stripes share a path: the controller places host pairs, not connections)")
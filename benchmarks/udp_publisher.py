@@ -0,0 +1,112 @@
+"""
+Benchmark for UDPPublisher
+
+Sends datagrams to a local UDP socket, first queued and sent by a
+ConnectionPollerThread as the bot used to, then with a connected
+socket and send_now(). Reports datagrams per second and the latency
+from send()/send_now() until the datagram is received.
+
+Last, a connected publisher sends to a closed port on a selector-backed
+ConnectionPoller, as the upload engine's notifier does while the
+controller is down, and the polls per second are reported; anything
+near the wait rate means the refused errors don't keep it spinning.
+
+Usage: python3 benchmarks/udp_publisher.py [count] [poll-rate]
+"""
+
+import os
+import sys
+import time
+import socket
+import selectors
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sockets_lib.udp_connection import UDPPublisher
+from sockets_lib.connection import ConnectionPoller, ConnectionPollerThread
+from upload_bot.flow_metrics import percentile
+
+
+def receive(receiver, count, received):
+    for _ in range(count):
+        try:
+            receiver.recv(64)
+        except socket.timeout:
+            return
+        received.append(time.perf_counter())
+
+
+def run(name, count, poll_rate, fast):
+    receiver = socket.socket(type=socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.settimeout(2)
+    address, port = receiver.getsockname()
+
+    received = []
+    listener = threading.Thread(target=receive, args=(receiver, count, received))
+    listener.start()
+
+    publisher = UDPPublisher(address, port, connected=fast)
+    poll_thread = ConnectionPollerThread(publisher, poll_rate)
+    poll_thread.start()
+
+    message = b'{"src": "10.0.0.1", "dest": "10.0.0.2", "state": "open"}'
+    sent = []
+    start = time.perf_counter()
+    for _ in range(count):
+        sent.append(time.perf_counter())
+        if fast:
+            publisher.send_now(message)
+        else:
+            publisher.send(message)
+    listener.join()
+    elapsed = time.perf_counter() - start
+
+    poll_thread.stop()
+    poll_thread.join()
+    publisher.close()
+    receiver.close()
+
+    latencies = sorted((r - s) * 1000 for s, r in zip(sent, received))
+    print("{:<10} {:>7} received {:>12.0f} dgram/s   latency p50 {:8.3f} ms  p99 {:8.3f} ms".format(
+        name, len(received), len(received) / elapsed,
+        percentile(latencies, 50), percentile(latencies, 99)))
+
+
+def closed_port(duration=1.0, wait=0.1):
+    # Bind and close a socket to find a port nothing listens on
+    closed = socket.socket(type=socket.SOCK_DGRAM)
+    closed.bind(("127.0.0.1", 0))
+    address, port = closed.getsockname()
+    closed.close()
+
+    poller = ConnectionPoller(selectors.DefaultSelector())
+    publisher = UDPPublisher(address, port, connected=True)
+    poller.add_connection(publisher)
+
+    message = b'{"src": "10.0.0.1", "dest": "10.0.0.2", "state": "open"}'
+    polls = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        publisher.send_now(message)
+        poller.poll()
+        poller.wait(wait)
+        polls += 1
+
+    publisher.close()
+    poller.poll()
+    poller.close()
+
+    print("{:<10} {:>7} polls/s (waiting up to {} s per poll), {} sent".format(
+        "closed", int(polls / duration), wait, publisher.metrics().messages_out))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    poll_rate = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    run("queued", count, poll_rate, False)
+    run("send_now", count, poll_rate, True)
+    closed_port()
@@ -6,6 +6,30 @@ from mininet.util import dumpNodeConnections
 from mininet.log import setLogLevel
 from mininet.node import OVSSwitch, Controller, RemoteController
 
+# Shaping options, as given to the topology, and the TCLink
+# parameter each one sets
+LINK_PARAMETERS = {
+    'bw': 'bw',                     # Mbit/s
+    'delay': 'delay',               # e.g. '5ms'
+    'loss': 'loss',                 # percent
+    'queue': 'max_queue_size',      # packets
+}
+
+def link_options( shaping, prefix, fallback=True ):
+    """
+    TCLink parameters for one group of links, from options named
+    prefix_bw, prefix_delay and so on, or if fallback is set,
+    the unprefixed options shared by both arms
+    """
+    options = {}
+    for name, parameter in LINK_PARAMETERS.items():
+        value = shaping.get('%s_%s' % (prefix, name))
+        if value is None and fallback:
+            value = shaping.get(name)
+        if value is not None:
+            options[parameter] = value
+    return options
+
 class DiamondTopoEqualWeight(Topo):
     """
     Diamond topology connecting n nodes
@@ -27,26 +51,43 @@ class DiamondTopoEqualWeight(Topo):
                          |      |
                          |      | 
                          --------
-                       
+
+    The links can be shaped with bw, delay, loss and queue options (see
+    LINK_PARAMETERS), which apply to both arms, or top_ and bottom_
+    prefixed ones for the links through s2 and s3 separately; edge_
+    prefixed ones shape the host links. The network must be created
+    with link=TCLink for them to take effect, e.g.
+
+        mn --custom mininet_ext/diamond.py --link tc
+           --topo diamond-equal,2,top_bw=100,bottom_bw=10,delay=5ms
     """
-    def build(self, leaves):
+    def build(self, leaves, **shaping):
+        for option in shaping:
+            name = option.split('_', 1)[-1] if option.startswith(('top_', 'bottom_', 'edge_')) else option
+            if name not in LINK_PARAMETERS:
+                raise ValueError('Unknown link option %s' % option)
+
+        top = link_options(shaping, 'top')
+        bottom = link_options(shaping, 'bottom')
+        edge = link_options(shaping, 'edge', fallback=False)
+
         switch1 = self.addSwitch('s1')
         switch2 = self.addSwitch('s2')
         switch3 = self.addSwitch('s3')
         switch4 = self.addSwitch('s4')
 
-        self.addLink(switch1, switch2)
-        self.addLink(switch1, switch3)
+        self.addLink(switch1, switch2, **top)
+        self.addLink(switch1, switch3, **bottom)
 
-        self.addLink(switch4, switch3)
-        self.addLink(switch4, switch2)
+        self.addLink(switch4, switch3, **bottom)
+        self.addLink(switch4, switch2, **top)
 
         for h in range(leaves):
             host = self.addHost('h%s' % (h + 1))
-            self.addLink(host, switch1)
+            self.addLink(host, switch1, **edge)
 
         for h in range(leaves):
             host = self.addHost('h%s' % (h + leaves + 1))
-            self.addLink(host, switch4)
+            self.addLink(host, switch4, **edge)
 
 topos = {'diamond-equal' : DiamondTopoEqualWeight}
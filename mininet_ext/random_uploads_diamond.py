@@ -3,72 +3,373 @@
 """
 Create a network and random_uploads on each host
 to generate random TCP connections
+
+By default this drops into the Mininet CLI once the bots are running.
+Given --duration, it runs headless instead: for every combination of
+--hosts and --strategies it starts the controller (with --pox), brings
+up the network, lets the bots run for that many seconds, stops
+everything and collects the bots' flow logs and the controller's
+statistics into one results file
 """
 
 import sys
 import os, errno
+import argparse
+import glob
+import json
+import signal
+import subprocess
+import time
 
 
 from mininet.net import Mininet
 from mininet.cli import CLI
+from mininet.clean import cleanup
 from mininet.log import lg, info
 from mininet.node import Node, RemoteController, OVSSwitch
 from mininet.util import waitListening
-from mininet.link import Intf
+from mininet.link import Intf, TCLink
 
 from diamond import DiamondTopoEqualWeight
 
-def DiamondNet( edge_hosts, **kwargs ):
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT = os.path.join(REPO_ROOT, "random_uploader.py")
+
+sys.path.insert(0, REPO_ROOT)
+from upload_bot.flow_metrics import percentile
+
+def DiamondNet( edge_hosts, shaping=None, **kwargs ):
     "Convenience function for creating tree networks."
-    topo = DiamondTopoEqualWeight( edge_hosts )
+    topo = DiamondTopoEqualWeight( edge_hosts, **(shaping or {}) )
+    if shaping:
+        kwargs['link'] = TCLink
     return Mininet( topo, **kwargs )
 
-def random_uploads( network, address, port ): 
-    
+def make_net( edge_hosts, shaping=None ):
+    return DiamondNet(
+        edge_hosts = edge_hosts,
+        shaping = shaping,
+        controller=lambda name: RemoteController( name, ip='127.0.0.1', port=OPENFLOW_PORT ),
+        switch=OVSSwitch,
+        autoSetMacs=True)
+
+def parse_links( links ):
+    """
+    Parses link shaping options like 'top_bw=100,bottom_bw=10,delay=5ms'
+    into the options of DiamondTopoEqualWeight
+    """
+    shaping = {}
+    for option in links.split(',') if links else []:
+        name, value = option.split('=', 1)
+        try:
+            value = float(value) if '.' in value else int(value)
+        except ValueError:
+            pass
+        shaping[name.strip()] = value
+    return shaping
+
+# Seconds to wait for every bot to be listening and
+# registered with the controller before starting anyway
+READY_TIMEOUT = 60
+
+# POX's OpenFlow port; it only listens once every component has launched
+OPENFLOW_PORT = 6633
+
+# Seconds to wait for the controller to listen before starting anyway
+CONTROLLER_START_TIMEOUT = 30
+
+# Seconds the bots get to finish and flush their logs before being killed
+BOT_STOP_TIMEOUT = 10
+
+def bot_options( host, ip_end, profile, seed, record, replay, time_scale, log_dir ):
+    "Extra random_uploader.py options for one host"
+    options = " --profile {}".format(profile)
+
+    # Each host gets its own seed so they don't all make the same
+    # uploads, but the whole network is reproducible from one seed
+    if seed is not None:
+        options += " --seed {}".format(seed + int(ip_end))
+
+    if record:
+        options += " --record-trace {}/{}.trace".format(log_dir, host)
+
+    # The replay starts when the bots are released from the startup
+    # barrier, so the uploads line up across the network as they were recorded
+    if replay:
+        options += " --replay {} --time-scale {}".format(replay, time_scale)
+    return options
+
+def start_bots( network, address, port, args, log_dir, measure=False ):
+    """
+    Starts a bot on every host, all at once, then waits until each is
+    listening and registered with the controller before letting them
+    all start uploading together. Returns the seconds this took
+    """
+    start = time.time()
+    bots = network.hosts[:-1]
+    go_file = "{}/go".format(log_dir)
+    ready_files = {}
+    if os.path.exists(go_file):
+        os.remove(go_file)
+
+    for host in bots:
+        ip_end = host.IP()[host.IP().rfind('.')+1:]
+        ready_files[host] = "{}/{}.ready".format(log_dir, host)
+        if os.path.exists(ready_files[host]):
+            os.remove(ready_files[host])
+
+        options = bot_options(host, ip_end, args.profile, args.seed, args.record,
+                              args.replay, args.time_scale, log_dir)
+        options += " --ready-file {} --go-file {}".format(ready_files[host], go_file)
+        if measure:
+            options += " --flow-log {0}/{1}.flows --metrics-file {0}/{1}.metrics {2}".format(
+                log_dir, host, args.bot_args)
+        cmd = "python3 {} {} {} 10.0.0 {} 9000 {} > {}/{}-log 2>&1 &".format(
+            BOT, address, port, ip_end, len(network.hosts)-1, options, log_dir, str(host))
+        host.cmd(cmd)
+
+    waiting = set(bots)
+    while waiting and time.time() - start < READY_TIMEOUT:
+        waiting = set(host for host in waiting if not os.path.exists(ready_files[host]))
+        time.sleep(0.05)
+    if waiting:
+        info("*** Bots on {} not ready after {}s; starting anyway\n".format(
+            " ".join(sorted(str(host) for host in waiting)), READY_TIMEOUT))
+
+    open(go_file, "w").close()
+    startup = time.time() - start
+    info("*** {} bots started in {:.2f}s\n".format(len(bots) - len(waiting), startup))
+    return startup
+
+def stop_bots( network ):
+    """
+    Stops the bots, killing any which haven't exited BOT_STOP_TIMEOUT
+    seconds after being asked to. Returns the names of the hosts whose
+    bots had to be killed, since their logs may be incomplete
+    """
+    bots = network.hosts[:-1]
+
+    # SIGINT lets the bots finish and flush their logs
+    for host in bots:
+        host.cmd("kill -INT %python3")
+
+    running = list(bots)
+    deadline = time.time() + BOT_STOP_TIMEOUT
+    while running and time.time() < deadline:
+        running = [host for host in running if host.cmd("jobs -r %python3 2>/dev/null").strip()]
+        if running:
+            time.sleep(0.1)
+
+    for host in running:
+        info("*** Bot on {} still running after {}s; killing it\n".format(host, BOT_STOP_TIMEOUT))
+        host.cmd("kill -KILL %python3")
+    for host in bots:
+        host.cmd("wait")
+    return sorted(str(host) for host in running)
+
+def merge_traces( log_dir ):
+    traces = glob.glob("{}/h*.trace".format(log_dir))
+    os.system("cd {} && python3 -m upload_bot.trace merge {}/trace.jsonl {}".format(
+        REPO_ROOT, log_dir, " ".join(traces)))
+    info("Merged {} traces into {}/trace.jsonl\n".format(len(traces), log_dir))
+
+def random_uploads( network, address, port, args, log_dir ):
+
     # Adds a NAT adapter to switch 1
     # at ip address 10.0.0.2n+1
     network.addNAT().configDefault()
-       
+
     network.start()
-       
-    for host in network.hosts[:-1]:
-        ip_end = host.IP()[host.IP().rfind('.')+1:]
-        cmd = "python3 ~/network-optimizer/random_uploader.py {} {} 10.0.0 {} 9000 {} > ./logs/{}-log 2>&1 &".format(address, port, ip_end, len(network.hosts)-1, str(host))
-        host.cmd(cmd)
+    start_bots(network, address, port, args, log_dir)
 
     CLI( network )
-    
-    for host in network.hosts[:-1]:
-        host.cmd("kill % python3")
-    
+
+    stop_bots(network)
     network.stop()
 
-if __name__ == '__main__': 
-    if len(sys.argv) < 2:
-        print("Usage: {} ip-address [port] [n]".format(sys.argv[0]))
-        sys.exit(1)
-        
+    if args.record:
+        merge_traces(log_dir)
+
+def start_controller( pox, address, port, strategy, log_dir ):
+    "Starts POX with the diamond modules; returns the process"
+    command = [
+        sys.executable, os.path.expanduser(pox), "log.level", "--INFO",
+        "pox_ext.diamond.router", "pox_ext.diamond.arp_proxy",
+        "pox_ext.diamond.connection_listener", "--address={}".format(address), "--port={}".format(port),
+        "pox_ext.diamond.connection_manager", "--strategy={}".format(strategy),
+        "--stats_file={}/controller-stats.json".format(log_dir),
+    ]
+    with open("{}/controller-log".format(log_dir), "w") as out:
+        controller = subprocess.Popen(command, cwd=REPO_ROOT, stdout=out, stderr=subprocess.STDOUT)
+
+    start = time.time()
+    if waitListening(port=OPENFLOW_PORT, timeout=CONTROLLER_START_TIMEOUT):
+        info("*** Controller listening after {:.2f}s\n".format(time.time() - start))
+    elif controller.poll() is not None:
+        raise RuntimeError("Controller exited with {}; see {}/controller-log".format(
+            controller.returncode, log_dir))
+    else:
+        info("*** Controller not listening after {}s; starting anyway\n".format(CONTROLLER_START_TIMEOUT))
+    return controller
+
+def stop_controller( controller ):
+    controller.send_signal(signal.SIGINT)
+    controller.wait()
+
+def summarize_flows( log_dir, duration ):
+    "Totals of the uploads the bots recorded in their flow logs"
+    fcts = []
+    goodputs = []
+    total_bytes = 0
+    for path in glob.glob("{}/h*.flows".format(log_dir)):
+        with open(path) as flows:
+            for line in flows:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["type"] != "flow" or record["side"] != "client":
+                    continue
+                fcts.append(record["fct"])
+                goodputs.append(record["goodput"])
+                total_bytes += record["bytes"]
+
+    fcts.sort()
+    goodputs.sort()
+    return {
+        "flows": len(fcts),
+        "bytes": total_bytes,
+        "throughput": total_bytes / float(duration),
+        "fct_p50": percentile(fcts, 50),
+        "fct_p90": percentile(fcts, 90),
+        "fct_p99": percentile(fcts, 99),
+        "goodput_p50": percentile(goodputs, 50),
+    }
+
+def benchmark_run( edge_hosts, strategy, address, port, args, log_dir ):
+    "Runs the bots for args.duration seconds; returns the results"
+    controller = None
+    if args.pox:
+        controller = start_controller(args.pox, address, port, strategy, log_dir)
+
+    network = make_net(edge_hosts, args.shaping)
+    network.addNAT().configDefault()
+    network.start()
+
     try:
-        os.mkdir("logs")
+        startup = start_bots(network, address, port, args, log_dir, measure=True)
+        time.sleep(args.duration)
+        killed = stop_bots(network)
+    finally:
+        network.stop()
+        if controller:
+            stop_controller(controller)
+        cleanup()
+
+    if args.record:
+        merge_traces(log_dir)
+
+    result = {
+        "hosts": 2 * edge_hosts,
+        "edge_hosts": edge_hosts,
+        "strategy": strategy,
+        "duration": args.duration,
+        "profile": args.profile,
+        "seed": args.seed,
+        "replay": args.replay,
+        "bot_args": args.bot_args,
+        "links": args.shaping,
+        "startup": startup,
+        "killed_bots": killed,
+    }
+    result.update(summarize_flows(log_dir, args.duration))
+
+    stats_file = "{}/controller-stats.json".format(log_dir)
+    if os.path.exists(stats_file):
+        with open(stats_file) as stats:
+            result["controller"] = json.load(stats)
+    return result
+
+def clear_run( log_dir, keep=None ):
+    """
+    Removes what an earlier run left in log_dir, since the bots append
+    to their logs and the results are read back from them; keep is a
+    path not to remove, like a trace being replayed
+    """
+    patterns = ["h*.flows", "h*.trace", "h*.metrics", "trace.jsonl", "controller-stats.json"]
+    for pattern in patterns:
+        for path in glob.glob("{}/{}".format(log_dir, pattern)):
+            if keep is None or os.path.abspath(path) != os.path.abspath(keep):
+                os.remove(path)
+
+def benchmark( address, port, args ):
+    hosts = [int(n) for n in args.hosts.split(",")] if args.hosts else [args.n]
+    strategies = args.strategies.split(",") if args.pox else ["external"]
+
+    results = []
+    for edge_hosts in hosts:
+        for strategy in strategies:
+            log_dir = os.path.abspath("logs/h{}-{}".format(edge_hosts, strategy))
+            make_dir(log_dir)
+            clear_run(log_dir, args.replay)
+
+            info("*** Running {} hosts per side with strategy {} for {}s\n".format(
+                edge_hosts, strategy, args.duration))
+            result = benchmark_run(edge_hosts, strategy, address, port, args, log_dir)
+            info("*** {}\n".format(json.dumps(result)))
+            results.append(result)
+
+            # Written after every run so a failed matrix keeps what it has
+            with open(args.results, "w") as out:
+                json.dump(results, out, indent=2)
+
+    info("Wrote {} results to {}\n".format(len(results), args.results))
+
+def make_dir( path ):
+    try:
+        os.makedirs(path)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-           
-    hosts = 1  
-    address = sys.argv[1]
-    port = 6634
-        
-    if len(sys.argv) > 2:
-        hosts = int(sys.argv[2])
-    
-    if len(sys.argv) > 3:
-        port = int(sys.argv[3])
-        
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("address", help="IP address of the connection state listener")
+    parser.add_argument("n", type=int, nargs="?", default=1, help="Hosts on each side of the diamond")
+    parser.add_argument("port", type=int, nargs="?", default=6634, help="Port of the connection state listener")
+    parser.add_argument("--profile", default="legacy", help="Workload profile for the upload bots")
+    parser.add_argument("--seed", type=int, default=None, help="Seed to make the workload reproducible")
+    parser.add_argument("--record", action="store_true",
+                        help="Record every upload to trace.jsonl in the logs directory for replay")
+    parser.add_argument("--replay", default=None, help="Replay a recorded trace on all hosts")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Replay the trace this many times slower (0.5 is twice as fast)")
+    parser.add_argument("--links", default=None,
+                        help="Shape the links, e.g. 'top_bw=100,bottom_bw=10,delay=5ms,queue=100'; "
+                             "see mininet_ext/diamond.py")
+
+    benchmark_args = parser.add_argument_group("headless benchmark")
+    benchmark_args.add_argument("--duration", type=float, default=None,
+                                help="Run the bots for this many seconds without the CLI, and write results")
+    benchmark_args.add_argument("--hosts", default=None,
+                                help="Comma separated hosts per side to run in turn (default n)")
+    benchmark_args.add_argument("--strategies", default="count",
+                                help="Comma separated connection manager strategies to run in turn; "
+                                     "needs --pox (default count)")
+    benchmark_args.add_argument("--pox", default=None,
+                                help="Path to pox.py; the controller is started for each run. Without it, "
+                                     "an already running controller is used")
+    benchmark_args.add_argument("--bot-args", default="",
+                                help="Extra options for every bot, e.g. '--engine --afap'")
+    benchmark_args.add_argument("--results", default="logs/results.json",
+                                help="File to write the results to (default logs/results.json)")
+    args = parser.parse_args()
+    args.shaping = parse_links(args.links)
+
+    make_dir("logs")
+
     lg.setLogLevel( 'info')
-    net = DiamondNet( 
-        edge_hosts = hosts, 
-        controller=lambda name: RemoteController( name, ip='127.0.0.1' ),
-        switch=OVSSwitch,
-        autoSetMacs=True)
 
-    random_uploads(net, address, port)
+    if args.duration:
+        benchmark(args.address, args.port, args)
+    else:
+        random_uploads(make_net(args.n, args.shaping), args.address, args.port, args, os.path.abspath("logs"))
@@ -0,0 +1,52 @@
+"""
+Compact keys for the hosts and host pairs of the diamond.
+
+Host addresses are normalized once, when a notification or packet
+arrives, to 32-bit unsigned ints, and an unordered pair of hosts is
+packed into one 64-bit int, so the tables of the router and connection
+manager hold plain ints instead of strings, tuples or IPAddr objects.
+
+This module does not depend on POX
+"""
+
+import socket
+import struct
+import numbers
+
+_ipv4 = struct.Struct("!I")
+
+def ip_to_int(ip):
+    """
+    Returns the IPv4 address as an unsigned 32-bit int. ip can be an
+    int already, a dotted string, or anything with toUnsigned() (such
+    as a POX IPAddr). Raises ValueError if it is not an address
+    """
+    if isinstance(ip, numbers.Integral):
+        return ip
+    if hasattr(ip, "toUnsigned"):
+        return ip.toUnsigned()
+    try:
+        return _ipv4.unpack(socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        raise ValueError("Not an IPv4 address: {}".format(ip))
+
+def int_to_ip(value):
+    """
+    Returns the dotted string of an address from ip_to_int
+    """
+    return socket.inet_ntoa(_ipv4.pack(value))
+
+def pair_key(a, b):
+    """
+    Packs two addresses from ip_to_int into one int, which is
+    the same whichever order they are given in
+    """
+    if a > b:
+        a, b = b, a
+    return (a << 32) | b
+
+def pair_hosts(key):
+    """
+    Returns the two addresses of a pair_key, lowest first
+    """
+    return key >> 32, key & 0xFFFFFFFF
@@ -0,0 +1,111 @@
+"""
+This component answers ARP requests for the diamond network topology
+from the controller, so they are not flooded across both arms of the
+diamond; see router.py for the topology.
+
+Once the router has installed the default routes on switch 1 or 4,
+a rule is added there to send every ARP request to the controller
+instead of flooding it. Requests for an IP address the router has
+learned (from IP or ARP traffic of hosts connected directly to switch
+1 or 4) are answered with a packet out on the port they came in on.
+Anything else is flooded the same way the default routes would have,
+so hosts nobody has heard from yet can still answer for themselves.
+
+This component requires the component registered as 'diamond_router'
+"""
+
+from pox.core import core
+from pox.lib.packet.arp import arp
+from pox.lib.packet.ethernet import ethernet
+import pox.openflow.libopenflow_01 as of
+
+from .flow_table_priorities import *
+
+log = core.getLogger("diamond.arp_proxy")
+
+class ArpProxy (object):
+    """
+    Answers ARP requests from the hosts on switches 1 and 4 with
+    the macs learned by the router
+    """
+
+    def __init__(self):
+        self.__switches = set()
+        self.__answered = 0
+        self.__flooded = 0
+
+        core.diamond_router.addListenerByName("SwitchReady", self.__switch_ready)
+        core.openflow.addListenerByName("PacketIn", self.__packetIn)
+
+    def __arp_request_mod(self):
+        """
+        Creates a flow mod to send ARP requests
+        to the controller only
+        """
+        msg = of.ofp_flow_mod()
+        msg.priority = PRIORITY_ARP_REQUEST
+        msg.match.dl_type = ethernet.ARP_TYPE
+        msg.match.nw_proto = arp.REQUEST
+        msg.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER))
+
+        return msg
+
+    def __reply(self, request, mac):
+        """
+        Creates an ethernet frame answering an ARP request
+        on behalf of the host with the given mac
+        """
+        reply = arp()
+        reply.opcode = arp.REPLY
+        reply.hwsrc = mac
+        reply.hwdst = request.hwsrc
+        reply.protosrc = request.protodst
+        reply.protodst = request.protosrc
+
+        frame = ethernet(type = ethernet.ARP_TYPE, src = mac, dst = request.hwsrc)
+        frame.payload = reply
+        return frame
+
+    def __switch_ready(self, event):
+        log.info("Sending ARP requests from switch {} to the controller".format(event.dpid))
+        self.__switches.add(event.dpid)
+        event.connection.send(self.__arp_request_mod())
+
+    def __packetIn(self, event):
+        if event.dpid not in self.__switches:
+            return
+
+        packet_type = event.parsed
+        request = packet_type.find("arp") if packet_type.parsed else None
+        if not request or request.opcode != arp.REQUEST:
+            return
+
+        msg = of.ofp_packet_out()
+        msg.in_port = event.port
+
+        mac = core.diamond_router.mac_for(request.protodst)
+        if mac is not None and mac != request.hwsrc:
+            log.debug("Answering who-has {} from {} with {}".format(request.protodst, request.protosrc, mac))
+            msg.data = self.__reply(request, mac).pack()
+            msg.actions.append(of.ofp_action_output(port = of.OFPP_IN_PORT))
+            self.__answered += 1
+        else:
+            # Flood it like the default routes would have; ports 1 and 2
+            # are no-flood, so requests from local hosts also go out port 1
+            log.debug("Flooding who-has {} from {}".format(request.protodst, request.protosrc))
+            msg.data = event.ofp
+            msg.actions.append(of.ofp_action_output(port = of.OFPP_FLOOD))
+            if event.port > 2:
+                msg.actions.append(of.ofp_action_output(port = 1))
+            self.__flooded += 1
+
+        event.connection.send(msg)
+
+    def stats(self):
+        return {
+            "answered": self.__answered,
+            "flooded": self.__flooded,
+        }
+
+def launch ():
+    core.call_when_ready(lambda: core.register("diamond_arp_proxy", ArpProxy()), ["diamond_router"])
@@ -0,0 +1,183 @@
+"""
+Checkpoints of the controller's state, so it can restart warm.
+
+Without them, a restarted controller clears the flow tables of the edge
+switches, the hosts have to be learned again, and every upload that was
+running stays where the default routes put it. With this component
+launched, e.g.
+
+    pox_ext.diamond.checkpoint --path=controller.checkpoint --interval=5
+
+the router records the macs and hosts its edge switches learn, and the
+connection manager the host pairs it routes, as they change. The records
+are appended to path every interval seconds, and the file is rewritten
+with just the current state once it has grown well past it.
+
+On startup the file is read back. The router then reconciles each edge
+switch against the rules actually on it instead of clearing it, and
+the manager picks up the pairs it had routed; see router.py and
+connection_manager.py. Uploads which ended while the controller was
+down can't be known, so their pairs stay routed until another upload
+between the same hosts ends.
+
+The records are fixed size: a type, a dpid or arm, two addresses (from
+ip_to_int), a mac and a port or number of uploads. Checkpoint itself
+doesn't use POX
+"""
+
+import os
+import struct
+
+HOST = 1        # dpid, ip, mac: a host connected directly to an edge switch
+MAC = 2         # dpid, mac, port: where an edge switch sends a mac
+PLACE = 3       # arm, the pair's two ips, and its uploads
+REMOVE = 4      # the pair's two ips
+
+RECORD = struct.Struct("!BBII6sH")
+
+NO_MAC = b"\0" * 6
+
+# The file is compacted once it holds this many times more
+# records than the state needs, and at least MIN_COMPACT
+COMPACT_RATIO = 4
+MIN_COMPACT = 1024
+
+class Checkpoint(object):
+    """
+    The state of the last checkpoint, kept up to date as records are
+    added. Macs are 6 byte strings; addresses and pair keys as in
+    addresses.py
+    """
+    def __init__(self, path):
+        self.__path = path
+        self.__pending = bytearray()
+
+        # (dpid, ip) -> mac
+        self.__hosts = {}
+        # (dpid, mac) -> port
+        self.__macs = {}
+        # (ip, ip) lowest first -> (arm, uploads)
+        self.__placements = {}
+
+        self.__records = self.__load()
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return 0
+
+        with open(self.__path, "rb") as checkpoint:
+            data = checkpoint.read()
+
+        # A record cut short by a crash is ignored
+        count = len(data) // RECORD.size
+        for offset in range(0, count * RECORD.size, RECORD.size):
+            self.__apply(*RECORD.unpack_from(data, offset))
+        return count
+
+    def __apply(self, kind, small, a, b, mac, number):
+        if kind == HOST:
+            self.__hosts[(small, a)] = mac
+        elif kind == MAC:
+            self.__macs[(small, mac)] = number
+        elif kind == PLACE:
+            self.__placements[(a, b)] = (small, number)
+        elif kind == REMOVE:
+            self.__placements.pop((a, b), None)
+
+    def __add(self, kind, small=0, a=0, b=0, mac=NO_MAC, number=0):
+        self.__apply(kind, small, a, b, mac, number)
+        self.__pending += RECORD.pack(kind, small, a, b, mac, number)
+
+    def hosts(self, dpid=None):
+        """
+        Returns {ip: mac} of the hosts of an edge switch, or
+        {(dpid, ip): mac} of all of them
+        """
+        if dpid is None:
+            return dict(self.__hosts)
+        return dict((ip, mac) for (switch, ip), mac in self.__hosts.items() if switch == dpid)
+
+    def macs(self, dpid):
+        """
+        Returns {mac: port} of an edge switch
+        """
+        return dict((mac, port) for (switch, mac), port in self.__macs.items() if switch == dpid)
+
+    def placements(self):
+        """
+        Returns {(ip, ip): (arm, uploads)} of the routed pairs
+        """
+        return dict(self.__placements)
+
+    def learned_host(self, dpid, ip, mac):
+        if self.__hosts.get((dpid, ip)) != mac:
+            self.__add(HOST, dpid, ip, mac=mac)
+
+    def learned_mac(self, dpid, mac, port):
+        if self.__macs.get((dpid, mac)) != port:
+            self.__add(MAC, dpid, mac=mac, number=port)
+
+    def placed(self, a, b, arm, uploads):
+        if a > b:
+            a, b = b, a
+        # Records only hold 16 bits of uploads
+        uploads = min(uploads, 0xFFFF)
+        if self.__placements.get((a, b)) != (arm, uploads):
+            self.__add(PLACE, arm, a, b, number=uploads)
+
+    def removed(self, a, b):
+        if a > b:
+            a, b = b, a
+        if (a, b) in self.__placements:
+            self.__add(REMOVE, 0, a, b)
+
+    def flush(self):
+        """
+        Appends the records added since the last flush, or rewrites
+        the file if it has grown too far past the state it holds
+        """
+        live = len(self.__hosts) + len(self.__macs) + len(self.__placements)
+        written = self.__records + len(self.__pending) // RECORD.size
+        if written > max(MIN_COMPACT, COMPACT_RATIO * live):
+            self.compact()
+            return
+
+        if not self.__pending:
+            return
+        with open(self.__path, "ab") as checkpoint:
+            checkpoint.write(self.__pending)
+        self.__records = written
+        self.__pending = bytearray()
+
+    def compact(self):
+        """
+        Rewrites the file with only the current state
+        """
+        data = bytearray()
+        for (dpid, ip), mac in self.__hosts.items():
+            data += RECORD.pack(HOST, dpid, ip, 0, mac, 0)
+        for (dpid, mac), port in self.__macs.items():
+            data += RECORD.pack(MAC, dpid, 0, 0, mac, port)
+        for (a, b), (arm, uploads) in self.__placements.items():
+            data += RECORD.pack(PLACE, arm, a, b, NO_MAC, uploads)
+
+        temporary = self.__path + ".tmp"
+        with open(temporary, "wb") as checkpoint:
+            checkpoint.write(data)
+        os.rename(temporary, self.__path)
+        self.__records = len(data) // RECORD.size
+        self.__pending = bytearray()
+
+def launch (path="controller.checkpoint", interval=5):
+    from pox.core import core
+    from pox.lib.recoco import Timer
+
+    log = core.getLogger("diamond.checkpoint")
+    checkpoint = Checkpoint(path)
+    log.info("Loaded {} hosts and {} routed pairs from {}".format(
+        len(checkpoint.hosts()), len(checkpoint.placements()), path))
+
+    core.register("diamond_checkpoint", checkpoint)
+    core.addListenerByName("GoingDownEvent", lambda event: checkpoint.flush())
+    Timer(timeToWake=float(interval), callback=checkpoint.flush,
+          recurring=True, started=True, selfStoppable=False)
@@ -3,15 +3,38 @@ from pox.lib.recoco import Timer
 from pox.lib.revent import Event, EventMixin
 
 import json
+import time
 
+from .addresses import ip_to_int, pair_key
+from .metrics import REGISTRY
+
+from select import select
 from SocketServer import UDPServer, BaseRequestHandler
 
 log = core.getLogger("diamond.listener")
 
 class TCPConnectionEvent(Event):
-    def __init__(self, source, dest):
+    """
+    An upload between two hosts. Striped uploads also give the
+    source and destination ports of each of their connections;
+    otherwise those are None. size is the number of bytes the upload
+    expects to send when it starts, and did send when it ends, if
+    the bot said so
+
+    src_ip and dest_ip are the addresses as ints, and key the
+    pair_key of the two; see addresses.py. received is when the
+    notification was handled
+    """
+    def __init__(self, source, dest, sport=None, dport=None, size=None):
         self.__source = source
         self.__dest = dest
+        self.__source_ip = ip_to_int(source)
+        self.__dest_ip = ip_to_int(dest)
+        self.__key = pair_key(self.__source_ip, self.__dest_ip)
+        self.__received = time.time()
+        self.__sport = sport
+        self.__dport = dport
+        self.__size = size
         
     @property
     def src(self):
@@ -20,6 +43,34 @@ class TCPConnectionEvent(Event):
     @property
     def dest(self):
         return self.__dest
+
+    @property
+    def src_ip(self):
+        return self.__source_ip
+
+    @property
+    def dest_ip(self):
+        return self.__dest_ip
+
+    @property
+    def key(self):
+        return self.__key
+
+    @property
+    def received(self):
+        return self.__received
+
+    @property
+    def sport(self):
+        return self.__sport
+
+    @property
+    def dport(self):
+        return self.__dport
+
+    @property
+    def size(self):
+        return self.__size
         
 class UploadStarted(TCPConnectionEvent):
     pass
@@ -29,9 +80,10 @@ class UploadEnded(TCPConnectionEvent):
 
 class ConnectionHandler(BaseRequestHandler, object):
     def handle(self):
-        data = self.request[0]
+        data, sock = self.request
         
-        self.server.handle_message(json.loads(data))
+        reply = lambda msg: sock.sendto(json.dumps(msg), self.client_address)
+        self.server.handle_message(json.loads(data), reply)
         
 class ConnectionListener(UDPServer, EventMixin, object):
     _eventMixin_events = set([
@@ -39,6 +91,10 @@ class ConnectionListener(UDPServer, EventMixin, object):
         UploadEnded
       ])
       
+    # Most datagrams handled per poll, so a flood
+    # of notifications can't stall the controller
+    MAX_MESSAGES_PER_POLL = 1000
+
     def __init__(self, address, port):
         UDPServer.__init__(self, (address, port), ConnectionHandler, bind_and_activate=False)
         self.allow_reuse_address = True
@@ -47,13 +103,29 @@ class ConnectionListener(UDPServer, EventMixin, object):
         self.server_activate()
         
         self.__connections = []
+        self.__hosts = set()
+
+        self.__notifications = dict(
+            (state, REGISTRY.counter("diamond_notifications_total", "Notifications from the bots", {"state": state}))
+            for state in ("hello", "open", "close", "invalid"))
+        REGISTRY.gauge("diamond_bots", "Bots which have said hello", function=lambda: len(self.__hosts))
         self.__poll_timer = Timer(timeToWake=0.5, callback=self.__poll, 
                                   recurring=True, started=True, selfStoppable=False)
 
     def __poll(self):
-        self.handle_request()
+        # Handle everything that has arrived, not just one datagram
+        for _ in range(self.MAX_MESSAGES_PER_POLL):
+            if not select([self], [], [], 0)[0]:
+                break
+            self._handle_request_noblock()
+
+    def hosts(self):
+        """
+        Addresses of the bots which have said hello
+        """
+        return set(self.__hosts)
         
-    def handle_message(self, msg):
+    def handle_message(self, msg, reply=None):
         # Future Improvement: Add a timeout for these
         # messages so that if a host goes down, it will
         # eventually be considered as a closed connection
@@ -65,11 +137,29 @@ class ConnectionListener(UDPServer, EventMixin, object):
         log.debug("Got new message: {}".format(msg))
         
         try:
-            if msg["state"] == "open":
-                self.raiseEvent(UploadStarted, msg["src"], msg["dest"])
-            elif msg["state"] == "close":
-                self.raiseEvent(UploadEnded, msg["src"], msg["dest"])
-        except KeyError:
+            details = msg.get("sport"), msg.get("dport"), msg.get("bytes")
+            state = msg["state"]
+            if state == "hello":
+                # A bot starting up; acknowledge so it
+                # knows its notifications will be heard
+                self.__hosts.add(msg["src"])
+                log.info("Bot {} registered; {} bots".format(msg["src"], len(self.__hosts)))
+                if reply:
+                    reply({"state": "ack"})
+            elif state == "open":
+                self.raiseEvent(UploadStarted, msg["src"], msg["dest"], *details)
+            elif state == "close":
+                self.raiseEvent(UploadEnded, msg["src"], msg["dest"], *details)
+            else:
+                self.__notifications["invalid"].inc()
+                log.warning("Unknown state in message: {}".format(msg))
+                return
+
+            # Only counted once handled, so a bad message is
+            # counted as invalid and nothing else
+            self.__notifications[state].inc()
+        except (KeyError, ValueError):
+            self.__notifications["invalid"].inc()
             log.warning("Unexpected message: {}".format(msg))
                 
 def launch (address, port=6634):
@@ -36,102 +36,538 @@ system
 from pox.core import core
 from pox.lib.recoco import Timer
 
+from collections import deque
+from bisect import bisect_left, insort
+
+import json
 import time
+import logging
+
+from .addresses import int_to_ip, pair_key, pair_hosts
+from .metrics import REGISTRY
+from .decision_trace import TRACE, OPEN, CLOSE, PLACE, DEFER, CANCEL, MOVE, ARM_UP, ARM_DOWN
 
 log = core.getLogger("diamond.connection-manager")
 
+# Most pairs moved to even out the arms after one upload ends; each
+# move costs four flow mods, and whatever imbalance is left is picked
+# up again when the next upload ends
+MAX_REBALANCE_MOVES = 4
+
+class _Pair(object):
+    """
+    A host pair routed over one of the arms: the uploads between
+    the two which are running, and the bytes they expect to send
+    """
+    __slots__ = ("uses", "bytes")
+
+    def __init__(self, uses=0, bytes=0):
+        self.uses = uses
+        self.bytes = bytes
+
+class _Admission(object):
+    """
+    A host pair waiting out the admission delay before being routed
+    """
+    __slots__ = ("src_ip", "dest_ip", "deadline", "uses", "bytes")
+
+    def __init__(self, src_ip, dest_ip, deadline):
+        self.src_ip = src_ip
+        self.dest_ip = dest_ip
+        self.deadline = deadline
+        self.uses = 0
+        self.bytes = 0
+
 class ConnectionManager(object):
-    def __init__(self):
-        # Mapping from source to destination
+    """
+    Places each host pair on the up or down arm of the diamond when
+    its first upload starts, and moves pairs when the arms get out
+    of balance. The strategy decides what is balanced:
+
+    count - the number of pairs on each arm
+    size  - the bytes the uploads on each arm are expected to send. A
+            new pair goes on the arm with less outstanding bytes, and
+            when uploads end, the pair which best evens out the arms is
+            moved, like longest-processing-time scheduling on two
+            machines. The expected size of an upload is the size it
+            announces, or else an EWMA (weighted by alpha) of the sizes
+            of the past uploads from the same host
+
+    If admission_delay is more than 0, a pair isn't routed until it has
+    had uploads running for that many seconds. Pairs whose uploads all
+    end before then take the default routes and never cost any flow
+    mods; the two installs and two removes each of them would have
+    taken are counted as avoided
+
+    Pairs and hosts are keyed by the ints from addresses.py, and the
+    bytes on each arm are kept as running totals, so the work per
+    event doesn't grow with the number of pairs being routed. With the
+    size strategy the pairs on each arm are also kept sorted by bytes,
+    so the pair to move is found by bisection instead of a scan
+
+    If stats_file is given, the counters from stats() are written
+    to it as JSON when POX shuts down
+
+    If latency_threshold is more than 0 and the latency probes are
+    running (see latency_probe.py), new pairs whose upload is expected
+    to send fewer bytes than that go on the arm the probes say is faster,
+    if it is faster by at least latency_margin seconds, whatever the
+    strategy would do; bigger uploads still keep the arms balanced
+
+    If the checkpoint component is running (see checkpoint.py), the
+    routed pairs are saved to it as they change, and those it had are
+    picked up again when POX starts
+    """
+    def __init__(self, strategy="count", alpha=0.2, default_size=1000000, stats_file=None,
+                 admission_delay=0, latency_threshold=0, latency_margin=0.0005):
+        if strategy not in ("count", "size"):
+            raise ValueError("Unknown strategy {}".format(strategy))
+
+        # Pair key -> _Pair on each arm
         self.__up_connections = {}
         self.__down_connections = {}
+
+        # Bytes the pairs on each arm are expected to send
+        self.__up_bytes = 0
+        self.__down_bytes = 0
+
+        # (bytes, pair key) of the pairs on each arm, sorted; only
+        # kept with the size strategy
+        self.__up_sizes = []
+        self.__down_sizes = []
+
+        self.__strategy = strategy
+        self.__alpha = alpha
+        self.__default_size = default_size
+        self.__latency_threshold = latency_threshold
+        self.__latency_margin = latency_margin
+
+        # Host -> EWMA of the sizes of its uploads
+        self.__host_sizes = {}
+
+        # Pair key -> _Admission of pairs not routed yet, and
+        # (deadline, key) of each in the order they started
+        self.__admission_delay = admission_delay
+        self.__admitting = {}
+        self.__admission_queue = deque()
+        if admission_delay > 0:
+            self.__admission_timer = Timer(timeToWake=max(0.01, admission_delay / 4.0), callback=self.__admit,
+                                           recurring=True, started=True, selfStoppable=False)
+
+        self.__started = time.time()
+        self.__uploads = 0
+        self.__placements = 0
+        self.__moves = 0
+        self.__peak_pairs = 0
+        self.__peak_imbalance = 0
+        self.__admitted = 0
+        self.__cancelled = 0
+        self.__flow_mods_avoided = 0
+        self.__latency_placements = 0
+        self.__register_metrics()
+
+        self.__checkpoint = None
+        if core.starting_up:
+            core.addListenerByName("UpEvent", self.__restore)
+        else:
+            # Launched once its dependencies were ready, after POX
+            # (and possibly the switches) had already come up
+            self.__restore()
+
+        self.__stats_file = stats_file
+        if stats_file:
+            core.addListenerByName("GoingDownEvent", self.__write_stats)
         
-        log.info("Starting unweighted diamond connection manager")
+        log.info("Starting unweighted diamond connection manager balancing by {}".format(strategy))
 
         core.diamond_listener.addListenerByName("UploadStarted", self.__connectionStarted)
         core.diamond_listener.addListenerByName("UploadEnded", self.__connectionEnded)
 
+    def __register_metrics(self):
+        for arm, connections in (("up", self.__up_connections), ("down", self.__down_connections)):
+            REGISTRY.gauge("diamond_arm_pairs", "Host pairs routed over each arm", {"arm": arm},
+                           function=lambda connections=connections: len(connections))
+            REGISTRY.gauge("diamond_arm_bytes", "Bytes the pairs on each arm are expected to send", {"arm": arm},
+                           function=lambda connections=connections: self.__load(connections))
+
+        REGISTRY.counter("diamond_uploads_total", "Uploads started", function=lambda: self.__uploads)
+        REGISTRY.counter("diamond_placements_total", "Host pairs routed", function=lambda: self.__placements)
+        REGISTRY.counter("diamond_rebalances_total", "Host pairs moved to the other arm", function=lambda: self.__moves)
+        REGISTRY.counter("diamond_flow_mods_avoided_total", "Flow mods avoided by the admission delay",
+                         function=lambda: self.__flow_mods_avoided)
+        REGISTRY.gauge("diamond_pairs_admitting", "Host pairs waiting out the admission delay",
+                       function=lambda: len(self.__admitting))
+        self.__routing_time = REGISTRY.histogram(
+            "diamond_notification_to_flow_mod_seconds",
+            "Time from a notification arriving to the routes for it being sent")
+
+    def __restore(self, event=None):
+        if not core.hasComponent("diamond_checkpoint"):
+            return
+        self.__checkpoint = core.diamond_checkpoint
+
+        placements = self.__checkpoint.placements()
+        for (a, b), (arm, uploads) in placements.items():
+            connections = self.__up_connections if arm == ARM_UP else self.__down_connections
+            # Their sizes weren't saved, so assume the usual
+            self.__insert(connections, pair_key(a, b), _Pair(uploads, uploads * self.__default_size))
+        log.info("Restored {} routed pairs from the checkpoint".format(len(placements)))
+        self.__update_peaks()
+
+    def __save(self, key):
+        """
+        Records where a pair is routed, if at all, in the checkpoint
+        """
+        if self.__checkpoint is None:
+            return
+        a, b = pair_hosts(key)
+        if key in self.__up_connections:
+            self.__checkpoint.placed(a, b, ARM_UP, self.__up_connections[key].uses)
+        elif key in self.__down_connections:
+            self.__checkpoint.placed(a, b, ARM_DOWN, self.__down_connections[key].uses)
+        else:
+            self.__checkpoint.removed(a, b)
+
+    def __expected_size(self, event):
+        if event.size is not None:
+            return event.size
+        return self.__host_sizes.get(event.src_ip, self.__default_size)
+
+    def __load(self, connections):
+        if connections is self.__up_connections:
+            return self.__up_bytes
+        return self.__down_bytes
+
+    def __add_load(self, connections, amount):
+        if connections is self.__up_connections:
+            self.__up_bytes += amount
+        else:
+            self.__down_bytes += amount
+
+    def __sizes(self, connections):
+        if connections is self.__up_connections:
+            return self.__up_sizes
+        return self.__down_sizes
+
+    def __insert(self, connections, key, pair):
+        """
+        Adds a pair to an arm, along with the bytes it expects to send
+        """
+        connections[key] = pair
+        self.__add_load(connections, pair.bytes)
+        if self.__strategy == "size":
+            insort(self.__sizes(connections), (pair.bytes, key))
+
+    def __remove(self, connections, key):
+        """
+        Takes a pair off an arm, along with the bytes it expects to
+        send, and returns it
+        """
+        pair = connections.pop(key)
+        self.__add_load(connections, -pair.bytes)
+        if self.__strategy == "size":
+            sizes = self.__sizes(connections)
+            del sizes[bisect_left(sizes, (pair.bytes, key))]
+        return pair
+
+    def __resize(self, connections, key, amount):
+        """
+        Changes the bytes a pair on an arm expects to send
+        """
+        pair = self.__remove(connections, key)
+        pair.bytes = amount
+        self.__insert(connections, key, pair)
+
+    def stats(self):
+        return {
+            "strategy": self.__strategy,
+            "uptime": time.time() - self.__started,
+            "uploads": self.__uploads,
+            "placements": self.__placements,
+            "moves": self.__moves,
+            "peak_pairs": self.__peak_pairs,
+            "peak_imbalance": self.__peak_imbalance,
+            "pairs_up": len(self.__up_connections),
+            "pairs_down": len(self.__down_connections),
+            "admission_delay": self.__admission_delay,
+            "pairs_admitting": len(self.__admitting),
+            "admitted": self.__admitted,
+            "cancelled": self.__cancelled,
+            "flow_mods_avoided": self.__flow_mods_avoided,
+            "latency_placements": self.__latency_placements,
+            "latency": core.diamond_latency.stats() if core.hasComponent("diamond_latency") else None,
+            "flow_mods": core.diamond_router.flow_mod_stats(),
+        }
+
+    def __write_stats(self, event):
+        with open(self.__stats_file, "w") as out:
+            json.dump(self.stats(), out)
+
+    def __update_peaks(self):
+        pairs = len(self.__up_connections) + len(self.__down_connections)
+        imbalance = abs(len(self.__up_connections) - len(self.__down_connections))
+        self.__peak_pairs = max(self.__peak_pairs, pairs)
+        self.__peak_imbalance = max(self.__peak_imbalance, imbalance)
+
+    def __log_balance(self):
+        if not log.isEnabledFor(logging.INFO):
+            return
+        if self.__strategy == "size":
+            log.info("{} connections routed down ({} bytes), {} routed up ({} bytes)".format(
+                len(self.__down_connections), self.__down_bytes,
+                len(self.__up_connections), self.__up_bytes))
+        else:
+            log.info("{} connections routed down, {} routed up".format(len(self.__down_connections), len(self.__up_connections)))
+
     def __connectionStarted(self, event):
         log.debug("Connection {} -> {} started".format(event.src, event.dest))
         
-        # Key for dict lookup
-        key = tuple(sorted([event.dest, event.src]))
+        key = event.key
+        expected = self.__expected_size(event)
+        self.__uploads += 1
+        TRACE.record(OPEN, event.src_ip, event.dest_ip, -1 if event.size is None else int(event.size))
         
         # Check if the connection already exists
         # on one of the routes. If so, just mark it
         # as being used another time        
         if key in self.__up_connections:
             log.info("Connection {} <-> {} already being routed up".format(event.dest, event.src))
-            self.__up_connections[key] += 1
-
+            connections = self.__up_connections
             
         elif key in self.__down_connections:
             log.info("Connection {} <-> {} already being routed down".format(event.dest, event.src))
-            self.__down_connections[key] += 1
+            connections = self.__down_connections
 
+        # Not routed yet, and it has to wait to be
+        elif self.__admission_delay > 0:
+            admission = self.__admitting.get(key)
+            if admission is None:
+                admission = _Admission(event.src_ip, event.dest_ip, time.time() + self.__admission_delay)
+                self.__admitting[key] = admission
+                self.__admission_queue.append((admission.deadline, key))
+                TRACE.record(DEFER, event.src_ip, event.dest_ip)
+            admission.uses += 1
+            admission.bytes += expected
+            return
              
-        # Doesn't exist? If there's more connections on one side than the other
-        # add it to the one side, otherwise add it up
+        # Doesn't exist? Add it to the side with fewer connections
+        # (or bytes to send), otherwise add it up
         else:
-            if len(self.__down_connections) < len(self.__up_connections):
-                if core.diamond_router.add_route_down(event.src, event.dest):
-                    log.info("Connection {} <-> {} routed down".format(event.src, event.dest))
-                    self.__down_connections[key] = 1
-            else:
-                if core.diamond_router.add_route_up(event.src, event.dest):
-                    log.info("Connection {} <-> {} routed up".format(event.src, event.dest))
-                    self.__up_connections[key] = 1
+            connections = self.__place(key, event.src_ip, event.dest_ip, expected)
+            if connections is not None:
+                self.__routing_time.observe(time.time() - event.received)
+
+        if connections is not None:
+            connections[key].uses += 1
+            self.__resize(connections, key, connections[key].bytes + expected)
+            self.__save(key)
         
-        log.info("{} connections routed down, {} routed up".format(len(self.__down_connections), len(self.__up_connections)))
+        self.__update_peaks()
+        self.__log_balance()
         
+    def __faster_arm(self, size):
+        """
+        Returns the arm the latency probes say is faster if an upload
+        of the given size should go on it, otherwise None
+        """
+        if size >= self.__latency_threshold or not core.hasComponent("diamond_latency"):
+            return None
+
+        up = core.diamond_latency.latency(ARM_UP)
+        down = core.diamond_latency.latency(ARM_DOWN)
+        if up is None or down is None or abs(up - down) < self.__latency_margin:
+            return None
+        return ARM_UP if up < down else ARM_DOWN
+
+    def __place(self, key, src_ip, dest_ip, size):
+        """
+        Routes a new pair over the faster arm if its uploads are small,
+        otherwise the arm with fewer connections (or bytes to send), or
+        else up. Returns the connections of that arm, or None if the
+        router couldn't route it
+        """
+        faster = self.__faster_arm(size)
+        if faster is not None:
+            go_down = faster == ARM_DOWN
+        elif self.__strategy == "size":
+            go_down = self.__down_bytes < self.__up_bytes
+        else:
+            go_down = len(self.__down_connections) < len(self.__up_connections)
+
+        connections = None
+        if go_down:
+            if core.diamond_router.add_route_down(src_ip, dest_ip):
+                log.info("Connection {} <-> {} routed down".format(int_to_ip(src_ip), int_to_ip(dest_ip)))
+                TRACE.record(PLACE, src_ip, dest_ip, ARM_DOWN)
+                connections = self.__down_connections
+        else:
+            if core.diamond_router.add_route_up(src_ip, dest_ip):
+                log.info("Connection {} <-> {} routed up".format(int_to_ip(src_ip), int_to_ip(dest_ip)))
+                TRACE.record(PLACE, src_ip, dest_ip, ARM_UP)
+                connections = self.__up_connections
+
+        if connections is not None:
+            self.__insert(connections, key, _Pair())
+            self.__placements += 1
+            if faster is not None:
+                self.__latency_placements += 1
+        return connections
+
+    def __admit(self):
+        """
+        Routes the pairs which have waited out the admission delay
+        """
+        now = time.time()
+        admitted = False
+        while self.__admission_queue:
+            deadline, key = self.__admission_queue[0]
+            admission = self.__admitting.get(key)
+            if admission is not None and admission.deadline == deadline:
+                if deadline > now:
+                    break
+                del self.__admitting[key]
+                connections = self.__place(key, admission.src_ip, admission.dest_ip,
+                                           admission.bytes / float(admission.uses))
+                if connections is not None:
+                    connections[key].uses = admission.uses
+                    self.__resize(connections, key, admission.bytes)
+                    self.__save(key)
+                    self.__admitted += 1
+                    admitted = True
+            self.__admission_queue.popleft()
+
+        if admitted:
+            self.__update_peaks()
+            self.__log_balance()
+
     def __connectionEnded(self, event):
         log.debug("Connection {} -> {} ended".format(event.src, event.dest))
+        TRACE.record(CLOSE, event.src_ip, event.dest_ip, -1 if event.size is None else int(event.size))
+
+        if event.size is not None:
+            previous = self.__host_sizes.get(event.src_ip, event.size)
+            self.__host_sizes[event.src_ip] = self.__alpha * event.size + (1 - self.__alpha) * previous
         
-        # Key for dict lookup
-        key = tuple(sorted([event.dest, event.src]))
+        key = event.key
         
         # Check which way the connection went
         # and mark it one less; if it's at 0 now,
         # undo the routing     
         if key in self.__up_connections:
-            self.__up_connections[key] -= 1
-            if self.__up_connections[key] == 0:
-                log.info("Connection {} <-> {} is unused, removing up route".format(event.dest, event.src))
-                del self.__up_connections[key]
-                core.diamond_router.remove_route_up(event.src, event.dest)
-            else:
-                log.info("Connection {} <-> {} is used {} times; staying routed up".format(event.dest, event.src, self.__up_connections[key]))   
-            
+            connections, direction = self.__up_connections, "up"
         elif key in self.__down_connections:
-            self.__down_connections[key] -= 1
-            if self.__down_connections[key] == 0:
-                log.info("Connection {} <-> {} is unused, removing down route".format(event.dest, event.src))
-                del self.__down_connections[key]
-                core.diamond_router.remove_route_down(event.src, event.dest)
+            connections, direction = self.__down_connections, "down"
+        else:
+            connections = None
+
+        admission = self.__admitting.get(key)
+        if admission is not None:
+            admission.bytes -= admission.bytes / float(admission.uses)
+            admission.uses -= 1
+            if admission.uses == 0:
+                log.debug("Connection {} <-> {} ended before being routed".format(event.dest, event.src))
+                del self.__admitting[key]
+                TRACE.record(CANCEL, event.src_ip, event.dest_ip)
+                self.__cancelled += 1
+                self.__flow_mods_avoided += 4
+            return
+
+        if connections is not None:
+            pair = connections[key]
+            self.__resize(connections, key, pair.bytes - pair.bytes / float(pair.uses))
+            pair.uses -= 1
+            if pair.uses == 0:
+                log.info("Connection {} <-> {} is unused, removing {} route".format(event.dest, event.src, direction))
+                self.__remove(connections, key)
+                if connections is self.__up_connections:
+                    core.diamond_router.remove_route_up(event.src_ip, event.dest_ip)
+                else:
+                    core.diamond_router.remove_route_down(event.src_ip, event.dest_ip)
+                self.__routing_time.observe(time.time() - event.received)
             else:
-                log.info("Connection {} <-> {} is used {} times; staying routed down".format(event.dest, event.src, self.__down_connections[key]))   
+                log.info("Connection {} <-> {} is used {} times; staying routed {}".format(event.dest, event.src, pair.uses, direction))
+            self.__save(key)
+
+        if self.__strategy == "size":
+            self.__rebalance_sizes()
+        else:
+            self.__rebalance_counts()
+            
+        self.__log_balance()
 
+    def __move(self, key, heavy, light):
+        """
+        Moves a pair from the heavy arm's routes to the light one's. If
+        the router can't route it over the light arm, the pair is left
+        on the default routes and dropped, along with its load
+        """
+        a, b = pair_hosts(key)
+        if heavy is self.__up_connections:
+            log.info("Moving connection {} <-> {} from up to down".format(int_to_ip(a), int_to_ip(b)))
+            TRACE.record(MOVE, a, b, ARM_DOWN)
+            core.diamond_router.remove_route_up(a, b)
+            moved = core.diamond_router.add_route_down(a, b)
+        else:
+            log.info("Moving connection {} <-> {} from down to up".format(int_to_ip(a), int_to_ip(b)))
+            TRACE.record(MOVE, a, b, ARM_UP)
+            core.diamond_router.remove_route_down(a, b)
+            moved = core.diamond_router.add_route_up(a, b)
+
+        pair = self.__remove(heavy, key)
+        if moved:
+            self.__insert(light, key, pair)
+            self.__moves += 1
+        else:
+            log.warning("Unable to move connection {} <-> {}; dropping it and its {} uploads".format(
+                int_to_ip(a), int_to_ip(b), pair.uses))
+        self.__save(key)
+
+    def __rebalance_counts(self):
         # Rebalance; if there's > 2 difference between the sides
         while len(self.__up_connections) > len(self.__down_connections) + 1:
-            key, value = self.__up_connections.popitem()
-            log.info("Moving connection {} <-> {} from up to down".format(key[0], key[1]))
-            core.diamond_router.remove_route_up(key[0], key[1])
-            core.diamond_router.add_route_down(key[0], key[1])
+            key = next(iter(self.__up_connections))
+            self.__move(key, self.__up_connections, self.__down_connections)
             
         while len(self.__down_connections) > len(self.__up_connections) + 1:
-            key, value = self.__down_connections.popitem()
-            log.info("Moving connection {} <-> {} from down to up".format(key[0], key[1]))
-            core.diamond_router.remove_route_down(key[0], key[1])
-            core.diamond_router.add_route_up(key[0], key[1])
-            
-        log.info("{} connections routed down, {} routed up".format(len(self.__down_connections), len(self.__up_connections)))
+            key = next(iter(self.__down_connections))
+            self.__move(key, self.__down_connections, self.__up_connections)
+
+    def __rebalance_sizes(self):
+        # Move the pair which leaves the smallest difference between
+        # the arms, as long as that is an improvement: the one whose
+        # bytes are closest to half the difference, found either side
+        # of where half the difference would sort on the heavy arm
+        for _ in range(MAX_REBALANCE_MOVES):
+            if self.__up_bytes > self.__down_bytes:
+                heavy, light = self.__up_connections, self.__down_connections
+            else:
+                heavy, light = self.__down_connections, self.__up_connections
+            difference = abs(self.__up_bytes - self.__down_bytes)
+
+            sizes = self.__sizes(heavy)
+            i = bisect_left(sizes, (difference / 2.0,))
+            best = None
+            for size, key in sizes[max(0, i - 1):i + 1]:
+                if 0 < size < difference and (
+                        best is None or abs(difference - 2 * size) < best[0]):
+                    best = (abs(difference - 2 * size), key)
+            if best is None:
+                return
+            self.__move(best[1], heavy, light)
         
-def try_launch():
-    manager = ConnectionManager()
+def try_launch(strategy, alpha, stats_file, admission_delay, latency_threshold, latency_margin):
+    manager = ConnectionManager(strategy, alpha, stats_file=stats_file, admission_delay=admission_delay,
+                                latency_threshold=latency_threshold, latency_margin=latency_margin)
     
     core.register("diamond_manager", manager)
 
-def launch ():
-    core.call_when_ready(try_launch, ["diamond_listener", "diamond_router"])
-
-  
+def launch (strategy="count", alpha=0.2, stats_file=None, admission_delay=0,
+            latency_threshold=0, latency_margin=0.0005):
+    """
+    strategy is count or size, admission_delay the seconds a pair
+    waits before being routed, and uploads smaller than latency_threshold
+    bytes go on the faster arm; see ConnectionManager
+    """
+    core.call_when_ready(lambda: try_launch(strategy, float(alpha), stats_file, float(admission_delay),
+                                            float(latency_threshold), float(latency_margin)),
+                         ["diamond_listener", "diamond_router"])
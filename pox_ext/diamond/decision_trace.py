@@ -0,0 +1,257 @@
+"""
+A ring buffer of the decisions the controller makes, for working out
+afterwards why balancing went wrong without turning on debug logging.
+
+The connection manager and router record into TRACE as they go:
+notifications, placements (or their deferral by the admission delay),
+route adds and removes, moves between the arms, and hosts the edge
+switches learn. Each record is a timestamp from a monotonic clock
+(see _monotonic_clock), a kind and three ints written into
+preallocated arrays, so recording takes constant time and formats
+nothing. Once the buffer is full, the oldest records are overwritten.
+
+Launched as a POX component, e.g.
+
+    pox_ext.diamond.decision_trace --size=65536 --path=logs/decisions.jsonl
+
+the buffer is written to path on SIGUSR1, and served on /trace by the
+metrics endpoint if that is running. A path ending in .jsonl gets one
+JSON object per record, anything else the compact binary format.
+
+This module doesn't import POX, so it can also read dumps offline:
+
+    python2 -m pox_ext.diamond.decision_trace logs/decisions.jsonl [host]
+
+prints the timeline of every host pair in the dump (or only those
+of host)
+"""
+
+from array import array
+from collections import defaultdict
+
+import sys
+import json
+import time
+import struct
+
+from .addresses import ip_to_int, int_to_ip
+
+OPEN = 1
+CLOSE = 2
+PLACE = 3
+DEFER = 4
+CANCEL = 5
+ROUTE_ADD = 6
+ROUTE_REMOVE = 7
+MOVE = 8
+LEARN = 9
+
+KINDS = {
+    OPEN: "open",
+    CLOSE: "close",
+    PLACE: "place",
+    DEFER: "defer",
+    CANCEL: "cancel",
+    ROUTE_ADD: "route_add",
+    ROUTE_REMOVE: "route_remove",
+    MOVE: "move",
+    LEARN: "learn",
+}
+
+# Values of PLACE, ROUTE_ADD, ROUTE_REMOVE and MOVE
+ARM_UP = 1
+ARM_DOWN = 2
+ARMS = {ARM_UP: "up", ARM_DOWN: "down"}
+
+DEFAULT_SIZE = 65536
+
+# Binary dumps: this header, then one record per entry
+BINARY_MAGIC = b"DTR1"
+BINARY_RECORD = struct.Struct("!dBIIq")
+
+def _monotonic_clock():
+    """
+    Returns time.monotonic if there is one. Python 2 has none, so on
+    Linux it calls clock_gettime(CLOCK_MONOTONIC) through ctypes, and
+    only falls back to time.time, which can jump, if that fails
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+
+    try:
+        import ctypes
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL("librt.so.1", use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        now = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+            return time.time()
+        return now.tv_sec + now.tv_nsec * 1e-9
+    return monotonic
+
+_clock = _monotonic_clock()
+
+class DecisionTrace(object):
+    """
+    Fixed size ring buffer of (time, kind, a, b, value) records. For
+    LEARN, a is the host and b the switch's dpid; for everything else
+    a and b are the two hosts of a pair. value is the size of OPEN and
+    CLOSE (-1 if unknown), and the arm of the others
+    """
+    def __init__(self, size=DEFAULT_SIZE):
+        self.reset(size)
+
+    def reset(self, size):
+        self.__size = size
+        self.__times = array("d", [0.0]) * size
+        self.__kinds = array("B", [0]) * size
+        self.__a = array("L", [0]) * size
+        self.__b = array("L", [0]) * size
+        self.__values = array("l", [0]) * size
+        self.__next = 0
+        self.__recorded = 0
+
+    def record(self, kind, a, b, value=0):
+        i = self.__next
+        self.__times[i] = _clock()
+        self.__kinds[i] = kind
+        self.__a[i] = a
+        self.__b[i] = b
+        self.__values[i] = value
+        self.__next = i + 1 if i + 1 < self.__size else 0
+        self.__recorded += 1
+
+    def recorded(self):
+        """
+        Records made since the start, including overwritten ones
+        """
+        return self.__recorded
+
+    def records(self):
+        """
+        Returns the (time, kind, a, b, value) records
+        in the buffer, oldest first
+        """
+        count = min(self.__recorded, self.__size)
+        start = (self.__next - count) % self.__size
+        return [(self.__times[i], self.__kinds[i], self.__a[i], self.__b[i], self.__values[i])
+                for i in ((start + n) % self.__size for n in range(count))]
+
+    def dump_jsonl(self, out):
+        for record in self.records():
+            out.write(json.dumps(describe(record)) + "\n")
+
+    def dump_binary(self, out):
+        out.write(BINARY_MAGIC)
+        for record in self.records():
+            out.write(BINARY_RECORD.pack(*record))
+
+    def dump(self, path):
+        """
+        Writes the buffer to path; as JSONL if it ends in .jsonl
+        """
+        if path.endswith(".jsonl"):
+            with open(path, "w") as out:
+                self.dump_jsonl(out)
+        else:
+            with open(path, "wb") as out:
+                self.dump_binary(out)
+
+TRACE = DecisionTrace()
+
+def describe(record):
+    """
+    Returns a record as a dict, with addresses as strings
+    """
+    t, kind, a, b, value = record
+    described = {"t": t, "event": KINDS.get(kind, kind)}
+    if kind == LEARN:
+        described["host"] = int_to_ip(a)
+        described["dpid"] = b
+        return described
+
+    described["src"] = int_to_ip(a)
+    described["dest"] = int_to_ip(b)
+    if kind in (OPEN, CLOSE):
+        if value >= 0:
+            described["bytes"] = value
+    elif kind in (PLACE, ROUTE_ADD, ROUTE_REMOVE, MOVE):
+        described["arm"] = ARMS.get(value, value)
+    return described
+
+def load(path):
+    """
+    Reads a dump written by DecisionTrace.dump as described records
+    """
+    if path.endswith(".jsonl"):
+        with open(path) as dump:
+            return [json.loads(line) for line in dump if line.strip()]
+
+    with open(path, "rb") as dump:
+        data = dump.read()
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("{} is not a decision trace".format(path))
+    return [describe(BINARY_RECORD.unpack_from(data, offset))
+            for offset in range(len(BINARY_MAGIC), len(data), BINARY_RECORD.size)]
+
+def timelines(records, host=None):
+    """
+    Groups the records by host pair; the timeline of a single host
+    holds what was learned about it. Returns a list of (name, records
+    in time order), ordered by address
+    """
+    grouped = defaultdict(list)
+    for record in records:
+        if "host" in record:
+            hosts = (record["host"],)
+        else:
+            hosts = tuple(sorted([record["src"], record["dest"]], key=ip_to_int))
+        if host is None or host in hosts:
+            grouped[hosts].append(record)
+
+    return [(" <-> ".join(hosts), sorted(grouped[hosts], key=lambda record: record["t"]))
+            for hosts in sorted(grouped, key=lambda hosts: [ip_to_int(h) for h in hosts])]
+
+def print_timelines(records, host=None, out=sys.stdout):
+    if not records:
+        return
+    start = min(record["t"] for record in records)
+    for name, entries in timelines(records, host):
+        out.write("{}\n".format(name))
+        for record in entries:
+            details = " ".join("{}={}".format(key, record[key]) for key in ("arm", "bytes", "dpid") if key in record)
+            out.write("  {:10.4f} {:<12} {}\n".format(record["t"] - start, record["event"], details))
+
+def launch (size=DEFAULT_SIZE, path="decisions.jsonl"):
+    from pox.core import core
+    import signal
+
+    log = core.getLogger("diamond.decision-trace")
+    TRACE.reset(int(size))
+
+    def dump(signum=None, frame=None):
+        TRACE.dump(path)
+        log.info("Wrote {} decisions to {}".format(min(TRACE.recorded(), int(size)), path))
+
+    def serve_trace():
+        def page():
+            lines = [json.dumps(describe(record)) for record in TRACE.records()]
+            return "application/x-ndjson", "\n".join(lines) + "\n"
+        core.diamond_metrics.add_page("/trace", page)
+
+    signal.signal(signal.SIGUSR1, dump)
+    core.call_when_ready(serve_trace, ["diamond_metrics"])
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python2 -m pox_ext.diamond.decision_trace dump [host]")
+    print_timelines(load(sys.argv[1]), sys.argv[2] if len(sys.argv) > 2 else None)
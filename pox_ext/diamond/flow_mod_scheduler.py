@@ -0,0 +1,175 @@
+"""
+Rate limiting for the flow mods the router sends to a switch.
+
+A burst of uploads ending can make the connection manager move many
+pairs at once, four flow mods each, and switches (OVS included) slow
+down when flooded with control messages. A FlowModScheduler sits in
+front of one switch connection and sends at most rate flow mods a
+second, allowing bursts of up to burst, through a token bucket.
+Whatever can't be sent right away waits in one queue per class and is
+sent, oldest first, from the most important class that has any:
+
+CLASS_FAILOVER  - restoring routes which traffic depends on
+CLASS_REBALANCE - placing, moving and removing routes
+CLASS_LEARNING  - the mac rules of hosts the switch learns
+
+Messages can be sent with a key and a command (OFPFC_ADD or
+OFPFC_DELETE). If one is still queued when the other command with the
+same key is sent, the two cancel out and neither is sent, like a route
+added and removed again before the switch ever saw it.
+"""
+
+from pox.core import core
+from pox.lib.recoco import Timer
+
+from .metrics import REGISTRY
+
+from collections import deque
+
+import time
+
+log = core.getLogger("diamond.scheduler")
+
+CLASS_FAILOVER = 0
+CLASS_REBALANCE = 1
+CLASS_LEARNING = 2
+
+CLASSES = (CLASS_FAILOVER, CLASS_REBALANCE, CLASS_LEARNING)
+
+# Flow mods per second, and how many can be sent at once
+DEFAULT_RATE = 1000
+DEFAULT_BURST = 100
+
+class _Queued(object):
+    __slots__ = ("data", "key", "command", "queued", "cancelled")
+
+    def __init__(self, data, key, command, queued):
+        self.data = data
+        self.key = key
+        self.command = command
+        self.queued = queued
+        self.cancelled = False
+
+class FlowModScheduler(object):
+    """
+    Sends messages to one switch connection through a token bucket;
+    rate 0 sends everything immediately
+    """
+    def __init__(self, connection, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.__connection = connection
+        self.__rate = float(rate)
+        self.__burst = max(1, burst)
+
+        self.__tokens = float(self.__burst)
+        self.__last_fill = time.time()
+        self.__timer = None
+
+        self.__queues = dict((klass, deque()) for klass in CLASSES)
+        # Key -> the queued message with that key
+        self.__pending = {}
+        self.__depth = 0
+
+        self.__sent = 0
+        self.__delayed = 0
+        self.__coalesced = 0
+        self.__peak_depth = 0
+        self.__total_delay = 0.0
+        self.__max_delay = 0.0
+
+        labels = {"dpid": connection.dpid}
+        REGISTRY.counter("diamond_flow_mods_sent_total", "Flow mods sent to the switch",
+                         labels, lambda: self.__sent)
+        REGISTRY.counter("diamond_flow_mods_coalesced_total", "Flow mods never sent as they cancelled out",
+                         labels, lambda: self.__coalesced)
+        REGISTRY.gauge("diamond_flow_mod_queue_depth", "Flow mods waiting for the rate limit",
+                       labels, lambda: self.__depth)
+        self.__delay_histogram = REGISTRY.histogram(
+            "diamond_flow_mod_delay_seconds", "Time flow mods waited for the rate limit", labels)
+
+    def stats(self):
+        return {
+            "sent": self.__sent,
+            "delayed": self.__delayed,
+            "coalesced": self.__coalesced,
+            "queue_depth": self.__depth,
+            "peak_queue_depth": self.__peak_depth,
+            "mean_delay": self.__total_delay / self.__delayed if self.__delayed else 0.0,
+            "max_delay": self.__max_delay,
+        }
+
+    def send(self, data, klass=CLASS_REBALANCE, key=None, command=None):
+        """
+        Sends a message (packed or not) to the switch now, if the
+        bucket allows, or else once it does
+        """
+        if key is not None:
+            queued = self.__pending.get(key)
+            if queued is not None and queued.command == command:
+                # Already on its way
+                self.__coalesced += 1
+                return
+            if queued is not None:
+                # The two cancel out
+                queued.cancelled = True
+                del self.__pending[key]
+                self.__depth -= 1
+                self.__coalesced += 2
+                return
+
+        if self.__rate <= 0 or (not self.__depth and self.__take()):
+            self.__send(data)
+            return
+
+        queued = _Queued(data, key, command, time.time())
+        self.__queues[klass].append(queued)
+        if key is not None:
+            self.__pending[key] = queued
+        self.__depth += 1
+        self.__peak_depth = max(self.__peak_depth, self.__depth)
+        self.__schedule()
+
+    def __send(self, data):
+        self.__connection.send(data)
+        self.__sent += 1
+
+    def __take(self):
+        now = time.time()
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__last_fill) * self.__rate)
+        self.__last_fill = now
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+    def __schedule(self):
+        if self.__timer is None:
+            wait = max(0.001, (1 - self.__tokens) / self.__rate)
+            self.__timer = Timer(wait, self.__drain)
+
+    def __next(self):
+        for klass in CLASSES:
+            queue = self.__queues[klass]
+            while queue:
+                queued = queue.popleft()
+                if not queued.cancelled:
+                    return queued
+        return None
+
+    def __drain(self):
+        self.__timer = None
+        while self.__depth and self.__take():
+            queued = self.__next()
+            self.__depth -= 1
+            if queued.key is not None:
+                del self.__pending[queued.key]
+
+            delay = time.time() - queued.queued
+            self.__delayed += 1
+            self.__total_delay += delay
+            self.__max_delay = max(self.__max_delay, delay)
+            self.__delay_histogram.observe(delay)
+            self.__send(queued.data)
+
+        if self.__depth:
+            log.debug("Switch {}: {} flow mods queued".format(self.__connection.dpid, self.__depth))
+            self.__schedule()
@@ -25,3 +25,9 @@ PRIORITY_SEND_TO_MAC = 255
 # for outgoing
 PRIORITY_ROUTE_CONNECTION = 256
 
+# ARP requests go to the controller to be answered by the ARP
+# proxy instead of being flooded, ahead of every other rule
+PRIORITY_ARP_REQUEST = 257
+
+# Latency probes arriving at switch 4 go to the controller
+PRIORITY_LATENCY_PROBE = 258
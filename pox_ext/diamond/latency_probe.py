@@ -0,0 +1,147 @@
+"""
+This component measures the latency of the two arms of the diamond
+network topology; see router.py for the topology.
+
+Every interval seconds, once switches 1 and 4 have their default routes,
+a probe frame is sent out of switch 1 on port 1 (the up arm, through
+s2) and port 2 (the down arm, through s3) with a packet out. Probes
+have their own ethertype, and a rule on switch 4 sends them back to
+the controller, which takes the time between sending and receiving as
+the latency of the arm. This includes the control channel both ways,
+the same for both arms, so the difference between the arms is what
+matters; queues building up on an arm show up in it long before the
+number of pairs on the arm says anything.
+
+The latency of each arm is kept as an EWMA weighted by alpha. A probe
+which hasn't arrived by the time the next ones are sent is counted as
+lost.
+
+This component requires the component registered as 'diamond_router';
+the connection manager uses it, if it is running, to place small
+uploads on the faster arm (see connection_manager.py)
+"""
+
+from pox.core import core
+from pox.lib.addresses import EthAddr
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.recoco import Timer
+import pox.openflow.libopenflow_01 as of
+
+import struct
+import time
+
+from .flow_table_priorities import *
+from .decision_trace import ARM_UP, ARM_DOWN, ARMS
+from .metrics import REGISTRY
+
+log = core.getLogger("diamond.latency")
+
+# IEEE local experimental ethertype
+PROBE_ETHERTYPE = 0x88B5
+PROBE_SRC = EthAddr("02:00:00:00:00:01")
+PROBE_DST = EthAddr("02:00:00:00:00:04")
+
+# Sequence number, arm, and the time it was sent
+PROBE = struct.Struct("!IBd")
+
+# Port of switch 1 each arm starts on
+ARM_PORTS = {ARM_UP: 1, ARM_DOWN: 2}
+
+class LatencyProbe (object):
+    def __init__(self, interval=1.0, alpha=0.2):
+        self.__alpha = alpha
+        self.__switch_1 = None
+        self.__switch_4 = None
+
+        self.__sequence = 0
+        # Sequence number -> arm of the probes on their way
+        self.__outstanding = {}
+
+        self.__latency = dict((arm, None) for arm in ARMS)
+        self.__received = dict((arm, 0) for arm in ARMS)
+        self.__lost = dict((arm, 0) for arm in ARMS)
+
+        for arm, name in ARMS.items():
+            REGISTRY.gauge("diamond_arm_latency_seconds", "EWMA of the probe latency of each arm",
+                           {"arm": name}, lambda arm=arm: self.__latency[arm] or 0)
+            REGISTRY.counter("diamond_latency_probes_lost_total", "Latency probes which never arrived",
+                             {"arm": name}, lambda arm=arm: self.__lost[arm])
+
+        core.diamond_router.addListenerByName("SwitchReady", self.__switch_ready)
+        core.openflow.addListenerByName("PacketIn", self.__packetIn)
+        self.__probe_timer = Timer(timeToWake=interval, callback=self.__probe,
+                                   recurring=True, started=True, selfStoppable=False)
+
+    def __probe_to_controller_mod(self):
+        """
+        Creates a flow mod to send probes to the controller only
+        """
+        msg = of.ofp_flow_mod()
+        msg.priority = PRIORITY_LATENCY_PROBE
+        msg.match.dl_type = PROBE_ETHERTYPE
+        msg.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER))
+
+        return msg
+
+    def __switch_ready(self, event):
+        if event.dpid == 1:
+            self.__switch_1 = event.connection
+        elif event.dpid == 4:
+            log.info("Sending latency probes from switch 4 to the controller")
+            event.connection.send(self.__probe_to_controller_mod())
+            self.__switch_4 = event.connection
+
+    def __probe(self):
+        if not self.__switch_1 or not self.__switch_4:
+            return
+
+        for sequence, arm in self.__outstanding.items():
+            self.__lost[arm] += 1
+        self.__outstanding.clear()
+
+        for arm, port in ARM_PORTS.items():
+            self.__sequence = (self.__sequence + 1) & 0xFFFFFFFF
+            self.__outstanding[self.__sequence] = arm
+
+            frame = ethernet(type = PROBE_ETHERTYPE, src = PROBE_SRC, dst = PROBE_DST)
+            frame.payload = PROBE.pack(self.__sequence, arm, time.time())
+
+            msg = of.ofp_packet_out()
+            msg.data = frame.pack()
+            msg.actions.append(of.ofp_action_output(port = port))
+            self.__switch_1.send(msg)
+
+    def __packetIn(self, event):
+        if event.dpid != 4 or event.parsed.type != PROBE_ETHERTYPE:
+            return
+
+        data = event.ofp.data[ethernet.MIN_LEN:ethernet.MIN_LEN + PROBE.size]
+        if len(data) < PROBE.size:
+            return
+        sequence, arm, sent = PROBE.unpack(data)
+        if self.__outstanding.pop(sequence, None) != arm:
+            return
+
+        latency = time.time() - sent
+        previous = self.__latency[arm]
+        self.__latency[arm] = latency if previous is None else self.__alpha * latency + (1 - self.__alpha) * previous
+        self.__received[arm] += 1
+        log.debug("Probe over the {} arm took {:.6f}s".format(ARMS[arm], latency))
+
+    def latency(self, arm):
+        """
+        Returns the EWMA latency, in seconds, of ARM_UP or
+        ARM_DOWN, or None if no probe has come back over it
+        """
+        return self.__latency[arm]
+
+    def stats(self):
+        return dict((ARMS[arm], {
+            "latency": self.__latency[arm],
+            "received": self.__received[arm],
+            "lost": self.__lost[arm],
+        }) for arm in ARMS)
+
+def launch (interval=1.0, alpha=0.2):
+    core.call_when_ready(lambda: core.register("diamond_latency", LatencyProbe(float(interval), float(alpha))),
+                         ["diamond_router"])
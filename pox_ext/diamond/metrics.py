@@ -0,0 +1,212 @@
+"""
+Metrics for the diamond controller, in the Prometheus text format.
+
+The listener, router and connection manager register counters, gauges
+and histograms with REGISTRY when they start, and keep them to update
+as they go: a counter or histogram update is a few additions, and a
+gauge can be a function which is only called when the metrics are
+read, so keeping them costs next to nothing while nobody looks.
+
+Counts a component already keeps for itself are best registered as
+functions, which the hot path then doesn't touch at all.
+
+Launching this component serves them over HTTP on /metrics, e.g.
+
+    pox_ext.diamond.metrics --address=127.0.0.1 --port=9100
+
+The server is polled from a recoco timer, like the connection
+listener, so it needs no threads of its own. Other components can
+serve pages of their own from it with add_page()
+"""
+
+from pox.core import core
+from pox.lib.recoco import Timer
+
+from bisect import bisect_left
+from select import select
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+log = core.getLogger("diamond.metrics")
+
+# Upper bounds, in seconds, of the buckets of latency histograms
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def _labels(labels, extra=None):
+    items = sorted(labels.items()) if labels else []
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in items) + "}"
+
+class Counter(object):
+    """
+    A count which only goes up, or if function is given, read
+    from it whenever the metrics are rendered
+    """
+    __slots__ = ("value", "function")
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name + _labels(labels), self.function() if self.function else self.value
+
+class Gauge(object):
+    """
+    A value which is set, or if function is given, read from
+    it whenever the metrics are rendered
+    """
+    __slots__ = ("value", "function")
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name + _labels(labels), self.function() if self.function else self.value
+
+class Histogram(object):
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            yield name + "_bucket" + _labels(labels, ("le", repr(bound))), total
+        yield name + "_bucket" + _labels(labels, ("le", "+Inf")), self.count
+        yield name + "_sum" + _labels(labels), self.sum
+        yield name + "_count" + _labels(labels), self.count
+
+class Registry(object):
+    """
+    Metrics by name and labels. Asking for a metric which already
+    exists returns the existing one
+    """
+    def __init__(self):
+        # name -> (type, help, {labels tuple -> (labels, metric)})
+        self.__families = {}
+        self.__order = []
+
+    def __metric(self, kind, name, help, labels, make):
+        family = self.__families.get(name)
+        if family is None:
+            family = (kind, help, {})
+            self.__families[name] = family
+            self.__order.append(name)
+        elif family[0] != kind:
+            raise ValueError("Metric {} is a {}, not a {}".format(name, family[0], kind))
+
+        key = tuple(sorted(labels.items())) if labels else ()
+        entry = family[2].get(key)
+        if entry is None:
+            entry = (labels, make())
+            family[2][key] = entry
+        return entry[1]
+
+    def counter(self, name, help, labels=None, function=None):
+        counter = self.__metric("counter", name, help, labels, Counter)
+        if function is not None:
+            counter.function = function
+        return counter
+
+    def gauge(self, name, help, labels=None, function=None):
+        gauge = self.__metric("gauge", name, help, labels, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, labels=None, bounds=LATENCY_BUCKETS):
+        return self.__metric("histogram", name, help, labels, lambda: Histogram(bounds))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format
+        """
+        lines = []
+        for name in self.__order:
+            kind, help, metrics = self.__families[name]
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, metric in metrics.values():
+                for sample, value in metric.samples(name, labels):
+                    lines.append("{} {}".format(sample, value))
+        lines.append("")
+        return "\n".join(lines)
+
+REGISTRY = Registry()
+
+class MetricsHandler(BaseHTTPRequestHandler, object):
+    # A client which stops sending can only stall the controller this long
+    timeout = 1
+
+    def do_GET(self):
+        page = self.server.page(self.path.split("?", 1)[0])
+        if page is None:
+            self.send_error(404)
+            return
+
+        content_type, body = page()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+class MetricsServer(HTTPServer, object):
+    # Most requests handled per poll
+    MAX_REQUESTS_PER_POLL = 10
+
+    def __init__(self, address, port, registry=REGISTRY, poll_interval=0.5):
+        HTTPServer.__init__(self, (address, port), MetricsHandler, bind_and_activate=False)
+        self.allow_reuse_address = True
+        self.server_bind()
+        self.server_activate()
+
+        self.__pages = {}
+        self.add_page("/metrics", lambda: (CONTENT_TYPE, registry.render()))
+
+        log.info("Serving metrics on http://{}:{}/metrics".format(address, port))
+        self.__poll_timer = Timer(timeToWake=poll_interval, callback=self.__poll,
+                                  recurring=True, started=True, selfStoppable=False)
+
+    def add_page(self, path, function):
+        """
+        Serves the (content type, body) returned by function on path
+        """
+        self.__pages[path] = function
+
+    def page(self, path):
+        return self.__pages.get(path)
+
+    def __poll(self):
+        for _ in range(self.MAX_REQUESTS_PER_POLL):
+            if not select([self], [], [], 0)[0]:
+                break
+            self._handle_request_noblock()
+
+def launch (address="127.0.0.1", port=9100):
+    core.register("diamond_metrics", MetricsServer(address, int(port)))
@@ -0,0 +1,85 @@
+"""
+Pre-packed flow mods for the routes the router adds and removes.
+
+Every route change sends a flow mod which differs from the last one
+to the same port only in its IP addresses and xid. Rather than build
+ofp_flow_mod, ofp_match and ofp_action_output objects and have POX
+pack them each time, RouteModTemplates packs one flow mod per (port,
+command) and patches those fields into a copy of its bytes, which a
+connection sends as they are.
+
+Only used for OpenFlow 1.0, where the xid is at offset 4 of the
+header and the match's nw_src and nw_dst at offsets 36 and 40
+"""
+
+from pox.lib.addresses import IPAddr
+import pox.openflow.libopenflow_01 as of
+
+import struct
+
+from .addresses import int_to_ip
+
+XID_OFFSET = 4
+NW_SRC_OFFSET = 36
+NW_DST_OFFSET = 40
+
+_uint32 = struct.Struct("!I")
+
+# Addresses packed into the templates, so their offsets can be checked
+_PLACEHOLDER_SRC = 0x01020304
+_PLACEHOLDER_DST = 0x05060708
+
+def route_mod(local_ip, other_ip, port, priority, command=of.OFPFC_ADD):
+    """
+    Produces a flow mod to send messages from the given ip address
+    to the other out the target port, or with OFPFC_DELETE, one to
+    remove that rule. Addresses are from ip_to_int
+    """
+    msg = of.ofp_flow_mod()
+    msg.command = command
+    msg.priority = priority
+    msg.match.nw_src = (IPAddr(int_to_ip(local_ip)), 32)
+    msg.match.nw_dst = (IPAddr(int_to_ip(other_ip)), 32)
+    msg.match.dl_type = 0x0800
+
+    if command == of.OFPFC_DELETE:
+        msg.out_port = port
+    else:
+        msg.actions.append(of.ofp_action_output(port = port))
+
+    return msg
+
+class RouteModTemplates(object):
+    """
+    Packed route_mod()s for one switch, made once per (port, command)
+    """
+    def __init__(self, priority):
+        self.__priority = priority
+        self.__templates = {}
+
+    def __template(self, port, command):
+        template = self.__templates.get((port, command))
+        if template is None:
+            template = bytearray(route_mod(
+                _PLACEHOLDER_SRC, _PLACEHOLDER_DST, port, self.__priority, command).pack())
+            assert _uint32.unpack_from(template, NW_SRC_OFFSET)[0] == _PLACEHOLDER_SRC
+            assert _uint32.unpack_from(template, NW_DST_OFFSET)[0] == _PLACEHOLDER_DST
+            self.__templates[(port, command)] = template
+        return template
+
+    def pack(self, local_ip, other_ip, port, command=of.OFPFC_ADD):
+        """
+        Returns the packed route_mod() for the given addresses,
+        with a new xid, ready to be sent on a connection
+        """
+        data = bytearray(self.__template(port, command))
+        _uint32.pack_into(data, XID_OFFSET, of.generate_xid())
+        _uint32.pack_into(data, NW_SRC_OFFSET, local_ip)
+        _uint32.pack_into(data, NW_DST_OFFSET, other_ip)
+        return bytes(data)
+
+    def add(self, local_ip, other_ip, port):
+        return self.pack(local_ip, other_ip, port, of.OFPFC_ADD)
+
+    def delete(self, local_ip, other_ip, port):
+        return self.pack(local_ip, other_ip, port, of.OFPFC_DELETE)
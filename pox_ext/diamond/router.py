@@ -34,10 +34,19 @@ switch 2 is 2, and so forth.
 """
 
 from pox.core import core
-from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.addresses import EthAddr
+from pox.lib.revent import Event, EventMixin
 import pox.openflow.libopenflow_01 as of
 
+import time
+import logging
+
 from .flow_table_priorities import *
+from .addresses import ip_to_int, int_to_ip
+from .route_mods import RouteModTemplates
+from .metrics import REGISTRY
+from .decision_trace import TRACE, ROUTE_ADD, ROUTE_REMOVE, LEARN, ARM_UP, ARM_DOWN
+from .flow_mod_scheduler import FlowModScheduler, CLASS_FAILOVER, CLASS_REBALANCE, CLASS_LEARNING, DEFAULT_RATE, DEFAULT_BURST
 
 log = core.getLogger("diamond.router")
 
@@ -45,6 +54,23 @@ class MissingPortError(Exception):
     def __init__(self, port):
         self.port = port
 
+class SwitchReady(Event):
+    """
+    Raised by the router once the default routes of switch 1 or 4
+    are installed; they start by clearing the flow table, so other
+    components must add their own rules after this
+    """
+    def __init__(self, connection):
+        self.__connection = connection
+
+    @property
+    def connection(self):
+        return self.__connection
+
+    @property
+    def dpid(self):
+        return self.__connection.dpid
+
 class SmartSwitchController (object):
     """
     Controller for one of the two switches on the sides
@@ -69,6 +95,13 @@ class SmartSwitchController (object):
     5b. Messages from that mac will be flooded to all local ports (if it is on port 1 or 2)
     
     Note, for this to work, rule 5 must be lower priority than rule 4
+
+    If a checkpoint (see checkpoint.py) has macs or hosts for the switch,
+    they are restored and the table is not cleared. Instead, once the
+    default routes are sent, the rules on the switch are fetched:
+    route rules the routes_callback doesn't expect are removed, expected
+    ones missing are added, mac rules missing are sent again, and mac rules
+    the checkpoint didn't have are adopted
     """
     
     def __no_flood_mod(self, port):
@@ -156,33 +189,6 @@ class SmartSwitchController (object):
         
         return msg;
               
-    def __ip_route_add_mod(self, local_ip, other_ip, port):
-        """
-        Produces a flow mod to send messages from the given
-        ip address out the target port.
-        """
-        msg = of.ofp_flow_mod()
-        msg.priority = PRIORITY_ROUTE_CONNECTION
-        msg.match.nw_src = (IPAddr(local_ip), 32)
-        msg.match.nw_dst = (IPAddr(other_ip), 32)
-        msg.match.dl_type = 0x0800
-        msg.actions.append(of.ofp_action_output(port = port))
-        
-        return msg
-        
-    def __ip_route_delete_mod(self, local_ip, other_ip, port):
-        """
-        Produces a flow mod to remove a flow mod
-        to send messages from the given
-        ip address out the target port.
-        """
-        msg = self.__ip_route_add_mod(local_ip, other_ip, port)
-        msg.command = of.OFPFC_DELETE
-        msg.actions = []
-        msg.out_port = port
-        
-        return msg
-      
     def __clear_table_mod(self):
         """
         Produces a flow mod to clear the table
@@ -193,8 +199,9 @@ class SmartSwitchController (object):
         return msg
         
     def __set_default_route(self):
-        # 0. Clear the table
-        self.__connection.send(self.__clear_table_mod())
+        # 0. Clear the table, unless what's on it is being restored
+        if not self.__warm:
+            self.__connection.send(self.__clear_table_mod())
         
         # 1. Ports 1 and 2 will be marked no-flood
         self.__connection.send(self.__no_flood_mod(1))
@@ -237,16 +244,20 @@ class SmartSwitchController (object):
         
         self.log.info("Mapping mac {} to port {}".format(mac, port))
         self.__mac_to_port[mac] = port
-        
+        if self.__checkpoint:
+            self.__checkpoint.learned_mac(self.__dpid, mac.toRaw(), port)
+        self.__send_mac_rules(mac, port, CLASS_LEARNING)
+
+    def __send_mac_rules(self, mac, port, klass):
         # 4. Messages for that mac will be forwarded to that port
-        self.__connection.send(self.__send_for_mac_to_port_mod(mac, port))
+        self.__scheduler.send(self.__send_for_mac_to_port_mod(mac, port), klass)
         
         # 5. Messages from that mac will be flooded and forwarded to port 1
         # or just flooded
         if port == 1:
-            self.__connection.send(self.__flood_from_mac_mod(mac))
+            self.__scheduler.send(self.__flood_from_mac_mod(mac), klass)
         else:
-            self.__connection.send(self.__flood_and_forward_from_mac_mod(mac))
+            self.__scheduler.send(self.__flood_and_forward_from_mac_mod(mac), klass)
         
     def __try_set_default_route(self):
         if self.__default_route_is_setup:
@@ -256,28 +267,111 @@ class SmartSwitchController (object):
             self.__set_default_route()
             self.log.info("Setup default routes")
             self.__default_route_is_setup = True
+            if self.__warm:
+                self.log.info("Fetching the rules on the switch to reconcile with the checkpoint")
+                self.__connection.send(of.ofp_stats_request(body = of.ofp_flow_stats_request()))
+            if self.__ready_callback:
+                self.__ready_callback(self.__connection)
         except MissingPortError as ex:
             self.log.warning("Unable to set default route; missing port {}".format(ex.port))
    
     
-    def __init__(self, connection):
+    def __init__(self, connection, ready_callback=None, learned_callback=None, scheduler=None,
+                 checkpoint=None, routes_callback=None):
         self.__connection = connection
+        # Flow mods after the default routes go through this; see flow_mod_scheduler.py
+        self.__scheduler = scheduler or FlowModScheduler(connection, 0)
         self.__dpid = connection.dpid
         self.__default_route_is_setup = False
+        self.__ready_callback = ready_callback
+        self.__learned_callback = learned_callback
+        self.__checkpoint = checkpoint
+        self.__routes_callback = routes_callback
+
+        self.__packet_in_time = REGISTRY.histogram(
+            "diamond_packet_in_seconds", "Time taken to handle a PacketIn", {"dpid": self.__dpid})
+
+        # Route flow mods are sent pre-packed; see route_mods.py
+        self.__route_mods = RouteModTemplates(PRIORITY_ROUTE_CONNECTION)
         
         self.log = log.getChild("switch-{}".format(self.__dpid))
         self.log.info("Smart switch {} connected".format(self.__dpid))
         
         self.__connection.addListenerByName("PacketIn", self.__packetIn)
         self.__connection.addListenerByName("PortStatus", self.__portStatus)
+        self.__connection.addListenerByName("FlowStatsReceived", self.__flowStats)
         
         self.__mac_to_port = {}
+        # IPs (from ip_to_int) of hosts connected directly
         self.__learned_ips = set()
+        # IP -> mac of hosts connected directly
+        self.__ip_to_mac = {}
+
+        self.__warm = False
+        if checkpoint:
+            self.__restore()
 
         self.log.info("Attempting to set up default routes...")
         self.__try_set_default_route()
             
+    def __restore(self):
+        macs = self.__checkpoint.macs(self.__dpid)
+        hosts = self.__checkpoint.hosts(self.__dpid)
+        if not macs and not hosts:
+            return
+
+        self.log.info("Restoring {} macs and {} hosts from the checkpoint".format(len(macs), len(hosts)))
+        self.__warm = True
+        for mac, port in macs.items():
+            self.__mac_to_port[EthAddr(mac)] = port
+        for ip, mac in hosts.items():
+            self.__ip_to_mac[ip] = EthAddr(mac)
+            self.__learned_ips.add(ip)
+            if self.__learned_callback:
+                self.__learned_callback(ip, self.__dpid)
+
+    def __flowStats(self, event):
+        if not self.__warm:
+            return
+        self.__warm = False
+
+        present_routes = set()
+        present_macs = {}
+        for stats in event.stats:
+            if not stats.actions:
+                continue
+            if stats.priority == PRIORITY_ROUTE_CONNECTION:
+                present_routes.add((ip_to_int(stats.match.nw_src), ip_to_int(stats.match.nw_dst),
+                                    stats.actions[0].port))
+            elif stats.priority == PRIORITY_SEND_TO_MAC and stats.match.dl_dst is not None:
+                present_macs[stats.match.dl_dst] = stats.actions[0].port
+
+        expected = self.__routes_callback(self.__dpid) if self.__routes_callback else set()
+        for route in present_routes - expected:
+            self.__scheduler.send(self.__route_mods.delete(*route), CLASS_FAILOVER)
+        for route in expected - present_routes:
+            self.__scheduler.send(self.__route_mods.add(*route), CLASS_FAILOVER)
+
+        for mac, port in present_macs.items():
+            if mac not in self.__mac_to_port:
+                self.__mac_to_port[mac] = port
+                if self.__checkpoint:
+                    self.__checkpoint.learned_mac(self.__dpid, mac.toRaw(), port)
+        resent = 0
+        for mac, port in self.__mac_to_port.items():
+            if present_macs.get(mac) != port:
+                self.__send_mac_rules(mac, port, CLASS_FAILOVER)
+                resent += 1
+
+        self.log.info("Reconciled with the checkpoint: {} routes kept, {} removed and {} restored; {} macs resent".format(
+            len(present_routes & expected), len(present_routes - expected), len(expected - present_routes), resent))
+
     def __packetIn(self, event):
+        start = time.time()
+        self.__handle_packet_in(event)
+        self.__packet_in_time.observe(time.time() - start)
+
+    def __handle_packet_in(self, event):
         packet_type = event.parsed # This is the parsed packet data.
         if not packet_type.parsed:
           self.log.warning("Ignoring incomplete packet")
@@ -294,7 +388,21 @@ class SmartSwitchController (object):
             # Only track IP addresses of hosts connected
             # directly
             if event.port > 2:
-                self.__learned_ips.add(ip.srcip)
+                src = ip_to_int(ip.srcip)
+                self.__ip_to_mac[src] = eth.src
+                if src not in self.__learned_ips:
+                    self.__learned_ips.add(src)
+                    if self.__checkpoint:
+                        self.__checkpoint.learned_host(self.__dpid, src, eth.src.toRaw())
+                    if self.__learned_callback:
+                        self.__learned_callback(src, self.__dpid)
+
+        # ARP tells us the mac of a local host before it sends any IP
+        arp = packet_type.find("arp")
+        if arp and event.port > 2:
+            src = ip_to_int(arp.protosrc)
+            if src:
+                self.__ip_to_mac[src] = arp.hwsrc
         
     def __portStatus(self, event):
         self.log.info("Ports changed!")
@@ -302,31 +410,36 @@ class SmartSwitchController (object):
         self.__try_set_default_route()
         
     def has_learned(self, ip):
-        return IPAddr(ip) in self.__learned_ips
+        return ip_to_int(ip) in self.__learned_ips
+
+    def mac_for(self, ip):
+        """
+        Returns the mac of a host connected directly to this
+        switch with the given IP address, or None
+        """
+        return self.__ip_to_mac.get(ip_to_int(ip))
         
     def __add_route(self, local_ip, other_ip, port):
-        self.log.debug("Adding rule for {} -> {} out port {}".format(local_ip, other_ip, port))
-        self.__connection.send(self.__ip_route_add_mod(local_ip, other_ip, port))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Adding rule for {} -> {} out port {}".format(int_to_ip(local_ip), int_to_ip(other_ip), port))
+        self.__scheduler.send(self.__route_mods.add(local_ip, other_ip, port), CLASS_REBALANCE,
+                              (local_ip, other_ip, port), of.OFPFC_ADD)
         
     def __remove_route(self, local_ip, other_ip, port):
-        self.log.debug("Removing rule for {} -> {} out port {}".format(local_ip, other_ip, port))
-        self.__connection.send(self.__ip_route_delete_mod(local_ip, other_ip, port))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Removing rule for {} -> {} out port {}".format(int_to_ip(local_ip), int_to_ip(other_ip), port))
+        self.__scheduler.send(self.__route_mods.delete(local_ip, other_ip, port), CLASS_REBALANCE,
+                              (local_ip, other_ip, port), of.OFPFC_DELETE)
         
-    def add_route(self, src_ip, dest_ip, port):
-        if self.has_learned(src_ip):
-            assert(not self.has_learned(dest_ip))
-            self.__add_route(src_ip, dest_ip, port)
-        else:
-            assert(self.has_learned(dest_ip))
-            self.__add_route(dest_ip, src_ip, port)
+    def add_route(self, local_ip, other_ip, port):
+        """
+        Sends traffic from local_ip, connected to this switch,
+        to other_ip out port. Both are from ip_to_int
+        """
+        self.__add_route(local_ip, other_ip, port)
         
-    def remove_route(self, src_ip, dest_ip, port):
-        if self.has_learned(src_ip):
-            assert(not self.has_learned(dest_ip))
-            self.__remove_route(src_ip, dest_ip, port)
-        else:
-            assert(self.has_learned(dest_ip))
-            self.__remove_route(dest_ip, src_ip, port)
+    def remove_route(self, local_ip, other_ip, port):
+        self.__remove_route(local_ip, other_ip, port)
         
 class DumbSwitchController (object):
     """
@@ -350,20 +463,36 @@ class DumbSwitchController (object):
         connection.send(self.__dumb_flow_mod(1, 2))
         connection.send(self.__dumb_flow_mod(2, 1))
 
-class EqualDiamondRouter (object):
+class EqualDiamondRouter (EventMixin):
     """
     A single controller should be created on startup,
     and then given access to all connections found.
     
     Once the four expected connections have been added,
     it will begin operation.
+
+    Raises SwitchReady when the default routes of switch 1 or
+    4 have been installed
     """
+    _eventMixin_events = set([
+        SwitchReady,
+      ])
     
-    def __init__ (self):
+    def __init__ (self, flow_mod_rate=DEFAULT_RATE, flow_mod_burst=DEFAULT_BURST):
         self.__switch_1 = None
         self.__switch_2 = None
         self.__switch_3 = None
         self.__switch_4 = None
+
+        self.__flow_mod_rate = flow_mod_rate
+        self.__flow_mod_burst = flow_mod_burst
+        # dpid -> FlowModScheduler of switches 1 and 4
+        self.__schedulers = {}
+
+        # IP (from ip_to_int) -> dpid of the edge switch
+        # the host is connected to
+        self.__edges = {}
+        self.__checkpoint = None
         
         log.info("Starting unweighted diamond controller")
         
@@ -384,13 +513,83 @@ class EqualDiamondRouter (object):
         # When switches 1 and 4 come online, set up a smart controller
         # to work with them
         elif connection.dpid == 1:
-            self.__switch_1 = SmartSwitchController(connection)
+            self.__switch_1 = self.__smart_switch(connection)
         elif connection.dpid == 4:
-            self.__switch_4 = SmartSwitchController(connection)
+            self.__switch_4 = self.__smart_switch(connection)
             
         else:
             log.info("Unknown switch {} ignored".format(connection.dpid))
 
+    def __smart_switch(self, connection):
+        if not self.__checkpoint and core.hasComponent("diamond_checkpoint"):
+            # Where every host was, so routes to the other switch are
+            # known before it connects
+            self.__checkpoint = core.diamond_checkpoint
+            for (dpid, ip), mac in self.__checkpoint.hosts().items():
+                self.__edges[ip] = dpid
+        return SmartSwitchController(connection, self.__switch_ready, self.__learned,
+                                     self.__scheduler(connection), self.__checkpoint,
+                                     self.__checkpointed_routes)
+
+    def __checkpointed_routes(self, dpid):
+        """
+        Returns the (local ip, other ip, port) route rules switch 1 or 4
+        should have for the pairs routed in the checkpoint
+        """
+        routes = set()
+        if not self.__checkpoint:
+            return routes
+
+        for (a, b), (arm, uploads) in self.__checkpoint.placements().items():
+            if self.__edges.get(b) == dpid:
+                a, b = b, a
+            if self.__edges.get(a) != dpid or self.__edges.get(b) in (None, dpid):
+                continue
+
+            if dpid == 1:
+                port = 1 if arm == ARM_UP else 2
+            else:
+                port = 2 if arm == ARM_UP else 1
+            routes.add((a, b, port))
+        return routes
+
+    def __scheduler(self, connection):
+        scheduler = FlowModScheduler(connection, self.__flow_mod_rate, self.__flow_mod_burst)
+        self.__schedulers[connection.dpid] = scheduler
+        return scheduler
+
+    def flow_mod_stats(self):
+        """
+        Returns the stats of the flow mod scheduler of each
+        edge switch, by dpid
+        """
+        return dict((dpid, scheduler.stats()) for dpid, scheduler in self.__schedulers.items())
+
+    def __switch_ready(self, connection):
+        self.raiseEvent(SwitchReady, connection)
+
+    def __learned(self, ip, dpid):
+        self.__edges[ip] = dpid
+        TRACE.record(LEARN, ip, dpid)
+
+    def edge_of(self, ip):
+        """
+        Returns the dpid of the switch (1 or 4) the host with
+        the given IP address is connected to, or None
+        """
+        return self.__edges.get(ip_to_int(ip))
+
+    def mac_for(self, ip):
+        """
+        Returns the mac of the host with the given IP address if
+        switch 1 or 4 has learned it, otherwise None
+        """
+        for switch in (self.__switch_1, self.__switch_4):
+            mac = switch.mac_for(ip) if switch else None
+            if mac is not None:
+                return mac
+        return None
+
     """
     add/remove route functions are used
     to route messages between two sides of the diamond
@@ -400,64 +599,75 @@ class EqualDiamondRouter (object):
     this has not happened, the request is ignored.
     """
     
-    def __route_should_be_established(self, src_ip, dest_ip):
+    def __route_ends(self, src_ip, dest_ip):
         """
-        Checks if a route should be established; this requires
-        that both of the IP addresses are known by at least one of
-        [switch 1, switch 4] and that they are not both known by the same
-        switch (that would be a useless rule to add)
+        Returns the two IP addresses as ints, the one connected to
+        switch 1 first, if a route should be established between
+        them; this requires that both of the IP addresses are known
+        by one of [switch 1, switch 4] and that they are not both
+        known by the same switch (that would be a useless rule to add).
+        Otherwise returns None
         """
         if not self.__switch_1 or not self.__switch_4:
             log.warning("Cannot establish route: Switches not online")
-            return False
-        
-        src_learned_by = 0
-        if self.__switch_1.has_learned(src_ip):
-            src_learned_by = 1
-        elif self.__switch_4.has_learned(src_ip):
-            src_learned_by = 4
-       
-        dest_learned_by = 0
-        if self.__switch_1.has_learned(dest_ip):
-            dest_learned_by = 1
-        elif self.__switch_4.has_learned(dest_ip):
-            dest_learned_by = 4
+            return None
+
+        src_ip = ip_to_int(src_ip)
+        dest_ip = ip_to_int(dest_ip)
+        src_learned_by = self.__edges.get(src_ip)
+        dest_learned_by = self.__edges.get(dest_ip)
        
         if not src_learned_by or not dest_learned_by:
-            log.warning("Cannot establish route: {} or {} not known".format(src_ip, dest_ip))
-            return False
+            log.warning("Cannot establish route: {} or {} not known".format(int_to_ip(src_ip), int_to_ip(dest_ip)))
+            return None
               
         if src_learned_by == dest_learned_by:
-            log.info("Not going to establish route: {} and {} are attached to the same switch".format(src_ip, dest_ip))
-            return False
+            log.info("Not going to establish route: {} and {} are attached to the same switch".format(
+                int_to_ip(src_ip), int_to_ip(dest_ip)))
+            return None
             
-        return True
+        if src_learned_by == 1:
+            return src_ip, dest_ip
+        return dest_ip, src_ip
     
     def add_route_up(self, src_ip, dest_ip):
-        if self.__route_should_be_established(src_ip, dest_ip):
-            self.__switch_1.add_route(src_ip, dest_ip, 1)
-            self.__switch_4.add_route(src_ip, dest_ip, 2)
+        ends = self.__route_ends(src_ip, dest_ip)
+        if ends:
+            TRACE.record(ROUTE_ADD, ends[0], ends[1], ARM_UP)
+            self.__switch_1.add_route(ends[0], ends[1], 1)
+            self.__switch_4.add_route(ends[1], ends[0], 2)
             return True
         return False
             
     def add_route_down(self, src_ip, dest_ip):
-        if self.__route_should_be_established(src_ip, dest_ip):
-            self.__switch_1.add_route(src_ip, dest_ip, 2)
-            self.__switch_4.add_route(src_ip, dest_ip, 1)
+        ends = self.__route_ends(src_ip, dest_ip)
+        if ends:
+            TRACE.record(ROUTE_ADD, ends[0], ends[1], ARM_DOWN)
+            self.__switch_1.add_route(ends[0], ends[1], 2)
+            self.__switch_4.add_route(ends[1], ends[0], 1)
             return True
         return False
         
     def remove_route_up(self, src_ip, dest_ip):
-        if self.__route_should_be_established(src_ip, dest_ip):
-            self.__switch_1.remove_route(src_ip, dest_ip, 1)
-            self.__switch_4.remove_route(src_ip, dest_ip, 2)
+        ends = self.__route_ends(src_ip, dest_ip)
+        if ends:
+            TRACE.record(ROUTE_REMOVE, ends[0], ends[1], ARM_UP)
+            self.__switch_1.remove_route(ends[0], ends[1], 1)
+            self.__switch_4.remove_route(ends[1], ends[0], 2)
         
     def remove_route_down(self, src_ip, dest_ip):
-        if self.__route_should_be_established(src_ip, dest_ip):
-            self.__switch_1.remove_route(src_ip, dest_ip, 2)
-            self.__switch_4.remove_route(src_ip, dest_ip, 1)
+        ends = self.__route_ends(src_ip, dest_ip)
+        if ends:
+            TRACE.record(ROUTE_REMOVE, ends[0], ends[1], ARM_DOWN)
+            self.__switch_1.remove_route(ends[0], ends[1], 2)
+            self.__switch_4.remove_route(ends[1], ends[0], 1)
 
-def launch ():
-    controller = EqualDiamondRouter()
+def launch (flow_mod_rate=DEFAULT_RATE, flow_mod_burst=DEFAULT_BURST):
+    """
+    flow_mod_rate is the most flow mods a second sent to switches 1
+    and 4 after their default routes, in bursts of up to flow_mod_burst;
+    0 doesn't limit them
+    """
+    controller = EqualDiamondRouter(float(flow_mod_rate), int(flow_mod_burst))
     core.register("diamond_router", controller)
   
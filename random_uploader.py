@@ -1,238 +1,298 @@
-from sockets_lib.tcp_connection import TCPClientConnection, TCPServerConnection, TCPServer
-from sockets_lib.udp_connection import UDPPublisher
-from sockets_lib.connection import ConnectionPoller, ConnectionPollerThread, ConnectionIsClosedError
-
-from threading import Thread
-from functools import partial
-from itertools import zip_longest
-
+from sockets_lib.metrics import MetricsDumper
+from sockets_lib.tcp_pool import TCPConnectionPool
+from upload_bot.payload import PayloadPool
+from upload_bot.notifier import ConnectionNotifier
+from upload_bot.server import Server
+from upload_bot.client import Client
+from upload_bot.engine import UploadEngine
+from upload_bot.workload import Workload, PROFILES
+from upload_bot.flow_metrics import FlowRecorder
+from upload_bot.trace import TraceRecorder, ReplayWorkload
+from upload_bot.striping import split_plan, DEFAULT_STRIPE_THRESHOLD
+
+from threading import Event
+
+import os
 import time
 import signal
-import sys
-import threading
 import logging
-import random
-import json
-
-if len(sys.argv) != 7:
-    help = """Usage: python3 {} listener-ip listener-port subnet local-ip port max-ip
-
-    listener-ip     IP address of the connection state listener
-    listener-port           Port used by the connection state listener
-    subnet          First 3 numbers of IP address (e.g. 10.0.0)
-    local-ip        Last number of IP address (e.g. 4)
-    port            Port to listen on for incoming connections and to connect to
-                        for 'uploads'
-    max-ip          Highest value that any address on the subnet uses
-    
-    For example, if this device had IP address 192.168.1.3, and 
-    was connected to devices with address 192.168.1.1 - 192.168.1.10,
-    the usage would be
-        python3 {} ip port 192.168.1 3 port 10
-"""
-    print(help.format(sys.argv[0], sys.argv[0]))
-    sys.exit(1)
-
-listener_ip = sys.argv[1]
-listener_port = int(sys.argv[2])
-subnet = sys.argv[3]
-local_ip = "{}.{}".format(subnet, sys.argv[4])
-server_port = int(sys.argv[5])
-max_ip = int(sys.argv[6])
-
-root_log = logging.getLogger("app")
-logging.basicConfig(level=logging.INFO, format="%(message)s")
+import argparse
 
 log = logging.getLogger("app.random-uploads")
 
-log.info("Starting random upload bot on {}:{} talking to {}.1:{} - {}.{}:{}".format(local_ip, server_port, subnet, server_port, subnet, max_ip, server_port))
+START_TIME = time.monotonic()
 
-running = True
+# Seconds between checks for the go file
+GO_POLL_INTERVAL = 0.01
 
-clients = []
-
-def cleanup():
-    server.stop()
-    
-    for client in clients:
-        client.stop()
-        client.join()
-
-    global running
-    running = False
-
-
-def signal_handler(sig, frame):
-    cleanup()
-    time.sleep(1)
-    sys.exit(0)
+description = """Random upload bot. Runs a TCP server, and periodically uploads
+random data to the server of another bot, notifying the connection
+state listener when each upload starts and stops"""
 
+epilog = """For example, if this device had IP address 192.168.1.3, and
+was connected to devices with address 192.168.1.1 - 192.168.1.10,
+the usage would be
+    python3 random_uploader.py ip port 192.168.1 3 port 10
+"""
 
-signal.signal(signal.SIGINT, signal_handler)
 
-class ConnectionNotifier:
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("listener_ip", help="IP address of the connection state listener")
+    parser.add_argument("listener_port", type=int, help="Port used by the connection state listener")
+    parser.add_argument("subnet", help="First 3 numbers of IP address (e.g. 10.0.0)")
+    parser.add_argument("local_ip", help="Last number of IP address (e.g. 4)")
+    parser.add_argument("port", type=int,
+                        help="Port to listen on for incoming connections and to connect to for 'uploads'")
+    parser.add_argument("max_ip", type=int, help="Highest value that any address on the subnet uses")
+
+    parser.add_argument("--engine", action="store_true",
+                        help="Run all uploads on a single event loop instead of a thread per upload")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="Maximum number of uploads in progress at once, counting each stripe "
+                             "of a striped upload (default 10)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="legacy",
+                        help="Workload profile; see upload_bot/workload.py (default legacy)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for the workload and payloads, to make runs reproducible")
+    parser.add_argument("--arrival-rate", type=float, default=None,
+                        help="Override the profile with Poisson arrivals at this many uploads per second")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--bitrate", type=float, default=None,
+                        help="Override the profile to pace writes at a constant bits per second")
+    pacing.add_argument("--afap", action="store_true",
+                        help="Override the profile to write as fast as possible")
+    parser.add_argument("--backlog", type=int, default=128,
+                        help="Listen backlog of the upload server (default 128)")
+    parser.add_argument("--accept-batch", type=int, default=64,
+                        help="Maximum connections accepted per poll (default 64)")
+    parser.add_argument("--reuse-connections", action="store_true",
+                        help="Keep connections to other bots open between uploads and reuse them")
+    parser.add_argument("--idle-timeout", type=float, default=30,
+                        help="Seconds a reusable connection may stay idle before it is closed (default 30)")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="Seconds to wait after notifying the controller, for routes to be set up "
+                             "(default 1)")
+    parser.add_argument("--stripes", type=int, default=1,
+                        help="Split large uploads over this many connections (default 1, no striping)")
+    parser.add_argument("--stripe-threshold", type=int, default=DEFAULT_STRIPE_THRESHOLD,
+                        help="Uploads of at least this many bytes are striped (default {})".format(
+                            DEFAULT_STRIPE_THRESHOLD))
+    parser.add_argument("--stripe-port", type=int, default=None,
+                        help="Port to receive striped uploads on (default port + 1)")
+    parser.add_argument("--record-trace", default=None,
+                        help="Append every upload decision to this trace file")
+    parser.add_argument("--replay", default=None,
+                        help="Replay the uploads this host made in a trace instead of using a profile")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Multiply all times in a replayed trace by this; 2 replays at half speed")
+    parser.add_argument("--replay-start", type=float, default=None,
+                        help="Epoch time at which the replayed trace starts, to line up several hosts "
+                             "(default when uploads start)")
+    parser.add_argument("--ready-file", default=None,
+                        help="Once listening, register with the controller and create this file")
+    parser.add_argument("--go-file", default=None,
+                        help="Wait for this file to exist before starting any uploads")
+    parser.add_argument("--register-timeout", type=float, default=30,
+                        help="Seconds to wait for the controller to answer when registering (default 30)")
+    parser.add_argument("--flow-log", default=None,
+                        help="Append a JSON line per completed flow, and periodic summaries, to this file")
+    parser.add_argument("--summary-interval", type=float, default=10,
+                        help="Seconds between flow summaries (default 10)")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Append JSON snapshots of socket metrics to this file")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="Seconds between metrics snapshots (default 10)")
+    return parser.parse_args()
+
+
+def make_workload(args, local_ip):
+    if args.replay:
+        return ReplayWorkload(args.replay, local_ip, args.time_scale, args.replay_start)
+
+    arrivals = ("poisson", args.arrival_rate) if args.arrival_rate else None
+
+    pacing = None
+    if args.bitrate:
+        pacing = ("cbr", args.bitrate)
+    elif args.afap:
+        pacing = ("afap",)
+
+    return Workload(args.profile, args.seed, arrivals=arrivals, pacing=pacing)
+
+
+def startup_barrier(args, notifier, shutdown):
     """
-    Class to notify pox listener when connections go up/down
-    Assumed port 6634
+    Run once the server is listening: registers with the controller,
+    creates the ready file, and waits until the go file exists, so that
+    a whole network of bots can start uploading at once without
+    connecting to bots which aren't up yet
     """
-    def __init__(self):
-        self.__poller = ConnectionPoller()
-        self.__poll_thread = ConnectionPollerThread(self.__poller)
-        self.__poll_thread.start()
-        
-        self.__connection = UDPPublisher(listener_ip, listener_port, self.__closed)
-        self.__poller.add_connection(self.__connection)
-            
-    def __closed(self, socket):
-        self.__connection = None
-        self.__poll_thread.stop()
-
-    def stop(self):
-        self.__poller.close_all_connections()
-        self.__poll_thread.join()
-        
-    def send_start_connection(self, target_ip):
-        msg = {"src":local_ip, "dest":target_ip, "state":"open"}
-        self.__connection.send(json.dumps(msg).encode())  
-
-    def send_stop_connection(self, target_ip):
-        msg = {"src":local_ip, "dest":target_ip, "state":"close"}
-        self.__connection.send(json.dumps(msg).encode())  
-
-class Server:
-    def __init__(self, addr="localhost", port=9000):
-        log.info("Starting server...")
-        self.__server = TCPServer(addr, port, self.__got_connection)
-        self.__connections = []
-
-        log.debug("Starting server poller...")
-        self.__poller = ConnectionPoller()
-        self.__poll_thread = ConnectionPollerThread(self.__poller)
-        self.__poll_thread.start()
-
-    def __got_connection(self, server_socket, address):
-        log.info("New connection from" + str(address))
-
-        conn_if = TCPServerConnection(
-            server_socket, address, None, self.__connection_closed
-        )
-        self.__poller.add_connection(conn_if)
-
-    def __connection_closed(self, connection):
-        log.info("Server connection closed:" + str(connection.address()))
-        self.__poller.remove_connection(connection)
-        
-    def start(self):
-        self.__server.start()
-
-    def stop(self):
-        log.info("Stopping server")
-        self.__server.stop()
-        self.__server.join()
-        
-        log.debug("Closing connections")
-        self.__poller.close_all_connections()
-        time.sleep(1)
-        
-        log.debug("Stopping poller")
-        self.__poll_thread.stop()
-        self.__poll_thread.join()
-       
-        log.debug("Stopped")
-
-
-class Client(Thread):
-    def __init__(self, addr="localhost", port=9000, notifier=None):
-        super().__init__()
-        self.__random = random.Random()
-        self.__addr = addr
-        self.__port = port
-        self.__done = False
-        self.__notifier = connection_notifier
-        
-        global clients
-        clients.append(self)
-
-    def __closed(self, connection):
-        self.__poll_thread.stop()
-        self.__done = True
-        log.info("Client side closed; {} clients still open".format(len(clients)))
-
-    def run(self):
-        self.__shutdown = False
-
-        log.info("Starting upload to {}:{}...".format(self.__addr, self.__port))
-        try:
-            self.__poller = ConnectionPoller()
-            self.__poll_thread = ConnectionPollerThread(self.__poller)
-            self.__connection = TCPClientConnection(self.__addr, self.__port, None, self.__closed)
-
-            self.__poller.add_connection(self.__connection)
-            self.__poll_thread.start()
-
-            if self.__notifier:
-                self.__notifier.send_start_connection(self.__addr)
-                time.sleep(1)
-
-            total_bytes = 0;
-            num_writes = self.__random.randint(50, 200)
-            for i in range(num_writes):
-                if self.__shutdown:
-                    break
-                    
-                msg_len = self.__random.randint(500, 1000)
-                total_bytes = total_bytes + msg_len
-                data = "".join([str(self.__random.random()) for _ in range(msg_len)])
-
-                log.debug("Queuing message to send")
-                try:
-                    self.__connection.send(data.encode())
-                except ConnectionIsClosedError:
-                    log.warning("Server closed before client finished")
-                    break
-                
-                time.sleep(self.__random.uniform(0, 0.25))
-
-            if self.__notifier:
-                self.__notifier.send_stop_connection(self.__addr)
-                time.sleep(1)
-            
-            log.info("Uploaded {} bytes to {}:{}".format(total_bytes, self.__addr, self.__port))
-            log.debug("Closing client")
-            self.__poller.close_all_connections()
-
-        except ConnectionRefusedError:
-            log.warning("Unable to connect to {}:{}".format(self.__addr, self.__port))
-            self.__shutdown = True
-            self.__done = True
-
-    def stop(self):
-        log.info("Stopping client")
-        self.__shutdown = True
-        self.__poll_thread.join()
-
-    def done(self):
-        return self.__done
-
-server = Server(local_ip, server_port)
-server.start()
-
-connection_notifier = ConnectionNotifier()
-
-while running:
-    time.sleep(random.randint(5, 10))
-    
-    for client in clients:
-        if client.done():
+    if args.ready_file:
+        if not notifier.register(args.register_timeout, shutdown=shutdown):
+            if shutdown.is_set():
+                return
+            log.warning("No answer from the listener at {}:{}; starting anyway".format(
+                args.listener_ip, args.listener_port))
+        open(args.ready_file, "w").close()
+        log.info("Ready after {:.2f}s".format(time.monotonic() - START_TIME))
+
+    if args.go_file:
+        while not os.path.exists(args.go_file):
+            if shutdown.wait(GO_POLL_INTERVAL):
+                return
+        log.info("Starting uploads after {:.2f}s".format(time.monotonic() - START_TIME))
+
+
+def stripe_port(args):
+    if args.stripes <= 1:
+        return None
+    return args.stripe_port or args.port + 1
+
+
+def run_threaded(args, local_ip, targets, payloads, workload, recorder, shutdown, dumper):
+    server = Server(local_ip, args.port, args.backlog, args.accept_batch, recorder=recorder,
+                    stripe_port=stripe_port(args))
+    server.start()
+    if dumper:
+        dumper.add_source("server", server.poller().stats)
+
+    notifier = ConnectionNotifier(args.listener_ip, args.listener_port, local_ip)
+    startup_barrier(args, notifier, shutdown)
+    pool = TCPConnectionPool(idle_timeout=args.idle_timeout) if args.reuse_connections else None
+    if pool and dumper:
+        dumper.add_source("pool", pool.stats)
+    clients = []
+
+    while not shutdown.is_set():
+        delay = workload.next_arrival()
+        if delay is None:
+            log.info("Workload finished; no more uploads will be started")
+            shutdown.wait()
+            break
+        if shutdown.wait(delay):
+            break
+
+        for client in [c for c in clients if c.done()]:
             client.stop()
             client.join()
-            
             clients.remove(client)
-    
-    if len(clients) < 10:
-        c = Client("{}.{}".format(subnet, random.randint(1, max_ip)), server_port, connection_notifier)
-        c.start()
-    
-    
-cleanup()
+        if pool:
+            pool.expire()
+
+        plan = workload.next_plan(targets)
+        if args.stripes > 1 and plan.total_bytes() >= args.stripe_threshold:
+            new_clients = [
+                Client(stripe, stripe_port(args), notifier, payloads, args.settle, recorder=recorder,
+                       local_ip=local_ip, stripe_header=header)
+                for stripe, header in split_plan(plan, args.stripes)
+            ]
+        else:
+            new_clients = [Client(plan, args.port, notifier, payloads, args.settle, recorder=recorder,
+                                  local_ip=local_ip, pool=pool)]
+
+        # Every stripe counts against the concurrency
+        if len(clients) + len(new_clients) > args.concurrency:
+            workload.skipped(plan)
+            continue
+
+        for c in new_clients:
+            clients.append(c)
+            c.start()
 
+    server.stop()
+    for client in clients:
+        client.stop()
+        client.join()
+    if pool:
+        pool.close()
+    notifier.stop()
+
+
+def run_engine(args, local_ip, targets, payloads, workload, recorder, shutdown, stop_callbacks, dumper):
+    engine = UploadEngine(
+        local_ip, args.port, targets, payloads, workload,
+        notifier_factory=lambda poller: ConnectionNotifier(
+            args.listener_ip, args.listener_port, local_ip, poller
+        ),
+        concurrency=args.concurrency,
+        settle=args.settle,
+        backlog=args.backlog,
+        accept_batch=args.accept_batch,
+        recorder=recorder,
+        stripes=args.stripes,
+        stripe_threshold=args.stripe_threshold,
+        stripe_port=stripe_port(args),
+        reuse_connections=args.reuse_connections,
+        idle_timeout=args.idle_timeout,
+    )
+    if dumper:
+        dumper.add_source("engine", engine.stats)
+        if engine.pool():
+            dumper.add_source("pool", engine.pool().stats)
+        dumper.add_source("poller", engine.poller().stats)
+
+    # The signal handler only sets a flag; the engine
+    # notices on its next loop and shuts down cleanly
+    stop_callbacks.append(engine.stop)
+    startup_barrier(args, engine.notifier(), shutdown)
+    engine.run()
+
+
+def main():
+    args = parse_args()
+    local_ip = "{}.{}".format(args.subnet, args.local_ip)
+    targets = ["{}.{}".format(args.subnet, i) for i in range(1, args.max_ip + 1)]
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    log.info("Starting random upload bot on {}:{} talking to {}.1:{} - {}.{}:{}".format(
+        local_ip, args.port, args.subnet, args.port, args.subnet, args.max_ip, args.port))
+
+    shutdown = Event()
+    stop_callbacks = []
+
+    def signal_handler(sig, frame):
+        shutdown.set()
+        for callback in stop_callbacks:
+            callback()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    dumper = None
+    if args.metrics_file:
+        dumper = MetricsDumper(args.metrics_file, args.metrics_interval)
+        dumper.start()
+
+    payloads = PayloadPool(seed=args.seed)
+    workload = make_workload(args, local_ip)
+    if args.replay:
+        log.info("Replaying {} uploads from {}".format(len(workload), args.replay))
+    else:
+        log.info("Using workload profile {}".format(args.profile))
+
+    if args.record_trace:
+        workload = TraceRecorder(workload, args.record_trace, local_ip)
+
+    recorder = FlowRecorder(args.flow_log, args.summary_interval)
+    if dumper:
+        dumper.add_source("flows", recorder)
+
+    if args.engine:
+        run_engine(args, local_ip, targets, payloads, workload, recorder, shutdown, stop_callbacks, dumper)
+    else:
+        run_threaded(args, local_ip, targets, payloads, workload, recorder, shutdown, dumper)
+
+    recorder.close()
+    if args.record_trace:
+        workload.close()
+
+    if dumper:
+        dumper.stop()
+        dumper.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 from abc import ABC, abstractmethod
 from threading import Thread
-from select import select
 from queue import Queue
 
+import socket
+import selectors
 import threading
 import time
 import logging
 
+from .metrics import ConnectionMetrics, PollerMetrics
+
 log = logging.getLogger("app.connection.internals")
 
 
@@ -55,6 +58,14 @@ class ConnectionIf(ABC):
         """
         pass
 
+    def fileno(self):
+        """
+        Return the file descriptor of the underlying socket, or
+        None if there isn't one. Connections with a file descriptor
+        can be watched for readiness by a ConnectionPoller
+        """
+        return None
+
     def __init__(self, receive_callback = None, closed_callback = None, max_reads=None, max_writes=None):
         """
         receive_callback is function with signature void(self, data)
@@ -79,6 +90,24 @@ class ConnectionIf(ABC):
         self.__closed = False
         self.__was_closed = False
 
+        self.__poll_lock = threading.Lock()
+        self.__metrics = ConnectionMetrics()
+
+    def metrics(self):
+        """
+        Returns the ConnectionMetrics counters for this connection
+        """
+        return self.__metrics
+
+    def _measure(self, data):
+        """
+        Returns the size in bytes of a message read or
+        written, for the metrics
+        """
+        if isinstance(data, (list, tuple)):
+            return sum(len(buf) for buf in data)
+        return len(data)
+
     def close(self):
         """
         Closes the connection if it is not already closed.
@@ -99,6 +128,37 @@ class ConnectionIf(ABC):
             raise ConnectionIsClosedError
         self.__pub_queue.put(data)
 
+    def queued(self):
+        """
+        Returns the number of messages waiting to be sent
+        """
+        return self.__pub_queue.qsize() + (self.__buffer is not None)
+
+    def wants_poll(self):
+        """
+        Return true if the next poll() has work to do regardless of
+        whether the socket is readable; that is, there are messages waiting
+        to be sent or the closed_callback has not been called yet
+        """
+        return (
+            self.__buffer is not None
+            or not self.__pub_queue.empty()
+            or (self.__closed and not self.__was_closed)
+        )
+
+    def wants_write(self):
+        """
+        Return true if the connection is open and has
+        messages waiting to be sent
+        """
+        return not self.__closed and (self.__buffer is not None or not self.__pub_queue.empty())
+
+    def wait(self, timeout):
+        """
+        Block for up to timeout seconds before the next poll()
+        """
+        time.sleep(timeout)
+
     def poll(self):
         """
         Attempts to read as up to max_reads, and then attempts to write
@@ -109,13 +169,26 @@ class ConnectionIf(ABC):
 
         If the socket has been closed, the closed_callback will be called
         at the end of the poll
+
+        Returns the time, in seconds, spent in callbacks. A connection
+        is never polled by two threads at once, so it is safe to move
+        it between pollers
         """
+        with self.__poll_lock:
+            return self.__poll()
+
+    def __poll(self):
+        metrics = self.__metrics
+        trace = log.isEnabledFor(logging.DEBUG)
+
         self.__did_just_close = False
         data_read = []
-        log.debug(str(threading.get_ident()) + " :: " + "Poll socket")
+        if trace:
+            log.debug("%s :: Poll socket", threading.get_ident())
         try:
-            if not self.__was_closed and (self.__closed or not self._is_open):
-                log.debug(str(threading.get_ident()) + " :: " + "Socket just got closed")
+            if not self.__was_closed and (self.__closed or not self._is_open()):
+                if trace:
+                    log.debug("%s :: Socket just got closed", threading.get_ident())
                 self.__did_just_close = True
                 self.__closed = True
                 self.__was_closed = True
@@ -124,27 +197,25 @@ class ConnectionIf(ABC):
                 success = True
                 reads = 0
                 while success:
-                    log.debug(str(threading.get_ident()) + " :: " + "Trying to read")
                     success, data = self._read()
                     success = success and len(data) > 0
                     if success:
                         data_read.append(data)
+                        metrics.bytes_in += self._measure(data)
 
                         reads = reads + 1
                         if self.__reads is not None and reads >= self.__reads:
                             break
 
+                metrics.messages_in += reads
+                metrics.reads_per_poll.record(reads)
+
                 if self.__buffer is None and not self.__pub_queue.empty():
                     self.__buffer = self.__pub_queue.get()
 
                 messages = self.__pub_queue.qsize() + 1 if self.__buffer is not None else 0
-                log.debug(
-                    str(threading.get_ident())
-                    + " :: "
-                    + "Trying to publish "
-                    + str(messages)
-                    + " messages"
-                )
+                if trace:
+                    log.debug("%s :: Trying to publish %s messages", threading.get_ident(), messages)
 
                 # Figure out how many times to try to publish
                 publishes = messages if self.__writes is None else min(messages, self.__writes)
@@ -154,54 +225,78 @@ class ConnectionIf(ABC):
                 while publishes > 0:
                     if self._write(self.__buffer):
                         publishes = publishes - 1
+                        metrics.messages_out += 1
+                        metrics.bytes_out += self._measure(self.__buffer)
                         self.__buffer = (
                             self.__pub_queue.get() if not self.__pub_queue.empty() else None
                         )
-                        log.debug(
-                            str(threading.get_ident())
-                            + " :: "
-                            + str(self.__pub_queue.qsize())
-                            + " messages left to send"
-                        )
                     else:
                         break
+
+                metrics.queue_depth = self.__pub_queue.qsize() + (self.__buffer is not None)
         except ConnectionIsClosedError:
-            log.debug(str(threading.get_ident()) + " :: " + "Connection closed!")
+            if trace:
+                log.debug("%s :: Connection closed!", threading.get_ident())
             self.__closed = True
             self.__was_closed = True
             self.__did_just_close = True
 
-        log.debug(
-            str(threading.get_ident())
-            + " :: Handling "
-            + str(len(data_read))
-            + " messages recieved"
-        )
+        if trace:
+            log.debug("%s :: Handling %s messages recieved", threading.get_ident(), len(data_read))
+        callback_start = time.perf_counter()
         for data in data_read:
             if self.__rcv_cb:
                 self.__rcv_cb(self, data)
 
         if self.__did_just_close:
             self.__pub_queue = Queue()
-            
+            metrics.queue_depth = 0
+
             if self.__cls_cb:
                 self.__cls_cb(self)
 
+        callback_time = time.perf_counter() - callback_start
+        metrics.polls += 1
+        metrics.callback_time += callback_time
+        return callback_time
+
 
 class ConnectionPoller:
     """
     Manager for multiple connection objects. Connections
     can be added to and removed from the poller, and it will
     poll them sequentially on each poll()
+
+    If a selector (from the selectors module) is given, connections
+    which have a fileno() are registered with it, and only those
+    which are readable or have work queued are polled. Connections
+    without a fileno() are polled every time. While a connection has
+    messages queued, it is also watched for being writable, so wait()
+    neither spins on a full socket buffer nor sleeps past the point
+    where it drains. Another thread which queues a message can call
+    wake() to end a wait() early
     """
 
-    def __init__(self):
+    def __init__(self, selector=None):
         self.__connections = set()
         self.__adds = set()
         self.__removes = set()
         self.__lock = threading.Lock()
         self.__update = False
 
+        self.__selector = selector
+        self.__unselectable = set()
+        self.__writers = set()
+
+        self.__waker = None
+        if selector is not None:
+            self.__waker = socket.socketpair()
+            for end in self.__waker:
+                end.setblocking(False)
+            selector.register(self.__waker[0], selectors.EVENT_READ)
+
+        self.__metrics = PollerMetrics()
+
     def size(self):
         with self.__lock:
             return len(self.__connections) + len(self.__adds) - len(self.__removes)
@@ -223,18 +318,141 @@ class ConnectionPoller:
         for connection_if in self.__connections:
             connection_if.close()
 
+    def metrics(self):
+        """
+        Returns the PollerMetrics counters for this poller
+        """
+        return self.__metrics
+
+    def stats(self):
+        """
+        Returns a snapshot of the metrics of this poller; the number of
+        connections, the number of polls, the mean and max time
+        spent in a poll() and the total time spent in callbacks
+        """
+        return self.__metrics.snapshot()
+
+    def connection_stats(self):
+        """
+        Returns a list with a metrics snapshot of each connection
+        """
+        return [connection_if.metrics().snapshot() for connection_if in list(self.__connections)]
+
+    def wake(self):
+        """
+        Ends the current or next wait() early; call after sending
+        on a connection from a thread other than the polling one
+        """
+        if self.__waker is not None:
+            try:
+                self.__waker[1].send(b"\0")
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        Releases the sockets used by wake()
+        """
+        if self.__waker is not None:
+            self.__selector.unregister(self.__waker[0])
+            for end in self.__waker:
+                end.close()
+            self.__waker = None
+
+    def wait(self, timeout):
+        """
+        Block for up to timeout seconds, or until one of the
+        connections is readable if there is a selector
+        """
+        if self.__selector is None:
+            time.sleep(timeout)
+            return
+
+        writers = set()
+        for connection_if in self.__connections:
+            if connection_if.wants_write() and connection_if not in self.__unselectable:
+                writers.add(connection_if)
+            elif connection_if.wants_poll():
+                return
+
+        self.__watch_writes(writers)
+        self.__selector.select(timeout)
+
+    def __watch_writes(self, writers):
+        changes = (
+            (writers - self.__writers, selectors.EVENT_READ | selectors.EVENT_WRITE),
+            (self.__writers - writers, selectors.EVENT_READ),
+        )
+        for connections, events in changes:
+            for connection_if in connections:
+                try:
+                    self.__selector.modify(connection_if, events)
+                except (KeyError, ValueError, OSError):
+                    pass
+        self.__writers = writers
+
+    def __apply_updates(self):
+        with self.__lock:
+            log.debug("%s :: Updating connections to poll", threading.get_ident())
+            if self.__selector is not None:
+                for connection_if in self.__removes:
+                    if connection_if in self.__unselectable:
+                        self.__unselectable.discard(connection_if)
+                    else:
+                        try:
+                            self.__selector.unregister(connection_if)
+                        except (KeyError, ValueError):
+                            pass
+                    self.__writers.discard(connection_if)
+
+                for connection_if in self.__adds - self.__connections:
+                    try:
+                        if connection_if.fileno() is None:
+                            raise ValueError
+                        self.__selector.register(connection_if, selectors.EVENT_READ)
+                    except (KeyError, ValueError):
+                        self.__unselectable.add(connection_if)
+
+            self.__connections -= self.__removes
+            self.__connections |= self.__adds
+            self.__removes.clear()
+            self.__adds.clear()
+            self.__update = False
+            self.__metrics.connections = len(self.__connections)
+
+    def __to_poll(self):
+        if self.__selector is None:
+            return self.__connections
+
+        to_poll = set(key.fileobj for key, _ in self.__selector.select(0))
+        if self.__waker is not None and self.__waker[0] in to_poll:
+            to_poll.discard(self.__waker[0])
+            try:
+                while self.__waker[0].recv(4096):
+                    pass
+            except OSError:
+                pass
+        to_poll |= self.__unselectable
+        to_poll.update(c for c in self.__connections if c.wants_poll())
+        return to_poll
+
     def poll(self):
+        poll_start = time.perf_counter()
+
         if self.__update:
-            with self.__lock:
-                log.debug(str(threading.get_ident()) + " :: " + "Updating connections to poll")
-                self.__connections -= self.__removes
-                self.__connections |= self.__adds
-                self.__removes.clear()
-                self.__adds.clear()
-                self.__update = False
+            self.__apply_updates()
 
-        for connection_if in self.__connections:
-            connection_if.poll()
+        callback_time = 0.0
+        to_poll = self.__to_poll()
+        for connection_if in to_poll:
+            callback_time += connection_if.poll()
+
+        metrics = self.__metrics
+        metrics.polls += 1
+        metrics.connections_polled += len(to_poll)
+        metrics.callback_time += callback_time
+        metrics.poll_time.record(time.perf_counter() - poll_start)
+        return callback_time
 
 
 class ConnectionPollerThread(Thread):
@@ -256,12 +474,129 @@ class ConnectionPollerThread(Thread):
         return self.__shutdown
 
     def run(self):
-        log.debug(str(threading.get_ident()) + " :: Started Thread")
+        log.debug("%s :: Started Thread", threading.get_ident())
         while not self.__shutdown:
             self.__pollable.poll()
-            log.debug(
-                str(threading.get_ident()) + " :: " + "Sleeping for " + str(self.__sleep_time)
-            )
-            time.sleep(self.__sleep_time)
+            self.__pollable.wait(self.__sleep_time)
+
+
+
+class ConnectionPollerPool:
+    """
+    Spreads connections across a number of ConnectionPollers, each
+    polled on its own ConnectionPollerThread and with its own selector,
+    so that a slow callback on one connection only delays the
+    connections that share its shard
+
+    Connections are assigned to shards by hashing their fileno() (or
+    the object itself if there is none). Since hashing only balances
+    the adds, the shards are rebalanced after removals if the largest has
+    more than rebalance_threshold connections over the smallest
+    """
 
+    def __init__(self, shards=4, poll_rate=10, rebalance_threshold=4, use_selectors=True):
+        self.__lock = threading.Lock()
+        self.__threshold = rebalance_threshold
+
+        self.__pollers = [
+            ConnectionPoller(selectors.DefaultSelector() if use_selectors else None)
+            for _ in range(shards)
+        ]
+        self.__threads = [ConnectionPollerThread(poller, poll_rate) for poller in self.__pollers]
+
+        # Connections in each shard, and the shard of each connection
+        self.__shards = [set() for _ in range(shards)]
+        self.__assignments = {}
+
+    def start(self):
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self.__threads:
+            thread.stop()
 
+    def join(self):
+        for thread in self.__threads:
+            thread.join()
+        for poller in self.__pollers:
+            poller.close()
+
+    def size(self):
+        with self.__lock:
+            return len(self.__assignments)
+
+    def __shard_for(self, connection_if):
+        fileno = connection_if.fileno()
+        key = hash(connection_if) if fileno is None else fileno
+        return key % len(self.__pollers)
+
+    def add_connection(self, connection_if):
+        with self.__lock:
+            if connection_if in self.__assignments:
+                return
+
+            shard = self.__shard_for(connection_if)
+            self.__assignments[connection_if] = shard
+            self.__shards[shard].add(connection_if)
+            self.__pollers[shard].add_connection(connection_if)
+
+    def remove_connection(self, connection_if):
+        with self.__lock:
+            shard = self.__assignments.pop(connection_if, None)
+            if shard is None:
+                return
+
+            self.__shards[shard].discard(connection_if)
+            self.__pollers[shard].remove_connection(connection_if)
+            self.__rebalance(False)
+
+    def close_all_connections(self):
+        with self.__lock:
+            connections = list(self.__assignments)
+
+        for connection_if in connections:
+            connection_if.close()
+
+    def rebalance(self, force=True):
+        """
+        Moves connections from the largest shards to the smallest
+        until they differ by at most one, or, if force is False, only
+        if they differ by more than the rebalance threshold.
+
+        Returns the number of connections moved
+        """
+        with self.__lock:
+            return self.__rebalance(force)
+
+    def __rebalance(self, force):
+        sizes = [len(shard) for shard in self.__shards]
+        if not force and max(sizes) - min(sizes) <= self.__threshold:
+            return 0
+
+        moved = 0
+        while True:
+            largest = max(range(len(sizes)), key=sizes.__getitem__)
+            smallest = min(range(len(sizes)), key=sizes.__getitem__)
+            if sizes[largest] - sizes[smallest] <= 1:
+                break
+
+            connection_if = self.__shards[largest].pop()
+            self.__pollers[largest].remove_connection(connection_if)
+            self.__pollers[smallest].add_connection(connection_if)
+            self.__shards[smallest].add(connection_if)
+            self.__assignments[connection_if] = smallest
+
+            sizes[largest] -= 1
+            sizes[smallest] += 1
+            moved += 1
+
+        if moved:
+            log.debug("Rebalanced %s connections; shard sizes %s", moved, sizes)
+        return moved
+
+    def stats(self):
+        """
+        Returns a list with the stats() of each shard's poller
+        """
+        return [poller.stats() for poller in self.__pollers]
@@ -0,0 +1,229 @@
+"""
+Length-prefixed message framing for stream connections
+
+TCP delivers a stream of bytes, not messages, so a receive_callback
+on a TCPConnection sees arbitrary fragments of whatever was sent.
+Prefixing each message with its length lets the receiving side cut
+the stream back into the original messages (frames).
+
+Usage:
+
+    framing = VarintFraming()
+    decoder = FrameDecoder(frame_callback, framing)
+    connection = TCPClientConnection(address, port, decoder)
+
+    connection.send(framing.encode(payload))
+
+The encoder never copies the payload; encode() returns the header and
+payload as separate buffers, which TCPConnection writes with a single
+scatter-gather sendmsg(). The decoder keeps received data in a ring
+buffer, so each byte is copied in once and out once no matter how
+the frames are fragmented.
+"""
+
+import struct
+
+
+class FramingError(Exception):
+    """
+    Exception raised when a frame header is malformed or
+    announces a frame larger than the maximum frame size.
+    If this is raised, the stream cannot be resynchronized
+    """
+
+    pass
+
+
+class FixedLengthFraming:
+    """
+    Frames prefixed with an unsigned big-endian length of
+    width 1, 2, 4 or 8 bytes
+    """
+
+    __formats = {1: "!B", 2: "!H", 4: "!I", 8: "!Q"}
+
+    def __init__(self, width=4, max_frame_size=16 * 1024 * 1024):
+        if width not in self.__formats:
+            raise ValueError("Unsupported length width " + str(width))
+
+        self.__struct = struct.Struct(self.__formats[width])
+        self.__max = min(max_frame_size, (1 << (8 * width)) - 1)
+        self.max_header_size = width
+
+    def header(self, length):
+        if length > self.__max:
+            raise FramingError("Frame of " + str(length) + " bytes is too large")
+        return self.__struct.pack(length)
+
+    def parse_header(self, data):
+        """
+        Parse a header from the start of data. Returns (length, header size)
+        or None if data does not hold a complete header yet
+        """
+        if len(data) < self.max_header_size:
+            return None
+
+        length, = self.__struct.unpack_from(data)
+        if length > self.__max:
+            raise FramingError("Frame of " + str(length) + " bytes is too large")
+        return length, self.max_header_size
+
+    def encode(self, payload):
+        """
+        Returns (header, payload) to be sent as one message
+        """
+        return (self.header(len(payload)), payload)
+
+    def encode_batch(self, payloads):
+        """
+        Returns a list of buffers to send several frames in one write
+        """
+        buffers = []
+        for payload in payloads:
+            buffers.append(self.header(len(payload)))
+            buffers.append(payload)
+        return buffers
+
+
+class VarintFraming(FixedLengthFraming):
+    """
+    Frames prefixed with an unsigned LEB128 varint length, so
+    small frames only pay one or two bytes of header
+    """
+
+    def __init__(self, max_frame_size=16 * 1024 * 1024):
+        self.__max = max_frame_size
+        self.max_header_size = 10
+
+    def header(self, length):
+        if length > self.__max:
+            raise FramingError("Frame of " + str(length) + " bytes is too large")
+
+        header = bytearray()
+        while length >= 0x80:
+            header.append((length & 0x7F) | 0x80)
+            length >>= 7
+        header.append(length)
+        return bytes(header)
+
+    def parse_header(self, data):
+        length = 0
+        for i, byte in enumerate(data[:self.max_header_size]):
+            length |= (byte & 0x7F) << (7 * i)
+            if not byte & 0x80:
+                if length > self.__max:
+                    raise FramingError("Frame of " + str(length) + " bytes is too large")
+                return length, i + 1
+
+        if len(data) >= self.max_header_size:
+            raise FramingError("Unterminated length prefix")
+        return None
+
+
+class RingBuffer:
+    """
+    Byte FIFO on a circular bytearray. The capacity doubles
+    when a write doesn't fit, so it settles at the size of the
+    largest backlog instead of growing with the stream
+    """
+
+    def __init__(self, capacity=4096):
+        self.__buffer = bytearray(capacity)
+        self.__head = 0
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    def __grow(self, needed):
+        capacity = len(self.__buffer)
+        while capacity < needed:
+            capacity *= 2
+
+        data = self.peek(self.__size)
+        self.__buffer = bytearray(capacity)
+        self.__buffer[:len(data)] = data
+        self.__head = 0
+
+    def write(self, data):
+        count = len(data)
+        if self.__size + count > len(self.__buffer):
+            self.__grow(self.__size + count)
+
+        capacity = len(self.__buffer)
+        tail = (self.__head + self.__size) % capacity
+        first = min(count, capacity - tail)
+        self.__buffer[tail:tail + first] = data[:first]
+        if first < count:
+            self.__buffer[:count - first] = data[first:]
+        self.__size += count
+
+    def peek(self, count):
+        """
+        Returns a copy of up to count bytes from the front of the buffer
+        """
+        count = min(count, self.__size)
+        end = self.__head + count
+        if end <= len(self.__buffer):
+            return bytes(self.__buffer[self.__head:end])
+        return bytes(self.__buffer[self.__head:]) + bytes(self.__buffer[:end - len(self.__buffer)])
+
+    def skip(self, count):
+        count = min(count, self.__size)
+        self.__size -= count
+        self.__head = (self.__head + count) % len(self.__buffer) if self.__size else 0
+
+    def read(self, count):
+        data = self.peek(count)
+        self.skip(len(data))
+        return data
+
+
+class FrameDecoder:
+    """
+    Incremental frame decoder. Data from a stream is given to
+    feed(), which returns every frame completed by it.
+
+    If frame_callback is given, the decoder can be used directly
+    as the receive_callback of a connection; it will call
+    frame_callback(connection, frame) for each complete frame
+    """
+
+    def __init__(self, frame_callback=None, framing=None):
+        self.__cb = frame_callback
+        self.__framing = framing if framing is not None else VarintFraming()
+        self.__ring = RingBuffer()
+        self.__length = None
+
+    def pending(self):
+        """
+        Returns the number of bytes received but not yet part of a frame
+        """
+        return len(self.__ring)
+
+    def feed(self, data):
+        self.__ring.write(data)
+
+        frames = []
+        while True:
+            if self.__length is None:
+                header = self.__framing.parse_header(
+                    self.__ring.peek(self.__framing.max_header_size)
+                )
+                if header is None:
+                    break
+
+                self.__length, header_size = header
+                self.__ring.skip(header_size)
+
+            if len(self.__ring) < self.__length:
+                break
+
+            frames.append(self.__ring.read(self.__length))
+            self.__length = None
+
+        return frames
+
+    def __call__(self, connection, data):
+        for frame in self.feed(data):
+            self.__cb(connection, frame)
@@ -0,0 +1,169 @@
+"""
+Counters and histograms for connections and pollers
+
+Every ConnectionIf and ConnectionPoller keeps one of these, available
+through metrics(). Updating them is a handful of integer and float
+additions per poll; nothing is formatted until snapshot() is called.
+
+snapshot() returns plain dicts and lists which can be given straight
+to json.dumps(). MetricsDumper writes snapshots of any number of
+sources to a file as JSON lines on a fixed interval.
+"""
+
+from threading import Thread, Event
+
+import math
+import json
+import time
+import logging
+
+log = logging.getLogger("app.connection.metrics")
+
+
+class Histogram:
+    """
+    Histogram with power-of-two bucket boundaries. Bucket i counts values
+    up to base * 2**i; the last bucket also counts everything larger
+    """
+
+    def __init__(self, base=1e-6, buckets=32):
+        self.__base = base
+        self.__buckets = [0] * buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+        if value <= self.__base:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(value / self.__base)
+            index = exponent - 1 if mantissa == 0.5 else exponent
+        self.__buckets[min(index, len(self.__buckets) - 1)] += 1
+
+    def snapshot(self):
+        """
+        Returns count, sum, mean and max, and the non-empty
+        buckets as [upper bound, count] pairs
+        """
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "buckets": [
+                [self.__base * 2 ** i, count] for i, count in enumerate(self.__buckets) if count
+            ],
+        }
+
+
+class ConnectionMetrics:
+    """
+    Counters for a single connection
+    """
+
+    __slots__ = [
+        "bytes_in", "bytes_out", "messages_in", "messages_out",
+        "polls", "queue_depth", "callback_time", "reads_per_poll",
+    ]
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.polls = 0
+        self.queue_depth = 0
+        self.callback_time = 0.0
+        self.reads_per_poll = Histogram(base=1, buckets=16)
+
+    def snapshot(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "polls": self.polls,
+            "queue_depth": self.queue_depth,
+            "callback_time": self.callback_time,
+            "reads_per_poll": self.reads_per_poll.snapshot(),
+        }
+
+
+class PollerMetrics:
+    """
+    Counters for a ConnectionPoller; poll_time is the
+    duration of each poll() including callbacks
+    """
+
+    __slots__ = ["connections", "polls", "connections_polled", "callback_time", "poll_time"]
+
+    def __init__(self):
+        self.connections = 0
+        self.polls = 0
+        self.connections_polled = 0
+        self.callback_time = 0.0
+        self.poll_time = Histogram()
+
+    def snapshot(self):
+        poll_time = self.poll_time.snapshot()
+        return {
+            "connections": self.connections,
+            "polls": self.polls,
+            "connections_polled": self.connections_polled,
+            "mean_poll_time": poll_time["mean"],
+            "max_poll_time": poll_time["max"],
+            "callback_time": self.callback_time,
+            "poll_time": poll_time,
+        }
+
+
+class MetricsDumper(Thread):
+    """
+    Thread to append a JSON line with snapshots of all of its
+    sources to a file every interval seconds
+
+    Sources are added with add_source(name, source), where source is
+    anything with a snapshot() method, or a function returning
+    something JSON serializable
+    """
+
+    def __init__(self, path, interval=10):
+        super().__init__(daemon=True)
+        self.__path = path
+        self.__interval = interval
+        self.__sources = {}
+        self.__stop = Event()
+
+    def add_source(self, name, source):
+        self.__sources[name] = source
+
+    def remove_source(self, name):
+        self.__sources.pop(name, None)
+
+    def snapshot(self):
+        snapshot = {"time": time.time()}
+        for name, source in list(self.__sources.items()):
+            snapshot[name] = source.snapshot() if hasattr(source, "snapshot") else source()
+        return snapshot
+
+    def dump(self):
+        with open(self.__path, "a") as out:
+            out.write(json.dumps(self.snapshot()) + "\n")
+
+    def stop(self):
+        self.__stop.set()
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            stopped = self.__stop.wait(self.__interval)
+            try:
+                self.dump()
+            except OSError as err:
+                log.warning("Unable to write metrics to {}: {}".format(self.__path, err))
@@ -1,41 +1,146 @@
 from .connection import ConnectionIf, ConnectionIsClosedError
 
+import os
+import errno
 import socket
-import threading
+import struct
 import logging
 
+from collections import deque
+from itertools import islice
 from socket import socket as make_socket
-from threading import Thread
+
+try:
+    from fcntl import ioctl
+    from termios import TIOCOUTQ
+except ImportError:
+    ioctl = TIOCOUTQ = None
 
 log = logging.getLogger("app.connection.tcp")
 
+# Max buffers per sendmsg(); IOV_MAX on Linux
+_MAX_BUFFERS = 1024
+
 
 class TCPConnection(ConnectionIf):
     """
     Specialization on ConnectionIf for TCP connections
     Will set the socket to be non-blocking on instantiation
+
+    Messages may be a bytes-like object, or a list or tuple of them which
+    will be sent back to back with scatter-gather IO (see framing.py).
+    If a message doesn't fit in the socket buffer, the rest of it is
+    sent on the following polls
+
+    If connecting is true, the socket's connect is still in progress;
+    messages are queued until it completes, and the connection is
+    watched for being writable so a poller finishes it as soon as it can
     """
 
-    def __init__(self, raw_socket, receive_callback, close_callback):
+    def __init__(self, raw_socket, receive_callback, close_callback, connecting=False):
         super().__init__(receive_callback, close_callback)
         self.__socket = raw_socket
         self.__socket.setblocking(0)
         self.__open = True
+        self.__connecting = connecting
+
+        # Unsent part of the message currently being written
+        self.__pending = deque()
+        self.__pending_message = None
 
     def _is_open(self):
         return self.__open
 
+    def fileno(self):
+        return self.__socket.fileno()
+
+    def local_address(self):
+        return self.__socket.getsockname()
+
+    def connecting(self):
+        """
+        Returns true if the connect has not completed (or failed) yet
+        """
+        return self.__connecting
+
+    def wants_write(self):
+        return (self.__connecting and self.__open) or super().wants_write()
+
+    def __connected(self):
+        """
+        Returns true once the connect has completed; raises
+        ConnectionIsClosedError if it failed
+        """
+        err = self.__socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if not err:
+            try:
+                self.__socket.getpeername()
+                self.__connecting = False
+                return True
+            except OSError as peer_err:
+                if peer_err.errno == errno.ENOTCONN:
+                    return False
+                err = peer_err.errno
+
+        self.__open = False
+        log.debug("Failed to connect; raising from " + os.strerror(err))
+        raise ConnectionIsClosedError
+
+    def unacknowledged(self):
+        """
+        Returns the number of bytes handed to the socket which the
+        other side hasn't acknowledged yet (SIOCOUTQ), or 0 if the
+        connection is closed or the platform can't tell
+        """
+        if not self.__open or ioctl is None:
+            return 0
+
+        try:
+            return struct.unpack("i", ioctl(self.__socket.fileno(), TIOCOUTQ, b"\0" * 4))[0]
+        except OSError:
+            return 0
+
+    def delivered(self):
+        """
+        Returns true once every message sent has been written and
+        acknowledged by the other side
+        """
+        return not self.queued() and not self.unacknowledged()
+
+    def healthy(self):
+        """
+        Returns true if the connection is open, and the other side has
+        neither closed it nor sent anything that is still unread; for
+        checking an idle connection before reusing it
+        """
+        if not self.__open:
+            return False
+
+        try:
+            self.__socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
     def _close(self):
-        self.__socket.shutdown(socket.SHUT_RDWR)
+        try:
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Never connected
+            pass
         self.__socket.close()
         self.__open = False
 
     def _read(self):
         if not self.__open:
             raise ConnectionIsClosedError
+        if self.__connecting and not self.__connected():
+            return False, ""
 
         try:
-            return True, self.__socket.recv(2048)
+            data = self.__socket.recv(2048)
         except BlockingIOError:
             return False, ""
         except OSError as err:
@@ -43,32 +148,81 @@ class TCPConnection(ConnectionIf):
             log.debug("Failed to read; raising from" + str(err))
             raise ConnectionIsClosedError
 
+        # An empty read means the other side has closed
+        if not data:
+            self.__socket.close()
+            self.__open = False
+            raise ConnectionIsClosedError
+        return True, data
+
     def _write(self, data):
         if not self.__open:
             raise ConnectionIsClosedError
+        if self.__connecting and not self.__connected():
+            return False
+
+        # A message that was partially sent is retried with
+        # the same object, so pick up where it left off
+        if self.__pending_message is not data:
+            buffers = data if isinstance(data, (list, tuple)) else (data,)
+            self.__pending = deque(memoryview(buf) for buf in buffers if len(buf))
+            self.__pending_message = data
 
         try:
-            self.__socket.sendall(data)
-            return True
+            while self.__pending:
+                sent = self.__socket.sendmsg(islice(self.__pending, _MAX_BUFFERS))
+                self.__consume(sent)
+        except BlockingIOError:
+            return False
         except OSError as err:
             self.__open = False
             log.debug("Failed to write; raising from" + str(err))
             raise ConnectionIsClosedError 
 
+        self.__pending_message = None
+        return True
+
+    def __consume(self, sent):
+        while sent:
+            first = self.__pending[0]
+            if sent < len(first):
+                self.__pending[0] = first[sent:]
+                return
+            sent -= len(first)
+            self.__pending.popleft()
+
 
 class TCPClientConnection(TCPConnection):
     """
     TCP Client connection - instantiates a raw socket and connects
     to the given address/port
+
+    connect_timeout limits how long the connect may block; socket.timeout
+    is raised if it expires. A connect_timeout of 0 doesn't block at all:
+    the connect completes on a later poll (see connecting()), and a failed
+    one closes the connection
     """
 
-    def __init__(self, dest_address, dest_port, receive_callback = None, close_callback = None):
+    def __init__(self, dest_address, dest_port, receive_callback = None, close_callback = None,
+                 connect_timeout = None):
         raw_socket = make_socket(socket.AF_INET, socket.SOCK_STREAM)
-        raw_socket.connect((dest_address, dest_port))
+        raw_socket.settimeout(connect_timeout)
+        connecting = False
+        try:
+            if connect_timeout == 0:
+                err = raw_socket.connect_ex((dest_address, dest_port))
+                if err not in (0, errno.EINPROGRESS):
+                    raise OSError(err, os.strerror(err))
+                connecting = err != 0
+            else:
+                raw_socket.connect((dest_address, dest_port))
+        except OSError:
+            raw_socket.close()
+            raise
 
         self.__address = (dest_address, dest_port)
 
-        super().__init__(raw_socket, receive_callback, close_callback)
+        super().__init__(raw_socket, receive_callback, close_callback, connecting)
 
     def address(self):
         return self.__address
@@ -88,41 +242,67 @@ class TCPServerConnection(TCPConnection):
         return self.__address
 
 
-class TCPServer(Thread):
+class TCPServer(ConnectionIf):
     """
-    Thread to listen on a TCP socket for incomming connections
+    Non-blocking listening TCP socket. Add it to a ConnectionPoller
+    like any other connection; each poll accepts up to accept_batch
+    pending connections and calls connect_callback(socket, address)
+    for each of them
+
+    backlog is the size of the listen queue used by the OS for connections
+    that have not been accepted yet
     """
 
-    def __init__(self, local_address, local_port, connect_callback, max_connections=1):
-        super().__init__()
+    def __init__(self, local_address, local_port, connect_callback,
+                 backlog=socket.SOMAXCONN, accept_batch=64):
+        super().__init__(self.__accepted, None, max_reads=accept_batch)
 
         self.__server_socket = make_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.__server_socket.bind((local_address, local_port))
-        self.__server_socket.listen(max_connections)
-        self.__shutdown = False
+        self.__server_socket.listen(backlog)
+        self.__server_socket.setblocking(0)
+        self.__open = True
         self.__cb = connect_callback
-        
+
         self.__address = local_address
         self.__port = local_port
 
-    def stop(self):
-        self.__shutdown = True
-        
-        # Open connection to unblock socket accept()
-        dummy = TCPClientConnection(self.__address, self.__port)
-        dummy.close()
-        
-        self.__server_socket.shutdown(socket.SHUT_RDWR)
+    def address(self):
+        return (self.__address, self.__port)
+
+    def fileno(self):
+        return self.__server_socket.fileno()
+
+    def _is_open(self):
+        return self.__open
+
+    def _close(self):
+        self.__open = False
         self.__server_socket.close()
 
-    def run(self):
-        log.debug(str(threading.get_ident()) + " :: Started Thread")
-        while not self.__shutdown:
-            try:
-                server_socket, address = self.__server_socket.accept()
-                if not self.__shutdown:
-                    self.__cb(server_socket, address)
-            except OSError:
-                pass
+    def _read(self):
+        if not self.__open:
+            raise ConnectionIsClosedError
+
+        try:
+            return True, self.__server_socket.accept()
+        except BlockingIOError:
+            return False, None
+        except ConnectionAbortedError:
+            # Client gave up before it was accepted
+            return False, None
+        except OSError as err:
+            self.__open = False
+            log.debug("Failed to accept; raising from" + str(err))
+            raise ConnectionIsClosedError
+
+    def _write(self, data):
+        return False
+
+    def _measure(self, data):
+        return 0
 
+    def __accepted(self, connection, accepted):
+        server_socket, address = accepted
+        self.__cb(server_socket, address)
@@ -0,0 +1,154 @@
+from .tcp_connection import TCPClientConnection
+from .connection import ConnectionPoller, ConnectionPollerThread
+
+from collections import defaultdict, deque
+from threading import Lock
+
+import time
+import logging
+import selectors
+
+log = logging.getLogger("app.connection.pool")
+
+
+class TCPConnectionPool:
+    """
+    Pool of idle TCP client connections, keyed by destination address
+    and port, so repeated transfers to the same peer skip the handshake
+    and slow start
+
+    acquire() hands out an idle connection to the destination if there
+    is a healthy one, or else connects a new one; release() gives it back
+    once the caller is done with it. Up to max_idle connections are kept
+    per destination, each for up to idle_timeout seconds.
+
+    All connections are polled by the given poller; otherwise the pool
+    runs its own selector-backed poller on its own thread. While a
+    connection is handed out, its close is reported to the close_callback
+    given to acquire()
+    """
+
+    def __init__(self, poller=None, idle_timeout=30.0, max_idle=4, connect_timeout=None):
+        self.__idle_timeout = idle_timeout
+        self.__max_idle = max_idle
+        self.__connect_timeout = connect_timeout
+
+        self.__poll_thread = None
+        if poller is None:
+            poller = ConnectionPoller(selectors.DefaultSelector())
+            self.__poll_thread = ConnectionPollerThread(poller)
+            self.__poll_thread.start()
+        self.__poller = poller
+
+        self.__lock = Lock()
+        # (address, port) -> deque of (connection, time released)
+        self.__idle = defaultdict(deque)
+        # Connection -> close callback of whoever has acquired it
+        self.__owners = {}
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__expired = 0
+        self.__unhealthy = 0
+
+    def poller(self):
+        return self.__poller
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "idle": sum(len(idle) for idle in self.__idle.values()),
+                "in_use": len(self.__owners),
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "expired": self.__expired,
+                "unhealthy": self.__unhealthy,
+            }
+
+    def acquire(self, address, port, close_callback=None):
+        """
+        Returns an open connection to address:port. Raises OSError
+        (or socket.timeout) if a new connection can't be made; with a
+        connect_timeout of 0, a new one may still be connecting
+        """
+        self.expire()
+
+        with self.__lock:
+            idle = self.__idle.get((address, port))
+            while idle:
+                connection, _ = idle.pop()
+                if connection.healthy():
+                    self.__hits += 1
+                    self.__owners[connection] = close_callback
+                    return connection
+
+                self.__unhealthy += 1
+                self.__poller.remove_connection(connection)
+                connection.close()
+            self.__misses += 1
+
+        connection = TCPClientConnection(
+            address, port, None, self.__closed, self.__connect_timeout
+        )
+        with self.__lock:
+            self.__owners[connection] = close_callback
+        self.__poller.add_connection(connection)
+        return connection
+
+    def release(self, connection):
+        """
+        Returns an acquired connection to the pool, or closes it if
+        it isn't fit to be reused
+        """
+        with self.__lock:
+            self.__owners.pop(connection, None)
+            idle = self.__idle[connection.address()]
+            if connection.queued() or not connection.healthy() or len(idle) >= self.__max_idle:
+                connection.close()
+                return
+            idle.append((connection, time.monotonic()))
+
+    def expire(self):
+        """
+        Closes connections which have been idle for too long
+        """
+        cutoff = time.monotonic() - self.__idle_timeout
+        with self.__lock:
+            for idle in self.__idle.values():
+                while idle and idle[0][1] < cutoff:
+                    connection, _ = idle.popleft()
+                    self.__expired += 1
+                    connection.close()
+
+    def __closed(self, connection):
+        self.__poller.remove_connection(connection)
+        with self.__lock:
+            callback = self.__owners.pop(connection, None)
+            idle = self.__idle.get(connection.address())
+            if idle:
+                for entry in list(idle):
+                    if entry[0] is connection:
+                        idle.remove(entry)
+
+        if callback:
+            callback(connection)
+
+    def close(self):
+        """
+        Closes every connection, idle or not
+        """
+        with self.__lock:
+            connections = list(self.__owners)
+            for idle in self.__idle.values():
+                connections.extend(connection for connection, _ in idle)
+                idle.clear()
+
+        for connection in connections:
+            connection.close()
+
+        if self.__poll_thread:
+            # Let the closed callbacks run before stopping
+            time.sleep(0.1)
+            self.__poll_thread.stop()
+            self.__poll_thread.join()
+            self.__poller.close()
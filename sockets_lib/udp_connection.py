@@ -1,11 +1,9 @@
 from .connection import ConnectionIf, ConnectionIsClosedError
 
 import socket
-import threading
 import logging
 
 from socket import socket as make_socket
-from threading import Thread
 
 log = logging.getLogger("app.connection.udp")
 
@@ -14,9 +12,14 @@ class UDPPublisher(ConnectionIf):
     """
     Specialization on ConnectionIf for UDP connections
     Will set the socket to be non-blocking on instantiation
+
+    If connected is true, the socket is connect()ed to the destination
+    once so that each datagram is sent without an address lookup, and
+    send_now() can be used to send on the calling thread instead of
+    waiting for the next poll
     """
 
-    def __init__(self, address, port, close_callback=None):
+    def __init__(self, address, port, close_callback=None, connected=False):
         super().__init__(None, close_callback)
         self.__socket = make_socket(type=socket.SOCK_DGRAM)
         self.__socket.setblocking(0)
@@ -24,29 +27,84 @@ class UDPPublisher(ConnectionIf):
         self.__address = address
         self.__port = port
 
+        self.__connected = connected
+        if connected:
+            self.__socket.connect((address, port))
+
     def _is_open(self):
         return self.__open
 
+    def fileno(self):
+        return self.__socket.fileno()
+
     def _close(self):
-        self.__socket.shutdown(socket.SHUT_RDWR)
+        # No shutdown(); it fails with ENOTCONN on an unconnected
+        # datagram socket and there is no stream to end anyway
         self.__socket.close()
         self.__open = False
 
 
     def _read(self):
+        # Nothing is expected back, but a connected socket is left
+        # readable by ICMP port unreachable until the error is read,
+        # so whatever is there is read and dropped
+        if not self.__open:
+            raise ConnectionIsClosedError
+
+        try:
+            self.__socket.recv(65535)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+        except OSError as err:
+            self.__open = False
+            log.debug("Failed to read; raising from" + str(err))
+            raise ConnectionIsClosedError
         return False, ""
 
     def _write(self, data):
         if not self.__open:
             raise ConnectionIsClosedError
 
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sending on UDP %s", data)
+
         try:
-            log.info("Sending on UDP {}".format(data.decode()))
-            self.__socket.sendto(data, (self.__address, self.__port))
-            return True
+            return self.__send(data)
+        except ConnectionRefusedError:
+            # A connected socket reports ICMP port unreachable for an
+            # earlier datagram from the next send, which clears the
+            # error without sending; that one is lost, this one isn't
+            try:
+                return self.__send(data)
+            except ConnectionRefusedError:
+                return False
         except OSError as err:
             self.__open = False
             log.debug("Failed to write; raising from" + str(err))
-            raise ConnectionIsClosedError 
+            raise ConnectionIsClosedError
+
+    def __send(self, data):
+        try:
+            if self.__connected:
+                self.__socket.send(data)
+            else:
+                self.__socket.sendto(data, (self.__address, self.__port))
+            return True
+        except BlockingIOError:
+            return False
+
+    def send_now(self, data):
+        """
+        Sends a message immediately on the calling thread. If it
+        can't be sent right away, or earlier messages are still queued,
+        it is queued for the next poll() so messages stay in order
 
+        raises ConnectionIsClosedError if the connection has been closed
+        """
+        if self.queued() or not self._write(data):
+            self.send(data)
+            return
 
+        metrics = self.metrics()
+        metrics.messages_out += 1
+        metrics.bytes_out += self._measure(data)
@@ -0,0 +1,143 @@
+from sockets_lib.tcp_connection import TCPClientConnection
+from sockets_lib.connection import ConnectionPoller, ConnectionPollerThread, ConnectionIsClosedError
+
+from threading import Thread
+
+import time
+import logging
+import selectors
+
+log = logging.getLogger("app.random-uploads")
+
+# Writes queued on the connection before the client waits for
+# it to drain, so unpaced uploads don't buffer their whole flow.
+# Writes are views of the shared payload pool, so this costs no copies
+MAX_QUEUED_WRITES = 32
+BACKPRESSURE_DELAY = 0.005
+
+
+class Client(Thread):
+    """
+    Thread which makes a single upload to another bot, as described
+    by an UploadPlan, with its own connection poller, notifying the
+    controller before and after
+
+    If stripe_header is given, the upload is one stripe of a striped
+    upload (see striping.py); the header is sent ahead of the writes,
+    and the notifications carry the connection's ports
+
+    If a TCPConnectionPool is given, the upload borrows a connection
+    from it, and its poller, and returns the connection afterwards; the
+    notifications then mark the start and end of the upload rather than
+    of the connection. Stripes are never pooled
+    """
+
+    def __init__(self, plan, port=9000, notifier=None, payloads=None, settle=1.0,
+                 recorder=None, local_ip=None, stripe_header=None, pool=None):
+        super().__init__()
+        self.__stripe_header = stripe_header
+        self.__pool = pool if stripe_header is None else None
+        self.__plan = plan
+        self.__recorder = recorder
+        self.__local_ip = local_ip
+        self.__addr = plan.target
+        self.__port = port
+        self.__done = False
+        self.__shutdown = False
+        self.__notifier = notifier
+        self.__payloads = payloads
+        self.__settle = settle
+        self.__poll_thread = None
+
+    def __closed(self, connection):
+        if self.__poll_thread:
+            self.__poll_thread.stop()
+        self.__done = True
+        log.info("Client side closed")
+
+    def run(self):
+        log.info("Starting upload to {}:{}...".format(self.__addr, self.__port))
+        try:
+            if self.__pool:
+                self.__poller = self.__pool.poller()
+                self.__connection = self.__pool.acquire(self.__addr, self.__port, self.__closed)
+            else:
+                self.__poller = ConnectionPoller(selectors.DefaultSelector())
+                self.__connection = TCPClientConnection(self.__addr, self.__port, None, self.__closed)
+
+                self.__poll_thread = ConnectionPollerThread(self.__poller)
+                self.__poller.add_connection(self.__connection)
+                self.__poll_thread.start()
+
+            ports = None
+            if self.__stripe_header is not None:
+                ports = (self.__connection.local_address()[1], self.__port)
+                self.__connection.send(self.__stripe_header)
+                self.__poller.wake()
+
+            if self.__notifier:
+                self.__notifier.send_start_connection(self.__addr, ports, self.__plan.total_bytes())
+                time.sleep(self.__settle)
+
+            start = time.time()
+            start_monotonic = time.monotonic()
+            total_bytes = 0
+            for size, gap in zip(self.__plan.writes, self.__plan.gaps):
+                if self.__shutdown:
+                    break
+
+                data = self.__payloads.get(size)
+                total_bytes = total_bytes + len(data)
+
+                log.debug("Queuing message to send")
+                try:
+                    self.__connection.send(data)
+                    self.__poller.wake()
+                except ConnectionIsClosedError:
+                    log.warning("Server closed before client finished")
+                    break
+
+                if gap:
+                    time.sleep(gap)
+
+                while (self.__connection.queued() >= MAX_QUEUED_WRITES
+                       and not self.__shutdown and not self.__done):
+                    time.sleep(BACKPRESSURE_DELAY)
+
+            # The flow is complete once the server has acknowledged
+            # every byte, not when the last one is handed to the socket
+            while not self.__connection.delivered() and not self.__shutdown and not self.__done:
+                time.sleep(BACKPRESSURE_DELAY)
+
+            if self.__recorder:
+                self.__recorder.record(
+                    "client" if ports is None else "client-stripe", self.__local_ip, self.__addr, start,
+                    time.monotonic() - start_monotonic, total_bytes
+                )
+
+            if self.__notifier:
+                self.__notifier.send_stop_connection(self.__addr, ports, total_bytes)
+                time.sleep(self.__settle)
+
+            log.info("Uploaded {} bytes to {}:{}".format(total_bytes, self.__addr, self.__port))
+            if self.__pool:
+                self.__pool.release(self.__connection)
+                self.__done = True
+            else:
+                log.debug("Closing client")
+                self.__poller.close_all_connections()
+
+        except ConnectionRefusedError:
+            log.warning("Unable to connect to {}:{}".format(self.__addr, self.__port))
+            self.__shutdown = True
+            self.__done = True
+
+    def stop(self):
+        log.info("Stopping client")
+        self.__shutdown = True
+        if self.__poll_thread is not None:
+            self.__poll_thread.join()
+            self.__poller.close()
+
+    def done(self):
+        return self.__done
@@ -0,0 +1,330 @@
+"""
+Single-threaded upload engine
+
+Instead of a thread (and a poller thread) per upload, the engine runs
+the server sink, the controller notifier and every upload on one
+selector-backed ConnectionPoller. Uploads are small state machines
+driven by a timer heap, so hundreds of them can run concurrently
+without running out of threads.
+"""
+
+from sockets_lib.tcp_connection import TCPClientConnection
+from sockets_lib.tcp_pool import TCPConnectionPool
+from sockets_lib.connection import ConnectionPoller, ConnectionIsClosedError
+
+from .server import Server
+from .striping import split_plan, DEFAULT_STRIPE_THRESHOLD
+
+from itertools import count
+
+import time
+import heapq
+import logging
+import selectors
+
+log = logging.getLogger("app.random-uploads.engine")
+
+# Writes queued on a connection before an upload waits for it
+# to drain, so unpaced uploads don't buffer their whole flow.
+# Writes are views of the shared payload pool, so this costs no copies
+MAX_QUEUED_WRITES = 32
+BACKPRESSURE_DELAY = 0.005
+
+
+class _Upload:
+    """
+    State of one upload in the engine
+    """
+
+    __slots__ = ["target", "port", "ports", "pooled", "connection", "plan", "next_write", "bytes",
+                 "finished", "start", "start_monotonic"]
+
+    def __init__(self, connection, plan, port, ports, pooled):
+        self.target = plan.target
+        self.port = port
+        self.ports = ports
+        self.pooled = pooled
+        self.connection = connection
+        self.plan = plan
+        self.next_write = 0
+        self.bytes = 0
+        self.finished = False
+        self.start = None
+        self.start_monotonic = None
+
+
+class UploadEngine:
+    """
+    Event loop running a server sink and uploads to random targets.
+
+    Uploads arrive as drawn from the workload, and as long as fewer
+    than concurrency are in progress, each one connects to the target
+    of its plan, notifies the controller, sends the planned writes
+    with the planned gaps, and notifies the controller again
+    before closing.
+
+    If stripes is more than 1, uploads of at least stripe_threshold
+    bytes are split over that many connections to stripe_port, where
+    the server's StripedSink reassembles them.
+
+    If reuse_connections is set, uploads (other than stripes) borrow
+    idle connections to their target from a TCPConnectionPool and give
+    them back when done, instead of connecting and closing every time.
+
+    Connects don't block the loop; writes queue until the connection
+    is established, and an upload whose connect hasn't completed within
+    connect_timeout seconds fails.
+
+    run() blocks until stop() is called, from any thread
+    or a signal handler
+    """
+
+    def __init__(self, local_ip, server_port, targets, payloads, workload, notifier_factory=None,
+                 concurrency=100, settle=1.0, backlog=128, accept_batch=64,
+                 connect_timeout=5.0, max_wait=0.1, recorder=None, stripes=1,
+                 stripe_threshold=DEFAULT_STRIPE_THRESHOLD, stripe_port=None,
+                 reuse_connections=False, idle_timeout=30.0):
+        self.__local_ip = local_ip
+        self.__recorder = recorder
+        self.__port = server_port
+        self.__targets = targets
+        self.__payloads = payloads
+        self.__workload = workload
+        self.__concurrency = concurrency
+        self.__settle = settle
+        self.__connect_timeout = connect_timeout
+        self.__max_wait = max_wait
+        self.__stripes = stripes
+        self.__stripe_threshold = stripe_threshold
+        self.__stripe_port = stripe_port
+
+        self.__poller = ConnectionPoller(selectors.DefaultSelector())
+        self.__server = Server(
+            local_ip, server_port, backlog, accept_batch, poller=self.__poller, recorder=recorder,
+            stripe_port=stripe_port
+        )
+        self.__notifier = notifier_factory(self.__poller) if notifier_factory else None
+
+        self.__idle_timeout = idle_timeout
+        self.__pool = None
+        if reuse_connections:
+            self.__pool = TCPConnectionPool(self.__poller, idle_timeout, connect_timeout=0)
+
+        self.__timers = []
+        self.__sequence = count()
+        self.__uploads = {}
+        self.__shutdown = False
+
+        self.__started = 0
+        self.__completed = 0
+        self.__failed = 0
+        self.__skipped = 0
+
+    def poller(self):
+        return self.__poller
+
+    def pool(self):
+        return self.__pool
+
+    def notifier(self):
+        return self.__notifier
+
+    def stats(self):
+        return {
+            "active": len(self.__uploads),
+            "started": self.__started,
+            "completed": self.__completed,
+            "failed": self.__failed,
+            "skipped": self.__skipped,
+        }
+
+    def stop(self):
+        self.__shutdown = True
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls callback(*args) on the engine thread after delay seconds
+        """
+        heapq.heappush(self.__timers, (time.monotonic() + delay, next(self.__sequence), callback, args))
+
+    def __run_timers(self):
+        now = time.monotonic()
+        while self.__timers and self.__timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.__timers)
+            callback(*args)
+
+    def __next_wait(self):
+        if not self.__timers:
+            return self.__max_wait
+        return max(0, min(self.__max_wait, self.__timers[0][0] - time.monotonic()))
+
+    def __arrival(self):
+        # The plan is drawn even if it is skipped, so the
+        # sequence of uploads doesn't depend on timing
+        plan = self.__workload.next_plan(self.__targets)
+        stripes = None
+        if self.__stripes > 1 and plan.total_bytes() >= self.__stripe_threshold:
+            stripes = split_plan(plan, self.__stripes)
+
+        # Every stripe counts against the concurrency
+        if len(self.__uploads) + (len(stripes) if stripes else 1) > self.__concurrency:
+            self.__skipped += 1
+            self.__workload.skipped(plan)
+        elif stripes:
+            for stripe, header in stripes:
+                self.start_upload(stripe, self.__stripe_port, header)
+        else:
+            self.start_upload(plan)
+
+        self.__schedule_arrival()
+
+    def __schedule_arrival(self):
+        delay = self.__workload.next_arrival()
+        if delay is None:
+            log.info("Workload finished; no more uploads will be started")
+        else:
+            self.schedule(delay, self.__arrival)
+
+    def start_upload(self, plan, port=None, stripe_header=None):
+        """
+        Starts an upload following the given UploadPlan, to the server port
+        unless another port is given. If stripe_header is given, the upload
+        is one stripe of a striped upload (see striping.py)
+        """
+        target = plan.target
+        port = port or self.__port
+        log.info("Starting upload to {}:{}...".format(target, port))
+        pooled = self.__pool is not None and stripe_header is None
+        try:
+            if pooled:
+                connection = self.__pool.acquire(target, port, self.__closed)
+            else:
+                connection = TCPClientConnection(target, port, None, self.__closed, 0)
+        except OSError as err:
+            log.warning("Unable to connect to {}:{}: {}".format(target, port, err))
+            self.__failed += 1
+            return
+
+        ports = None
+        if stripe_header is not None:
+            ports = (connection.local_address()[1], port)
+            connection.send(stripe_header)
+
+        upload = _Upload(connection, plan, port, ports, pooled)
+        self.__uploads[connection] = upload
+        self.__poller.add_connection(connection)
+        self.__started += 1
+        if connection.connecting():
+            self.schedule(self.__connect_timeout, self.__connect_expired, upload)
+
+        if self.__notifier:
+            self.__notifier.send_start_connection(target, ports, plan.total_bytes())
+            self.schedule(self.__settle, self.__write, upload)
+        else:
+            self.__write(upload)
+
+    def __connect_expired(self, upload):
+        if not upload.finished and upload.connection.connecting():
+            log.warning("Timed out connecting to {}:{}".format(upload.target, upload.port))
+            upload.connection.close()
+
+    def __write(self, upload):
+        if upload.finished:
+            return
+
+        plan = upload.plan
+        if upload.start is None:
+            upload.start = time.time()
+            upload.start_monotonic = time.monotonic()
+
+        if upload.next_write == len(plan.writes):
+            # The flow is complete once the server has acknowledged
+            # every byte, not when the last one is handed to the socket
+            if not upload.connection.delivered():
+                self.schedule(BACKPRESSURE_DELAY, self.__write, upload)
+                return
+
+            if self.__recorder:
+                self.__recorder.record(
+                    "client" if upload.ports is None else "client-stripe", self.__local_ip, upload.target, upload.start,
+                    time.monotonic() - upload.start_monotonic, upload.bytes
+                )
+            self.__end(upload)
+            return
+
+        if upload.connection.queued() >= MAX_QUEUED_WRITES:
+            self.schedule(BACKPRESSURE_DELAY, self.__write, upload)
+            return
+
+        data = self.__payloads.get(plan.writes[upload.next_write])
+        try:
+            upload.connection.send(data)
+        except ConnectionIsClosedError:
+            return
+
+        upload.bytes += len(data)
+        upload.next_write += 1
+        self.schedule(plan.gaps[upload.next_write - 1], self.__write, upload)
+
+    def __end(self, upload):
+        upload.finished = True
+        if self.__notifier:
+            self.__notifier.send_stop_connection(upload.target, upload.ports, upload.bytes)
+            self.schedule(self.__settle, self.__finish, upload)
+        else:
+            self.__finish(upload)
+
+    def __finish(self, upload):
+        log.info("Uploaded {} bytes to {}:{}".format(upload.bytes, upload.target, upload.port))
+        self.__completed += 1
+        if upload.pooled:
+            self.__uploads.pop(upload.connection, None)
+            self.__pool.release(upload.connection)
+        else:
+            upload.connection.close()
+
+    def __expire_idle(self):
+        self.__pool.expire()
+        self.schedule(self.__idle_timeout / 2, self.__expire_idle)
+
+    def __closed(self, connection):
+        self.__poller.remove_connection(connection)
+        upload = self.__uploads.pop(connection, None)
+        if upload is not None and not upload.finished:
+            if connection.connecting():
+                log.warning("Unable to connect to {}:{}".format(upload.target, upload.port))
+            else:
+                log.warning("Server closed before client finished")
+            self.__failed += 1
+            upload.finished = True
+            if self.__notifier and not self.__shutdown:
+                self.__notifier.send_stop_connection(upload.target, upload.ports, upload.bytes)
+
+    def run(self):
+        self.__server.start()
+        self.__schedule_arrival()
+        if self.__pool:
+            self.schedule(self.__idle_timeout / 2, self.__expire_idle)
+
+        while not self.__shutdown:
+            self.__poller.poll()
+            self.__run_timers()
+            self.__poller.wait(self.__next_wait())
+
+        log.info("Stopping engine; {} uploads in progress".format(len(self.__uploads)))
+        for upload in list(self.__uploads.values()):
+            if not upload.finished:
+                upload.finished = True
+                if self.__notifier:
+                    self.__notifier.send_stop_connection(upload.target, upload.ports, upload.bytes)
+            upload.connection.close()
+
+        if self.__pool:
+            self.__pool.close()
+        self.__server.stop()
+        if self.__notifier:
+            self.__notifier.stop()
+
+        # Run the closed callbacks
+        self.__poller.poll()
+        log.info("Engine stopped: {}".format(self.stats()))
@@ -0,0 +1,158 @@
+"""
+Per-flow measurements for the upload bot
+
+Both ends of every upload record when it started and ended and how
+many bytes it carried. From those come the flow completion time (FCT)
+and goodput of each flow, which are what a balancing policy is judged
+on. A client's flow runs until the server has acknowledged its last
+byte, so bytes still sitting in the socket buffers don't count as sent;
+a server's runs from its first received byte to its last. A flow the
+server got in a single read can't be timed, so its fct and goodput are
+null and it is left out of the FCT percentiles.
+
+Records are written as JSON lines, one per flow:
+
+    {"type": "flow", "side": "client", "src": ..., "dest": ...,
+     "start": epoch seconds, "fct": seconds, "bytes": n, "goodput": bytes/s}
+
+and every summary_interval seconds, whether or not any flows completed,
+a summary per side of the flows completed since the last one:
+
+    {"type": "summary", "side": "client", "time": ..., "interval": seconds,
+     "flows": n, "fct_p50": ..., "fct_p99": ..., "throughput": bytes/s}
+
+Clients and servers see the same bytes from opposite ends, so their
+flows are never summarized together.
+
+The mininet runner, which runs on python 2, imports percentile from
+here, so this module has to stay importable there.
+"""
+
+from threading import Event, Lock, Thread
+
+import json
+import time
+import logging
+
+log = logging.getLogger("app.random-uploads.flows")
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class _Window:
+    """
+    Flows completed on one side since the last summary
+    """
+
+    def __init__(self):
+        self.fcts = []
+        self.flows = 0
+        self.bytes = 0
+
+
+class FlowRecorder:
+    """
+    Collects completed flows and writes them to path, if given, along
+    with a summary every summary_interval seconds from a background
+    thread. Safe to use from several threads
+    """
+
+    def __init__(self, path=None, summary_interval=10):
+        self.__lock = Lock()
+        self.__out = open(path, "a") if path else None
+        self.__interval = summary_interval
+
+        self.__window_start = time.time()
+        self.__windows = {"client": _Window(), "server": _Window()}
+
+        self.__flows = 0
+        self.__total_bytes = 0
+
+        self.__stop = Event()
+        self.__thread = None
+        if summary_interval > 0:
+            self.__thread = Thread(target=self.__run)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def record(self, side, src, dest, start, duration, size):
+        """
+        Records a flow from src to dest, seen from the given side ("client",
+        "server", ...), which started at epoch time start, lasted duration
+        seconds and carried size bytes. duration is None if the flow was
+        too short to time
+        """
+        goodput = size / duration if duration else None
+        with self.__lock:
+            window = self.__windows.get(side)
+            if window is None:
+                window = self.__windows[side] = _Window()
+            if duration:
+                window.fcts.append(duration)
+            window.flows += 1
+            window.bytes += size
+            self.__flows += 1
+            self.__total_bytes += size
+
+            if self.__out:
+                self.__out.write(json.dumps({
+                    "type": "flow", "side": side, "src": src, "dest": dest,
+                    "start": start, "fct": duration or None, "bytes": size, "goodput": goodput,
+                }) + "\n")
+
+    def __run(self):
+        while not self.__stop.wait(self.__interval):
+            with self.__lock:
+                self.__summarize()
+
+    def __summarize(self):
+        now = time.time()
+        interval = now - self.__window_start
+
+        for side in sorted(self.__windows):
+            window = self.__windows[side]
+            fcts = sorted(window.fcts)
+            summary = {
+                "type": "summary", "side": side, "time": now, "interval": interval,
+                "flows": window.flows, "fct_p50": percentile(fcts, 50), "fct_p99": percentile(fcts, 99),
+                "throughput": window.bytes / interval if interval > 0 else 0.0,
+            }
+
+            if self.__out:
+                self.__out.write(json.dumps(summary) + "\n")
+
+            if fcts:
+                log.info("{} {} flows in {:.1f}s; FCT p50 {:.3f}s p99 {:.3f}s; {:.0f} bytes/s".format(
+                    window.flows, side, interval, summary["fct_p50"], summary["fct_p99"],
+                    summary["throughput"]))
+            elif window.flows:
+                log.info("{} {} flows in {:.1f}s; {:.0f} bytes/s".format(
+                    window.flows, side, interval, summary["throughput"]))
+
+            self.__windows[side] = _Window()
+
+        if self.__out:
+            self.__out.flush()
+        self.__window_start = now
+
+    def snapshot(self):
+        with self.__lock:
+            return {"flows": self.__flows, "bytes": self.__total_bytes}
+
+    def close(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+
+        with self.__lock:
+            self.__summarize()
+            if self.__out:
+                self.__out.close()
+                self.__out = None
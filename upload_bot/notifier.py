@@ -0,0 +1,102 @@
+from sockets_lib.udp_connection import UDPPublisher
+from sockets_lib.connection import ConnectionPoller, ConnectionPollerThread, ConnectionIsClosedError
+
+import json
+import time
+import socket
+import logging
+
+log = logging.getLogger("app.random-uploads")
+
+
+class ConnectionNotifier:
+    """
+    Class to notify pox listener when connections go up/down
+
+    Notifications are sent immediately on the calling thread. If a
+    poller is given, the UDP socket is added to it for anything that
+    has to be queued; otherwise the notifier polls it on its own thread
+    """
+
+    def __init__(self, listener_ip, listener_port, local_ip, poller=None):
+        self.__local_ip = local_ip
+        self.__listener = (listener_ip, listener_port)
+        self.__poll_thread = None
+
+        if poller is None:
+            poller = ConnectionPoller()
+            self.__poll_thread = ConnectionPollerThread(poller)
+            self.__poll_thread.start()
+        self.__poller = poller
+
+        self.__connection = UDPPublisher(listener_ip, listener_port, self.__closed, connected=True)
+        self.__poller.add_connection(self.__connection)
+
+    def __closed(self, connection):
+        self.__poller.remove_connection(connection)
+        if self.__poll_thread:
+            self.__poll_thread.stop()
+
+    def stop(self):
+        self.__connection.close()
+        if self.__poll_thread:
+            self.__poll_thread.join()
+
+    def __send(self, msg):
+        try:
+            self.__connection.send_now(json.dumps(msg).encode())
+        except ConnectionIsClosedError:
+            log.warning("Notifier closed; dropping {} notification".format(msg["state"]))
+
+    def __message(self, target_ip, state, ports, size):
+        msg = {"src": self.__local_ip, "dest": target_ip, "state": state}
+        if ports is not None:
+            msg["sport"], msg["dport"] = ports
+        if size is not None:
+            msg["bytes"] = size
+        return msg
+
+    def register(self, timeout=30.0, retry=0.5, shutdown=None):
+        """
+        Says hello to the listener every retry seconds until it answers,
+        so the bot knows the controller hears its notifications. Blocks
+        the calling thread; returns false if there was no answer within
+        timeout seconds, or if the shutdown Event, if given, was set
+        """
+        hello = json.dumps({"src": self.__local_ip, "state": "hello"}).encode()
+        deadline = time.monotonic() + timeout
+
+        with socket.socket(type=socket.SOCK_DGRAM) as sock:
+            sock.connect(self.__listener)
+            while time.monotonic() < deadline and not (shutdown and shutdown.is_set()):
+                sock.settimeout(max(0.001, min(retry, deadline - time.monotonic())))
+                try:
+                    sock.send(hello)
+                    if json.loads(sock.recv(2048).decode()).get("state") == "ack":
+                        return True
+                except socket.timeout:
+                    pass
+                except (ConnectionRefusedError, ValueError):
+                    # Listener isn't up yet (or answered garbage)
+                    delay = min(retry, max(0, deadline - time.monotonic()))
+                    if shutdown:
+                        shutdown.wait(delay)
+                    else:
+                        time.sleep(delay)
+        return False
+
+    def send_start_connection(self, target_ip, ports=None, size=None):
+        """
+        Notifies that an upload to target_ip is starting; ports may be the
+        (source, destination) ports of its connection, so the controller
+        can tell apart several connections between the same hosts, and
+        size the number of bytes it is expected to send
+        """
+        self.__send(self.__message(target_ip, "open", ports, size))
+
+    def send_stop_connection(self, target_ip, ports=None, size=None):
+        """
+        Notifies that an upload to target_ip has ended, after
+        sending size bytes
+        """
+        self.__send(self.__message(target_ip, "close", ports, size))
@@ -0,0 +1,63 @@
+"""
+Payload source for the upload bot
+
+Building each message out of random floats made the bot CPU-bound
+long before the link was, so uploads now send slices of one large
+buffer of random bytes which is filled once at startup.
+"""
+
+import os
+import random
+
+# Each write used to be randint(500, 1000) str(random.random()) values,
+# which average a little over 18 characters each
+DEFAULT_MIN_SIZE = 500 * 18
+DEFAULT_MAX_SIZE = 1000 * 18
+
+
+class PayloadPool:
+    """
+    Buffer of random bytes which hands out memoryview slices of it.
+
+    The buffer is filled from os.urandom, or from a generator with the given
+    seed so runs can be reproduced. next_size() draws a write size uniformly
+    from [min_size, max_size], and get(size) returns that many bytes from a
+    random offset in the buffer without copying them
+    """
+
+    def __init__(self, buffer_size=4 * 1024 * 1024, seed=None,
+                 min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE):
+        if max_size > buffer_size:
+            raise ValueError("max_size {} is larger than the buffer".format(max_size))
+
+        self.__random = random.Random(seed)
+        if seed is None:
+            self.__buffer = os.urandom(buffer_size)
+        else:
+            self.__buffer = self.__random.getrandbits(8 * buffer_size).to_bytes(buffer_size, "little")
+
+        self.__view = memoryview(self.__buffer)
+        self.__min = min_size
+        self.__max = max_size
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def next_size(self):
+        return self.__random.randint(self.__min, self.__max)
+
+    def get(self, size=None):
+        """
+        Returns a read-only memoryview of size bytes, or
+        of next_size() bytes if size is not given
+        """
+        if size is None:
+            size = self.next_size()
+
+        # Sizes larger than the buffer are served by repeating it
+        if size > len(self.__buffer):
+            repeats = size // len(self.__buffer) + 1
+            return memoryview(self.__buffer * repeats)[:size]
+
+        offset = self.__random.randint(0, len(self.__buffer) - size)
+        return self.__view[offset:offset + size]
@@ -0,0 +1,110 @@
+from sockets_lib.tcp_connection import TCPServerConnection, TCPServer
+from sockets_lib.connection import ConnectionPollerPool
+
+from .striping import StripedSink
+
+import time
+import logging
+
+log = logging.getLogger("app.random-uploads")
+
+
+class Server:
+    """
+    Sink for uploads from other bots; accepts connections and
+    discards whatever they send
+
+    If a poller is given, the listening socket and all connections
+    are added to it; otherwise the server runs its own ConnectionPollerPool
+
+    If a FlowRecorder is given, each connection is recorded as a flow
+    when it closes, lasting from its first to its last received byte,
+    with the byte count from the connection's metrics. A connection
+    reused by several uploads (see TCPConnectionPool) is one flow here
+
+    If stripe_port is given, a StripedSink on that port, sharing the
+    server's poller, reassembles striped uploads
+    """
+
+    def __init__(self, addr="localhost", port=9000, backlog=128, accept_batch=64, poller=None,
+                 recorder=None, stripe_port=None):
+        log.info("Starting server...")
+        self.__server = TCPServer(addr, port, self.__got_connection, backlog, accept_batch)
+        self.__addr = addr
+        self.__recorder = recorder
+
+        # Connection -> [wall clock and monotonic time it was accepted,
+        #                monotonic time of the first and last data]
+        self.__connections = {}
+
+        self.__owns_poller = poller is None
+        if self.__owns_poller:
+            log.debug("Starting server pollers...")
+            poller = ConnectionPollerPool()
+            poller.start()
+        self.__poller = poller
+
+        self.__sink = None
+        if stripe_port is not None:
+            self.__sink = StripedSink(addr, stripe_port, poller, recorder, backlog, accept_batch)
+
+    def __got_connection(self, server_socket, address):
+        log.info("New connection from" + str(address))
+
+        conn_if = TCPServerConnection(
+            server_socket, address,
+            self.__received if self.__recorder else None,
+            self.__connection_closed
+        )
+        self.__connections[conn_if] = [time.time(), time.monotonic(), None, None]
+        self.__poller.add_connection(conn_if)
+
+    def __received(self, connection, data):
+        times = self.__connections.get(connection)
+        if times is not None:
+            now = time.monotonic()
+            if times[2] is None:
+                times[2] = now
+            times[3] = now
+
+    def __connection_closed(self, connection):
+        log.info("Server connection closed:" + str(connection.address()))
+        times = self.__connections.pop(connection, None)
+        self.__poller.remove_connection(connection)
+
+        if self.__recorder and times and times[2] is not None:
+            accepted, accepted_monotonic, first, last = times
+            self.__recorder.record(
+                "server", connection.address()[0], self.__addr,
+                accepted + (first - accepted_monotonic), last - first if last > first else None,
+                connection.metrics().bytes_in
+            )
+
+    def poller(self):
+        return self.__poller
+
+    def start(self):
+        self.__poller.add_connection(self.__server)
+        if self.__sink:
+            self.__sink.start()
+
+    def stop(self):
+        log.info("Stopping server")
+        self.__poller.remove_connection(self.__server)
+        self.__server.close()
+        if self.__sink:
+            self.__sink.stop()
+
+        log.debug("Closing connections")
+        for connection in list(self.__connections):
+            connection.close()
+
+        if self.__owns_poller:
+            # Give the pollers a chance to run the closed callbacks
+            time.sleep(1)
+
+            log.debug("Stopping pollers")
+            self.__poller.stop()
+            self.__poller.join()
+
+        log.debug("Stopped")
@@ -0,0 +1,250 @@
+"""
+Striped uploads
+
+A large upload on one TCP stream is pinned to one arm of the diamond
+when routes are placed per host pair. Striping splits the upload into
+contiguous byte ranges and sends each range on its own sub-connection.
+Each one gets its own ephemeral source port from the OS, so a
+controller balancing per flow could spread a single transfer over
+both arms.
+
+Each sub-connection starts with a length-prefixed header frame
+
+    upload id (16 bytes), stripe index, stripe count, offset, length
+
+followed by the raw data of its range. The StripedSink on the receiving
+bot tracks which ranges of each upload have arrived and records the
+upload as a single flow once every stripe is complete.
+"""
+
+from sockets_lib.tcp_connection import TCPServerConnection, TCPServer
+from sockets_lib.framing import FixedLengthFraming
+
+from .workload import UploadPlan, MB
+
+from threading import Lock
+
+import os
+import time
+import struct
+import logging
+
+log = logging.getLogger("app.random-uploads.striping")
+
+# Uploads smaller than this are not worth striping
+DEFAULT_STRIPE_THRESHOLD = 4 * MB
+
+# Seconds an upload whose stripes have all closed waits for the rest
+# of them before it is given up on as incomplete
+INCOMPLETE_TIMEOUT = 30
+
+STRIPE_HEADER = struct.Struct("!16sHHQQ")
+_framing = FixedLengthFraming(2)
+
+
+def split_plan(plan, stripes):
+    """
+    Splits an UploadPlan into up to stripes plans of consecutive writes
+    with about the same number of bytes each. Returns a list of
+    (plan, header) where header must be sent before the plan's writes
+    """
+    upload_id = os.urandom(16)
+    total = plan.total_bytes()
+
+    groups = [[]]
+    sent = 0
+    for size, gap in zip(plan.writes, plan.gaps):
+        if sent >= total * len(groups) / stripes and len(groups) < stripes:
+            groups.append([])
+        groups[-1].append((size, gap))
+        sent += size
+
+    parts = []
+    offset = 0
+    for index, group in enumerate(groups):
+        writes = [size for size, _ in group]
+        length = sum(writes)
+        header = STRIPE_HEADER.pack(upload_id, index, len(groups), offset, length)
+        parts.append((
+            UploadPlan(plan.target, writes, [gap for _, gap in group]),
+            b"".join(_framing.encode(header)),
+        ))
+        offset += length
+    return parts
+
+
+class _Transfer:
+    """
+    Reassembly state of one striped upload
+    """
+
+    __slots__ = ["source", "stripes", "ranges", "received", "first", "last", "start", "open", "idle_since"]
+
+    def __init__(self, source, stripes):
+        self.source = source
+        self.stripes = stripes
+        self.ranges = {}
+        self.received = 0
+        self.first = None
+        self.last = None
+        self.start = None
+        # Stripes connected and not closed yet, and since when there
+        # have been none while some are still missing
+        self.open = 0
+        self.idle_since = None
+
+
+class _Stream:
+    """
+    State of one sub-connection; the start of the data until
+    the header has arrived, then the transfer it belongs to
+    """
+
+    __slots__ = ["head", "transfer", "stripe", "bytes"]
+
+    def __init__(self):
+        self.head = bytearray()
+        self.transfer = None
+        self.stripe = None
+        self.bytes = 0
+
+
+class StripedSink:
+    """
+    Sink for striped uploads. Accepts sub-connections on its own port,
+    and once all stripes of an upload have closed, checks that each
+    delivered its whole range and records the upload as one flow
+    ("server-striped") lasting from the first to the last byte of any
+    stripe. Stripes may be polled on different threads of a
+    ConnectionPollerPool, so the reassembly state is locked
+
+    An upload some of whose stripes never arrive (they failed to connect,
+    or never sent their header) is given up on, and logged as incomplete,
+    once none of its stripes have been open for INCOMPLETE_TIMEOUT seconds
+    """
+
+    def __init__(self, addr, port, poller, recorder=None, backlog=128, accept_batch=64):
+        self.__server = TCPServer(addr, port, self.__got_connection, backlog, accept_batch)
+        self.__addr = addr
+        self.__poller = poller
+        self.__recorder = recorder
+
+        self.__lock = Lock()
+        self.__streams = {}
+        self.__transfers = {}
+
+    def start(self):
+        self.__poller.add_connection(self.__server)
+
+    def stop(self):
+        self.__poller.remove_connection(self.__server)
+        self.__server.close()
+        with self.__lock:
+            connections = list(self.__streams)
+        for connection in connections:
+            connection.close()
+
+    def __got_connection(self, server_socket, address):
+        connection = TCPServerConnection(server_socket, address, self.__received, self.__closed)
+        with self.__lock:
+            self.__streams[connection] = _Stream()
+        self.__poller.add_connection(connection)
+
+    def __received(self, connection, data):
+        stream = self.__streams.get(connection)
+        if stream is None:
+            return
+
+        if stream.transfer is None:
+            # Only the header is framed; everything after it is data
+            stream.head += data
+            header = _framing.parse_header(stream.head)
+            if header is None:
+                return
+
+            length, header_size = header
+            if length != STRIPE_HEADER.size:
+                log.warning("Bad stripe header from {}; {} bytes".format(connection.address(), length))
+                connection.close()
+                return
+
+            end = header_size + length
+            if len(stream.head) < end:
+                return
+            self.__start_stream(connection, stream, bytes(stream.head[header_size:end]))
+            data_bytes = len(stream.head) - end
+            stream.head = None
+        else:
+            data_bytes = len(data)
+
+        if not data_bytes:
+            return
+
+        now = time.monotonic()
+        transfer = stream.transfer
+        stream.bytes += data_bytes
+        with self.__lock:
+            if transfer.first is None:
+                transfer.first = now
+                transfer.start = time.time()
+            transfer.last = max(transfer.last or now, now)
+
+    def __start_stream(self, connection, stream, header):
+        upload_id, index, stripes, offset, length = STRIPE_HEADER.unpack(header)
+
+        with self.__lock:
+            self.__expire()
+            transfer = self.__transfers.get(upload_id)
+            if transfer is None:
+                transfer = _Transfer(connection.address()[0], stripes)
+                self.__transfers[upload_id] = transfer
+            transfer.open += 1
+            transfer.idle_since = None
+
+        stream.transfer = transfer
+        stream.stripe = (upload_id, index, offset, length)
+
+    def __expire(self):
+        """
+        Gives up on uploads which have been missing stripes, with none
+        open, for too long; called with the lock held
+        """
+        cutoff = time.monotonic() - INCOMPLETE_TIMEOUT
+        for upload_id, transfer in list(self.__transfers.items()):
+            if transfer.idle_since is not None and transfer.idle_since < cutoff:
+                del self.__transfers[upload_id]
+                log.warning("Striped upload from {} incomplete; only {} of {} stripes arrived".format(
+                    transfer.source, len(transfer.ranges), transfer.stripes))
+
+    def __closed(self, connection):
+        self.__poller.remove_connection(connection)
+        with self.__lock:
+            stream = self.__streams.pop(connection, None)
+            if stream is None or stream.transfer is None:
+                return
+
+            upload_id, index, offset, length = stream.stripe
+            transfer = stream.transfer
+            transfer.ranges[index] = (offset, length, stream.bytes)
+            transfer.received += stream.bytes
+            transfer.open -= 1
+
+            if len(transfer.ranges) < transfer.stripes:
+                if not transfer.open:
+                    transfer.idle_since = time.monotonic()
+                return
+            del self.__transfers[upload_id]
+        missing = [i for i, (_, length, got) in transfer.ranges.items() if got != length]
+        if missing:
+            log.warning("Striped upload from {} incomplete; stripes {} short".format(transfer.source, missing))
+
+        duration = transfer.last - transfer.first if transfer.first is not None else 0.0
+        log.info("Striped upload of {} bytes over {} stripes from {} in {:.3f}s".format(
+            transfer.received, transfer.stripes, transfer.source, duration))
+        if duration <= 0:
+            duration = None
+        if self.__recorder:
+            self.__recorder.record(
+                "server-striped", transfer.source, self.__addr, transfer.start,
+                duration, transfer.received
+            )
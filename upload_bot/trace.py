@@ -0,0 +1,171 @@
+"""
+Workload traces for the upload bot
+
+A trace is a JSON lines file of every upload decision a bot made:
+
+    {"type": "header", "src": "10.0.0.1", "start": epoch seconds}
+    {"type": "upload", "src": "10.0.0.1", "dest": "10.0.0.3",
+     "time": epoch seconds, "writes": [bytes, ...], "gaps": [seconds, ...]}
+    {"type": "skip", "src": "10.0.0.1", "time": time of the upload}
+
+TraceRecorder wraps a workload and logs each plan it hands out, and a
+skip for each one which wasn't started because the bot already had
+as many uploads in progress as it allows. ReplayWorkload reads a
+trace back and hands out the same plans, less the skipped ones, at
+the same offsets from a common start time, optionally scaled faster
+or slower. Since every host replays against the same start time, traces
+from all hosts can be merged into one file and replayed across the
+whole network:
+
+    python3 -m upload_bot.trace merge merged.trace logs/*.trace
+"""
+
+from .workload import UploadPlan
+
+from threading import Lock
+
+import sys
+import json
+import time
+
+
+class TraceRecorder:
+    """
+    Workload which draws from another workload, and writes every
+    plan it hands out to a trace file
+    """
+
+    def __init__(self, workload, path, local_ip):
+        self.__workload = workload
+        self.__local_ip = local_ip
+        self.__last = None
+        self.__last_time = None
+        self.__lock = Lock()
+        self.__out = open(path, "a")
+        self.__write({"type": "header", "src": local_ip, "start": time.time()})
+
+    def __write(self, record):
+        with self.__lock:
+            self.__out.write(json.dumps(record) + "\n")
+            self.__out.flush()
+
+    def next_arrival(self):
+        return self.__workload.next_arrival()
+
+    def next_plan(self, targets):
+        plan = self.__workload.next_plan(targets)
+        self.__last = plan
+        self.__last_time = time.time()
+        self.__write({
+            "type": "upload", "src": self.__local_ip, "dest": plan.target,
+            "time": self.__last_time, "writes": plan.writes, "gaps": plan.gaps,
+        })
+        return plan
+
+    def skipped(self, plan):
+        """
+        Marks the last plan handed out as never started
+        """
+        self.__workload.skipped(plan)
+        if plan is self.__last:
+            self.__write({"type": "skip", "src": self.__local_ip, "time": self.__last_time})
+
+    def close(self):
+        with self.__lock:
+            self.__out.close()
+
+
+def read_trace(path):
+    """
+    Returns the start time of a trace (the earliest header) and
+    its uploads sorted by time, leaving out those which were skipped
+    """
+    start = None
+    uploads = []
+    skipped = set()
+    with open(path) as trace:
+        for line in trace:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            if record["type"] == "header":
+                start = record["start"] if start is None else min(start, record["start"])
+            elif record["type"] == "upload":
+                uploads.append(record)
+            elif record["type"] == "skip":
+                skipped.add((record["src"], record["time"]))
+
+    uploads = [record for record in uploads if (record["src"], record["time"]) not in skipped]
+    uploads.sort(key=lambda record: record["time"])
+    if start is None:
+        start = uploads[0]["time"] if uploads else 0.0
+    return start, uploads
+
+
+class ReplayWorkload:
+    """
+    Workload which replays the uploads made by local_ip in a trace.
+
+    Each upload starts at start_time plus its offset in the trace times
+    time_scale, so 2 replays at half speed and 0.5 at double speed; the
+    gaps between writes are scaled the same way. Timing is against the
+    absolute schedule, so delays in starting one upload don't shift
+    the rest. Without a start_time, the replay starts when the first
+    arrival is drawn. next_arrival() returns None once the trace is
+    exhausted
+    """
+
+    def __init__(self, path, local_ip, time_scale=1.0, start_time=None):
+        trace_start, uploads = read_trace(path)
+        self.__uploads = [record for record in uploads if record["src"] == local_ip]
+        self.__trace_start = trace_start
+        self.__scale = time_scale
+        self.__start = start_time
+        self.__next = 0
+
+    def __len__(self):
+        return len(self.__uploads)
+
+    def next_arrival(self):
+        if self.__next >= len(self.__uploads):
+            return None
+        if self.__start is None:
+            self.__start = time.time()
+
+        offset = (self.__uploads[self.__next]["time"] - self.__trace_start) * self.__scale
+        return max(0.0, self.__start + offset - time.time())
+
+    def next_plan(self, targets):
+        record = self.__uploads[self.__next]
+        self.__next += 1
+        return UploadPlan(
+            record["dest"], record["writes"], [gap * self.__scale for gap in record["gaps"]]
+        )
+
+    def skipped(self, plan):
+        pass
+
+
+def merge_traces(out_path, paths):
+    """
+    Merges the traces of several hosts into one file
+    """
+    records = []
+    for path in paths:
+        with open(path) as trace:
+            records.extend(json.loads(line) for line in trace if line.strip())
+
+    # Headers first, then uploads (and skips) in the order they happened
+    records.sort(key=lambda record: (record["type"] != "header", record.get("time", 0)))
+    with open(out_path, "w") as out:
+        for record in records:
+            out.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "merge":
+        print("Usage: python3 -m upload_bot.trace merge output-trace input-trace [input-trace ...]")
+        sys.exit(1)
+
+    merge_traces(sys.argv[2], sys.argv[3:])
@@ -0,0 +1,172 @@
+"""
+Workload profiles for the upload bot
+
+A workload decides when uploads start, where they go, how many bytes
+they send in which write sizes, and how the writes are paced. Every
+decision for an upload is drawn up front into an UploadPlan on the
+thread which starts uploads, so a seeded workload produces the same
+sequence of uploads no matter how the uploads themselves are run.
+
+Distributions are given as tuples of a name and its parameters:
+
+    arrivals     ("uniform", low, high)       seconds between uploads
+                 ("poisson", rate)            uploads per second
+    flow_size    ("writes", low, high)        randint(low, high) writes
+                 ("pareto", alpha, scale, cap)         bytes
+                 ("lognormal", mu, sigma, cap)         bytes
+                 ("mix", p, elephant, mice)   elephant with probability p
+    pacing       ("uniform", low, high)       seconds after each write
+                 ("cbr", bits_per_second)
+                 ("afap",)                    as fast as possible
+"""
+
+from .payload import DEFAULT_MIN_SIZE, DEFAULT_MAX_SIZE
+
+import random
+
+MB = 1024 * 1024
+
+PROFILES = {
+    # What the bot has always done
+    "legacy": {
+        "arrivals": ("uniform", 5, 10),
+        "flow_size": ("writes", 50, 200),
+        "pacing": ("uniform", 0, 0.25),
+    },
+    # Poisson arrivals with heavy-tailed sizes, mean about 1.2 MB
+    "pareto": {
+        "arrivals": ("poisson", 0.5),
+        "flow_size": ("pareto", 1.2, 200 * 1024, 256 * MB),
+        "pacing": ("afap",),
+    },
+    # Poisson arrivals with lognormal sizes, median about 1 MB
+    "lognormal": {
+        "arrivals": ("poisson", 0.5),
+        "flow_size": ("lognormal", 13.8, 1.5, 256 * MB),
+        "pacing": ("afap",),
+    },
+    # Mostly small transfers, with 10% elephants carrying most of the bytes
+    "elephant-mice": {
+        "arrivals": ("poisson", 2),
+        "flow_size": (
+            "mix", 0.1,
+            ("lognormal", 17.7, 0.5, 512 * MB),
+            ("lognormal", 10.5, 1.0, 1 * MB),
+        ),
+        "pacing": ("afap",),
+    },
+    # Long constant-bitrate streams, like video uploads
+    "cbr": {
+        "arrivals": ("poisson", 0.2),
+        "flow_size": ("lognormal", 16.5, 0.5, 256 * MB),
+        "pacing": ("cbr", 8 * 1000 * 1000),
+    },
+}
+
+
+class UploadPlan:
+    """
+    Everything about one upload: the target, the size of each
+    write, and the time to wait after each write
+    """
+
+    __slots__ = ["target", "writes", "gaps"]
+
+    def __init__(self, target, writes, gaps):
+        self.target = target
+        self.writes = writes
+        self.gaps = gaps
+
+    def total_bytes(self):
+        return sum(self.writes)
+
+
+class Workload:
+    """
+    Draws uploads from a named profile (see PROFILES), with
+    optional overrides of any of its distributions.
+
+    Writes are between min_write and max_write bytes; flow sizes
+    given in bytes are cut into writes of that size
+    """
+
+    def __init__(self, profile="legacy", seed=None, arrivals=None, flow_size=None, pacing=None,
+                 min_write=DEFAULT_MIN_SIZE, max_write=DEFAULT_MAX_SIZE):
+        if profile not in PROFILES:
+            raise ValueError("Unknown workload profile {}".format(profile))
+
+        settings = PROFILES[profile]
+        self.__arrivals = arrivals or settings["arrivals"]
+        self.__flow_size = flow_size or settings["flow_size"]
+        self.__pacing = pacing or settings["pacing"]
+
+        self.__min_write = min_write
+        self.__max_write = max_write
+        self.__random = random.Random(seed)
+
+    def __draw_bytes(self, distribution):
+        kind = distribution[0]
+        if kind == "pareto":
+            _, alpha, scale, cap = distribution
+            return min(cap, int(scale * self.__random.paretovariate(alpha)))
+        elif kind == "lognormal":
+            _, mu, sigma, cap = distribution
+            return min(cap, int(self.__random.lognormvariate(mu, sigma)))
+        elif kind == "mix":
+            _, elephant_probability, elephant, mice = distribution
+            if self.__random.random() < elephant_probability:
+                return self.__draw_bytes(elephant)
+            return self.__draw_bytes(mice)
+        raise ValueError("Unknown flow size distribution {}".format(kind))
+
+    def __draw_writes(self):
+        if self.__flow_size[0] == "writes":
+            _, low, high = self.__flow_size
+            return [
+                self.__random.randint(self.__min_write, self.__max_write)
+                for _ in range(self.__random.randint(low, high))
+            ]
+
+        remaining = max(1, self.__draw_bytes(self.__flow_size))
+        writes = []
+        while remaining > 0:
+            size = min(remaining, self.__random.randint(self.__min_write, self.__max_write))
+            writes.append(size)
+            remaining -= size
+        return writes
+
+    def __draw_gap(self, size):
+        kind = self.__pacing[0]
+        if kind == "uniform":
+            return self.__random.uniform(self.__pacing[1], self.__pacing[2])
+        elif kind == "cbr":
+            return size * 8.0 / self.__pacing[1]
+        elif kind == "afap":
+            return 0
+        raise ValueError("Unknown pacing {}".format(kind))
+
+    def next_arrival(self):
+        """
+        Returns the number of seconds until the next upload starts
+        """
+        kind = self.__arrivals[0]
+        if kind == "uniform":
+            return self.__random.uniform(self.__arrivals[1], self.__arrivals[2])
+        elif kind == "poisson":
+            return self.__random.expovariate(self.__arrivals[1])
+        raise ValueError("Unknown arrival distribution {}".format(kind))
+
+    def next_plan(self, targets):
+        """
+        Returns an UploadPlan to a random member of targets
+        """
+        target = self.__random.choice(targets)
+        writes = self.__draw_writes()
+        gaps = [self.__draw_gap(size) for size in writes]
+        return UploadPlan(target, writes, gaps)
+
+    def skipped(self, plan):
+        """
+        Called with a plan whose upload wasn't started
+        """
+        pass